@@ -4,6 +4,44 @@ host_opts = [
     cfg.PortOpt('listener_port_number',
                 default=8000,
                 help='Host Port Number to use for docker communication'),
+    cfg.StrOpt('listener_socket',
+               help='Unix socket to serve docker communication on instead '
+                    'of listener_port_number, for example '
+                    '/run/docker/plugins/vmaxAF.sock'),
+    cfg.StrOpt('listener_server',
+               default='twisted',
+               choices=['twisted', 'flask'],
+               help='HTTP server used for docker communication. twisted is '
+                    'the production server, flask the development server'),
+    cfg.IntOpt('listener_threads',
+               default=20,
+               min=1,
+               help='Maximum number of Create, Mount, Unmount and Remove '
+                    'requests handled at once by the twisted server'),
+    cfg.IntOpt('listener_fast_threads',
+               default=4,
+               min=1,
+               help='Worker threads the twisted server reserves for requests '
+                    'which only read local state, such as Path, Get and '
+                    'List'),
+    cfg.IntOpt('listener_backlog',
+               default=50,
+               min=1,
+               help='Listen backlog of the twisted server'),
+    cfg.IntOpt('listener_idle_timeout',
+               default=120,
+               min=1,
+               help='Seconds a connection to the twisted server may go '
+                    'without receiving data, when no request is being '
+                    'handled, before it is closed. Not a limit on how long '
+                    'a request may run'),
+    cfg.IntOpt('listener_request_timeout',
+               default=600,
+               min=0,
+               help='Seconds a request to the twisted server may run before '
+                    'docker is sent an error and its worker thread is '
+                    'freed. The handler runs on to its end. 0 for no '
+                    'deadline'),
     cfg.StrOpt('mount_path',
                 default='/docker_volumes/',
                 help='Path to mount for volumes'),
@@ -16,6 +54,38 @@ host_opts = [
                      'with its options'),
     cfg.StrOpt('default_backend',
                help='Default backend to use'),
+    cfg.StrOpt('metadata_store',
+               default='json',
+               choices=['json', 'sqlite'],
+               help='Store used to persist volume metadata. json keeps a '
+                    'journaled json file, sqlite keeps an indexed sqlite '
+                    'database'),
+    cfg.IntOpt('metadata_commit_window',
+               default=0,
+               min=0,
+               help='Milliseconds to wait for more volume metadata changes '
+                    'to join a batch before it is written'),
+    cfg.IntOpt('device_wait_timeout',
+               default=30,
+               min=1,
+               help='Seconds to wait for a volume to appear on the host '
+                    'after it is attached'),
+    cfg.IntOpt('multipath_wait_timeout',
+               default=5,
+               min=0,
+               help='Seconds to wait for multipath to build a device on a '
+                    'volume once its first path has appeared'),
+    cfg.BoolOpt('iscsi_multipath',
+                default=False,
+                help='Mount iSCSI volumes through their multipath device, '
+                     'waiting for it to have multipath_min_paths paths'),
+    cfg.IntOpt('multipath_min_paths',
+               default=2,
+               min=1,
+               help='Paths an iSCSI volume waits for before it is mounted '
+                    'when iscsi_multipath is set, at most one per portal of '
+                    'the port group. Without them by device_wait_timeout it '
+                    'is mounted with the paths it has'),
 ]
 
 volume_opts = [
@@ -52,5 +122,73 @@ volume_opts = [
                help='service level'),
     cfg.StrOpt('workload',
                help='workload'),
+    cfg.IntOpt('max_concurrent_operations',
+               default=8,
+               min=1,
+               help='Maximum number of Create, Mount, Unmount and Remove '
+                    'requests working against this backend at once'),
+    cfg.IntOpt('catalog_cache_ttl',
+               default=300,
+               min=0,
+               help='Seconds the SLOs, workloads, SRPs, port groups and '
+                    'port IP addresses read from the array are cached'),
+    cfg.IntOpt('object_cache_ttl',
+               default=10,
+               min=0,
+               help='Seconds storage groups, masking views and initiator '
+                    'groups read from the array are cached'),
+    cfg.IntOpt('initiator_cache_ttl',
+               default=300,
+               min=0,
+               help='Seconds the initiators in use on the array and their '
+                    'initiator groups are cached'),
+    cfg.IntOpt('rest_retries',
+               default=2,
+               min=0,
+               help='Times a Unisphere call which only reads is retried '
+                    'after Unisphere fails to handle it'),
+    cfg.FloatOpt('rest_retry_delay',
+                 default=0.5,
+                 min=0,
+                 help='Seconds of backoff before the first retry, doubled '
+                      'for each further retry and jittered'),
+    cfg.FloatOpt('rest_retry_budget',
+                 default=0.2,
+                 min=0,
+                 help='Retries allowed per Unisphere call made, on top of '
+                      'a reserve of 10'),
+    cfg.IntOpt('circuit_breaker_threshold',
+               default=5,
+               min=1,
+               help='Failed Unisphere calls in a row after which calls '
+                    'fail at once'),
+    cfg.IntOpt('circuit_breaker_reset_timeout',
+               default=30,
+               min=1,
+               help='Seconds calls fail at once before a call is let '
+                    'through to probe Unisphere'),
+    cfg.IntOpt('rest_connections',
+               default=4,
+               min=1,
+               help='Most connections to Unisphere open at once'),
+    cfg.IntOpt('rest_connection_idle_timeout',
+               default=300,
+               min=1,
+               help='Seconds a connection to Unisphere may be unused before '
+                    'it is closed'),
+    cfg.IntOpt('rest_connection_check_interval',
+               default=60,
+               min=0,
+               help='Seconds a connection to Unisphere may be unused before '
+                    'it is checked ahead of its next use'),
+    cfg.IntOpt('rest_read_limit',
+               default=3,
+               min=1,
+               help='Most Unisphere calls which only read in flight at once'),
+    cfg.IntOpt('rest_mutate_limit',
+               default=1,
+               min=1,
+               help='Most Unisphere calls which change the array in flight '
+                    'at once'),
 
 ]
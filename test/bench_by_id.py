@@ -0,0 +1,84 @@
+"""
+Time to resolve a volume's device among 1,000 synthetic VMAX LUNs, each
+with a SCSI disk and a multipath device, by scanning the udev devices and
+by its /dev/disk/by-id links. The udev database is a list of devices with
+the properties udev gives a disk, and by-id is a directory of symlinks
+like the one udev keeps.
+
+    python -m test.bench_by_id [repeats]
+"""
+from __future__ import absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from test import test_fileutil
+from vmaxafdockerplugin import fileutil
+
+LUNS = 1000
+
+
+def _properties(i):
+    # The other properties udev keeps on a disk, which a scan has to get
+    # past too.
+    return dict(('ID_PROPERTY_%d' % n, 'value-%d-%d' % (i, n))
+                for n in range(25))
+
+
+def _build(dev_root):
+    by_id = os.path.join(dev_root, 'disk', 'by-id')
+    os.makedirs(by_id)
+    devices = []
+    for lun in range(LUNS):
+        device_id = '%05X' % lun
+        wwn = test_fileutil.vmax_wwid(device_id)[len('naa.'):]
+        disk, dm = 'sd%d' % lun, 'dm-%d' % lun
+        devices.append(test_fileutil.vmax_disk(
+            '/dev/' + disk, device_id, claimed=True, **_properties(lun)))
+        devices.append(test_fileutil.vmax_dm(
+            '/dev/' + dm, device_id, **_properties(lun)))
+        for name in (disk, dm):
+            open(os.path.join(dev_root, name), 'w').close()
+        os.symlink('../../' + dm, os.path.join(by_id,
+                                               'dm-uuid-mpath-3' + wwn))
+        os.symlink('../../' + dm, os.path.join(by_id, 'wwn-0x' + wwn))
+    return test_fileutil.FakeContext(devices)
+
+
+def _timings(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        timings.append((time.time() - start) * 1000.0)
+    timings.sort()
+    return timings[len(timings) // 2], timings[-1]
+
+
+def main(repeats=50):
+    dev_root = tempfile.mkdtemp()
+    try:
+        context = _build(dev_root)
+        print('%d LUNs, %d udev devices' % (LUNS, len(context.devices)))
+        print('%8s %20s %20s' % ('LUN', 'scan ms p50/max',
+                                 'by-id ms p50/max'))
+        for lun in (0, LUNS // 2, LUNS - 1):
+            device_id = '%05X' % lun
+            encoded_str = fileutil._encode_device_id(device_id)
+            wwn = test_fileutil.vmax_wwid(device_id)[len('naa.'):]
+            print('%8d %20s %20s' % (
+                lun,
+                '%.3f / %.3f' % _timings(lambda: fileutil._find_device(
+                    context, test_fileutil.SYMM_ID, encoded_str), repeats),
+                '%.3f / %.3f' % _timings(
+                    lambda: fileutil._find_device_by_wwn(
+                        wwn, dev_root=dev_root), repeats)))
+    finally:
+        shutil.rmtree(dev_root)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,95 @@
+"""
+Cost of the targeted FC rescan and device removal on a simulated sysfs
+tree of 4 HBAs, each seeing 32 array ports with 500 LUNs between them.
+Writes to the scan and delete files land in plain files, so the timings
+are the plugin's own work; what the kernel would do is shown by how many
+targets each approach asks it to probe. rescan-scsi-bus itself cannot be
+simulated, it issues a LIP on every HBA and probes every target.
+
+    python -m test.bench_fc [repeats]
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+from test import test_fileutil
+from vmaxafdockerplugin import fileutil
+
+HBAS = 4
+PORTS = 32
+LUNS = 500
+PORT_GROUP = 4
+
+
+def _port_wwn(port):
+    return '0x50000973b00c%04x' % port
+
+
+def _build(sysfs):
+    for host in range(HBAS):
+        for port in range(PORTS):
+            sysfs.fc_target(host, 0, port, _port_wwn(port))
+    disk = 0
+    for lun in range(LUNS):
+        device_id = '%05X' % lun
+        slaves = []
+        for host in range(HBAS):
+            name = 'sd%d' % disk
+            disk += 1
+            sysfs.disk(name, test_fileutil.vmax_wwid(device_id))
+            slaves.append(name)
+        sysfs.multipath('dm-%d' % lun, 'mpath%d' % lun, slaves)
+    return disk
+
+
+def _timings(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        timings.append((time.time() - start) * 1000.0)
+    timings.sort()
+    return timings[len(timings) // 2], timings[-1]
+
+
+def _whole_bus(sysfs_root):
+    # The scan every host does in a rescan-scsi-bus, without its LIP.
+    hosts_dir = os.path.join(sysfs_root, 'class', 'scsi_host')
+    for host in os.listdir(hosts_dir):
+        fileutil._write_sysfs(os.path.join(hosts_dir, host, 'scan'),
+                              '- - -')
+
+
+def main(repeats=20):
+    sysfs = test_fileutil.FakeSysfs()
+    saved = fileutil.subprocess
+    fileutil.subprocess = test_fileutil.FakeSubprocess()
+    try:
+        disks = _build(sysfs)
+        wwns = [_port_wwn(port) for port in range(PORT_GROUP)]
+        print('%d HBAs, %d array ports each, %d LUNs, %d SCSI disks' % (
+            HBAS, PORTS, LUNS, disks))
+        print('%-28s %10s %16s' % ('', 'targets', 'ms p50/max'))
+        print('%-28s %10d %16s' % (
+            'whole bus scan', HBAS * PORTS,
+            '%.2f / %.2f' % _timings(lambda: _whole_bus(sysfs.root),
+                                     repeats)))
+        print('%-28s %10d %16s' % (
+            'rescan_fc_targets', fileutil.rescan_fc_targets(
+                wwns, sysfs_root=sysfs.root),
+            '%.2f / %.2f' % _timings(lambda: fileutil.rescan_fc_targets(
+                wwns, sysfs_root=sysfs.root), repeats)))
+        print('%-28s %10s %16s' % (
+            'remove_vmax_devices', '-',
+            '%.2f / %.2f' % _timings(lambda: fileutil.remove_vmax_devices(
+                test_fileutil.SYMM_ID, '00001', sysfs_root=sysfs.root),
+                repeats)))
+    finally:
+        fileutil.subprocess = saved
+        sysfs.remove()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
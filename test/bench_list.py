@@ -0,0 +1,68 @@
+"""
+Latency of VolumeDriver.List at 1k, 10k and 100k volumes, answered the old
+way, by parsing the data file, and from memory.
+
+    python -m test.bench_list [repeats]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from vmaxafdockerplugin import volume_ops
+
+SIZES = (1000, 10000, 100000)
+
+
+def _volumes(count):
+    return dict(('docker_vol_%06d' % i,
+                 {'name': 'docker_vol_%06d' % i,
+                  'volume_id': '%05X' % i,
+                  'wwn': '60000970000197900049533030%06X' % i,
+                  'formatted': True,
+                  'exported': {},
+                  'mounted': {'127.0.0.1': {'mount_point': '/mnt/%d' % i,
+                                            'count': 1}},
+                  'parameters': {},
+                  'backend-name': 'backend1'})
+                for i in range(count))
+
+
+def _timings(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        timings.append((time.time() - start) * 1000.0)
+    timings.sort()
+    return timings[len(timings) // 2], timings[-1]
+
+
+def main(repeats=20):
+    print('%8s %22s %22s' % ('volumes', 'parse file ms p50/max',
+                             'memory ms p50/max'))
+    for count in SIZES:
+        data_dir = tempfile.mkdtemp()
+        try:
+            data_file = os.path.join(data_dir, 'volumes_data.json')
+            with open(data_file, 'w') as f:
+                json.dump(_volumes(count), f, indent=2)
+
+            def parse():
+                with open(data_file) as f:
+                    return list(json.load(f))
+
+            metadata = volume_ops.VolumeMetaData(
+                store=volume_ops.JournalStore(data_file))
+            print('%8d %22s %22s' % (
+                count,
+                '%.2f / %.2f' % _timings(parse, repeats),
+                '%.3f / %.3f' % _timings(metadata.get_volume_list, repeats)))
+        finally:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,134 @@
+"""
+Latency of VolumeDriver.Path and VolumeDriver.Get while slow Mounts keep
+the server busy. Mounts sleep as if waiting on the array, Path and Get
+answer at once, each server runs in a child process. The servers are:
+
+    flask-single    the development server as Flask 0.12 runs it
+    flask-threaded  the development server as Flask 1.x runs it, a new
+                    thread per request
+    twisted-shared  the twisted server with Path and Get on the same
+                    worker threads as Mount
+    twisted         the twisted server, Path and Get on the fast lane
+
+    python -m test.bench_server [mounts] [mount_seconds] [seconds]
+"""
+import httplib
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from flask import Flask
+
+PORT = 18000
+READ_CLIENTS = 2
+
+
+def _app(mount_seconds):
+    app = Flask('bench')
+
+    @app.route('/VolumeDriver.Mount', methods=['POST'])
+    def mount():
+        time.sleep(mount_seconds)
+        return json.dumps({u'Err': '', u'Mountpoint': '/mnt/vol'})
+
+    @app.route('/VolumeDriver.Path', methods=['POST'])
+    @app.route('/VolumeDriver.Get', methods=['POST'])
+    def path():
+        return json.dumps({u'Err': '', u'Mountpoint': '/mnt/vol'})
+
+    return app
+
+
+SERVERS = ('flask-single', 'flask-threaded', 'twisted-shared', 'twisted')
+
+
+def _serve(server, mount_seconds):
+    app = _app(float(mount_seconds))
+    if server.startswith('flask'):
+        app.run('127.0.0.1', PORT, threaded=server == 'flask-threaded')
+    else:
+        from vmaxafdockerplugin import server as twisted_server
+        if server == 'twisted-shared':
+            twisted_server.FAST_PATHS = frozenset()
+        twisted_server.serve(app, PORT, threads=20, fast_threads=4)
+
+
+def _post(path, timeout=600):
+    conn = httplib.HTTPConnection('127.0.0.1', PORT, timeout=timeout)
+    try:
+        conn.request('POST', path, json.dumps({'Name': 'vol', 'ID': '1'}))
+        return conn.getresponse().read()
+    finally:
+        conn.close()
+
+
+def _wait_for_server():
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', PORT), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def _percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def measure(server, mounts, mount_seconds, seconds):
+    child = subprocess.Popen([sys.executable, '-m', 'test.bench_server',
+                              'serve', server, str(mount_seconds)])
+    try:
+        _wait_for_server()
+        stop = time.time() + seconds
+        timings = []
+        lock = threading.Lock()
+
+        def mount():
+            while time.time() < stop:
+                _post('/VolumeDriver.Mount')
+
+        def read():
+            while time.time() < stop:
+                for path in ('/VolumeDriver.Path', '/VolumeDriver.Get'):
+                    start = time.time()
+                    _post(path)
+                    with lock:
+                        timings.append((time.time() - start) * 1000.0)
+
+        threads = ([threading.Thread(target=mount)
+                    for _ in range(int(mounts))] +
+                   [threading.Thread(target=read)
+                    for _ in range(READ_CLIENTS)])
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (len(timings), _percentile(timings, 0.5),
+                _percentile(timings, 0.99), max(timings))
+    finally:
+        child.terminate()
+        child.wait()
+
+
+def main(mounts=32, mount_seconds=2.0, seconds=20.0):
+    print('%d Mounts of %.1fs running, %d clients calling Path/Get' % (
+        mounts, mount_seconds, READ_CLIENTS))
+    print('%15s %8s %10s %10s %10s' % ('server', 'requests', 'p50 ms',
+                                       'p99 ms', 'max ms'))
+    for server in SERVERS:
+        print('%15s %8d %10.1f %10.1f %10.1f' % (
+            (server,) + measure(server, mounts, mount_seconds, seconds)))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        _serve(*sys.argv[2:])
+    else:
+        main(*[float(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,99 @@
+"""
+Start up time of the listener with 1, 8 and 32 configured backends. Each
+run is a fresh process, timing the import of listener_vmax and
+create_app. Then, for comparison, what the listener did at import before
+create_app existed and no longer does at start up: build a U4VConn per
+backend, and import pyudev, sh and the twisted reactor. Unisphere is
+pointed at a closed local port, so no request made in the background
+waits on a network.
+
+    python -m test.bench_startup [repeats]
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = (1, 8, 32)
+BACKEND = """
+[Backend%(i)d]
+volume_backend_name = Backend%(i)d
+storage_protocol = iSCSI
+port_groups = [PG1]
+rest_server_ip = 127.0.0.1
+rest_port_number = 1
+rest_user_name = user
+rest_password = password
+array = 0001979000%(i)02d
+srp = SRP_1
+"""
+
+
+def _write_conf(data_dir, count):
+    conf_file = os.path.join(data_dir, 'vmax.conf')
+    with open(conf_file, 'w') as f:
+        f.write('[DEFAULT]\nenabled_backends = %s\nlog_file = %s\n' % (
+            ','.join('Backend%d' % i for i in range(count)),
+            os.path.join(data_dir, 'vmax.log')))
+        for i in range(count):
+            f.write(BACKEND % {'i': i})
+    return conf_file
+
+
+def _start(conf_file, data_dir):
+    start = time.time()
+    from vmaxafdockerplugin import listener_vmax
+    from vmaxafdockerplugin import volume_ops
+    imported = time.time()
+    listener_vmax.vmax_plugin_dir = data_dir
+    listener_vmax.vmax_plugin_file = os.path.join(data_dir, 'vmaxAF.json')
+    volume_ops.JournalStore.__init__.__func__.__defaults__ = (
+        os.path.join(data_dir, 'volumes_data.json'),
+        volume_ops.JournalStore.COMPACT_THRESHOLD)
+    listener_vmax.create_app(conf_file)
+    created = time.time()
+    for vmax in listener_vmax.backend_dict.values():
+        vmax._connect()
+    connected = time.time()
+    import pyudev  # noqa: F401
+    import sh  # noqa: F401
+    from twisted.internet import reactor  # noqa: F401
+    deferred = time.time()
+    print(json.dumps([(imported - start) * 1000.0,
+                      (created - imported) * 1000.0,
+                      (connected - created) * 1000.0,
+                      (deferred - connected) * 1000.0]))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main(repeats=5):
+    print('%8s %10s %14s %12s %12s' % ('backends', 'import ms',
+                                       'create_app ms', 'U4VConn ms',
+                                       'lazy mods ms'))
+    for count in SIZES:
+        data_dir = tempfile.mkdtemp()
+        try:
+            conf_file = _write_conf(data_dir, count)
+            runs = [json.loads(subprocess.check_output(
+                [sys.executable, '-m', 'test.bench_startup', 'start',
+                 conf_file, data_dir]).splitlines()[-1])
+                for _ in range(repeats)]
+            print('%8d %10.1f %14.1f %12.1f %12.1f' % (
+                (count,) + tuple(_median(column) for column in zip(*runs))))
+        finally:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['start']:
+        _start(*sys.argv[2:])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
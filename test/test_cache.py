@@ -0,0 +1,98 @@
+import threading
+import time
+import unittest
+
+from vmaxafdockerplugin import cache
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_hit_miss_and_expiry(self):
+        ttl_cache = cache.TTLCache(0.05)
+        loads = []
+
+        def load(value):
+            loads.append(value)
+            return value
+
+        self.assertEqual('a', ttl_cache.get('k', load, 'a'))
+        self.assertEqual('a', ttl_cache.get('k', load, 'b'))
+        time.sleep(0.06)
+        self.assertEqual('c', ttl_cache.get('k', load, 'c'))
+        self.assertEqual(['a', 'c'], loads)
+        self.assertEqual({'hits': 1, 'misses': 2, 'entries': 1},
+                         ttl_cache.stats())
+
+    def test_none_is_not_cached(self):
+        ttl_cache = cache.TTLCache(60)
+        loads = []
+        for _ in range(2):
+            ttl_cache.get('k', lambda: loads.append(1))
+        self.assertEqual(2, len(loads))
+
+    def _load_across(self, ttl_cache, key, invalidate):
+        """
+        Load key while invalidate runs, as a change on the array would be
+        made while the stale value is read.
+        """
+        loading = threading.Event()
+        invalidated = threading.Event()
+
+        def load():
+            loading.set()
+            invalidated.wait()
+            return 'stale'
+
+        thread = threading.Thread(target=ttl_cache.get, args=(key, load))
+        thread.start()
+        loading.wait()
+        invalidate()
+        invalidated.set()
+        thread.join()
+
+    def test_invalidate_during_load_drops_loaded_value(self):
+        ttl_cache = cache.TTLCache(60)
+        self._load_across(ttl_cache, 'sg1',
+                          lambda: ttl_cache.invalidate('sg1'))
+        self.assertEqual('fresh', ttl_cache.get('sg1', lambda: 'fresh'))
+
+    def test_invalidate_all_during_load_drops_loaded_value(self):
+        ttl_cache = cache.TTLCache(60)
+        self._load_across(ttl_cache, 'sg1', ttl_cache.invalidate)
+        self.assertEqual('fresh', ttl_cache.get('sg1', lambda: 'fresh'))
+
+    def test_invalidate_matching_during_load_drops_loaded_value(self):
+        ttl_cache = cache.TTLCache(60)
+        self._load_across(ttl_cache, 'sg1', lambda: (
+            ttl_cache.invalidate_matching(lambda key, value: False)))
+        self.assertEqual('fresh', ttl_cache.get('sg1', lambda: 'fresh'))
+
+    def test_other_key_invalidated_during_load_keeps_value(self):
+        ttl_cache = cache.TTLCache(60)
+        self._load_across(ttl_cache, 'sg1',
+                          lambda: ttl_cache.invalidate('sg2'))
+        self.assertEqual('stale', ttl_cache.get('sg1', lambda: 'fresh'))
+
+    def test_invalidate_matching(self):
+        ttl_cache = cache.TTLCache(60)
+        ttl_cache.set(('ig', 'init1'), 'IG1')
+        ttl_cache.set(('ig', 'init2'), 'IG2')
+        ttl_cache.invalidate_matching(lambda key, value: value == 'IG1')
+        self.assertEqual(None, ttl_cache.get(('ig', 'init1'), lambda: None))
+        self.assertEqual('IG2', ttl_cache.get(('ig', 'init2'), lambda: None))
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def test_shared_by_name_and_owner(self):
+        catalog = cache.shared('catalog', 'test-array1', 60)
+        self.assertIs(catalog, cache.shared('catalog', 'test-array1', 5))
+        self.assertEqual(60, catalog.ttl)
+        self.assertIsNot(catalog, cache.shared('objects', 'test-array1', 60))
+        self.assertIsNot(catalog, cache.shared('catalog', 'test-array2', 60))
+        self.assertIsNot(cache.shared('catalog', None, 60),
+                         cache.shared('catalog', None, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,412 @@
+import os
+import Queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from vmaxafdockerplugin import fileutil
+
+SYMM_ID = '000197900049'
+
+
+def vmax_wwid(device_id, symm_id=SYMM_ID):
+    return 'naa.60000970' + symm_id + '53' + (
+        fileutil._encode_device_id(device_id))
+
+
+class FakeSysfs(object):
+    """
+    A directory laid out like the parts of sysfs fileutil reads.
+    """
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+
+    def remove(self):
+        shutil.rmtree(self.root)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def write(self, value, *parts):
+        path = self.path(*parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(value)
+
+    def read(self, *parts):
+        path = self.path(*parts)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+    def fc_target(self, host, channel, target_id, port_name):
+        self.write(port_name + '\n', 'class', 'fc_transport',
+                   'target%s:%s:%s' % (host, channel, target_id), 'port_name')
+        self.write('', 'class', 'scsi_host', 'host%s' % host, 'scan')
+
+    def disk(self, name, wwid):
+        self.write(wwid + '\n', 'block', name, 'device', 'wwid')
+
+    def multipath(self, name, map_name, slaves):
+        self.write(map_name + '\n', 'block', name, 'dm', 'name')
+        for slave in slaves:
+            self.write('', 'block', name, 'slaves', slave)
+
+    def iscsi_session(self, sid, address, state='LOGGED_IN'):
+        if state is None:
+            # Older kernels have no state attribute.
+            os.makedirs(self.path('class', 'iscsi_session',
+                                  'session%s' % sid))
+        else:
+            self.write(state + '\n', 'class', 'iscsi_session',
+                       'session%s' % sid, 'state')
+        self.write(address + '\n', 'class', 'iscsi_connection',
+                   'connection%s:0' % sid, 'persistent_address')
+
+
+class FakeSubprocess(object):
+    CalledProcessError = subprocess.CalledProcessError
+
+    def __init__(self):
+        self.calls = []
+
+    def check_call(self, args):
+        self.calls.append(args)
+
+
+class FcRescanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = FakeSysfs()
+
+    def tearDown(self):
+        self.sysfs.remove()
+
+    def test_only_the_port_groups_targets_are_scanned(self):
+        self.sysfs.fc_target(1, 0, 0, '0x50000973b00c6c04')
+        self.sysfs.fc_target(1, 0, 1, '0x21000024ff3dd1aa')
+        self.sysfs.fc_target(2, 0, 3, '0x50000973b00c6c44')
+        self.sysfs.fc_target(3, 0, 0, '0x21000024ff3dd1bb')
+        scanned = fileutil.rescan_fc_targets(
+            ['50:00:09:73:B0:0C:6C:04', '50000973b00c6c44'],
+            sysfs_root=self.sysfs.root)
+        self.assertEqual(2, scanned)
+        self.assertEqual('0 0 -', self.sysfs.read(
+            'class', 'scsi_host', 'host1', 'scan'))
+        self.assertEqual('0 3 -', self.sysfs.read(
+            'class', 'scsi_host', 'host2', 'scan'))
+        self.assertEqual('', self.sysfs.read(
+            'class', 'scsi_host', 'host3', 'scan'))
+
+    def test_no_fc_transport(self):
+        self.assertEqual(0, fileutil.rescan_fc_targets(
+            ['50000973b00c6c04'], sysfs_root=self.sysfs.root))
+
+
+class RemoveDevicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = FakeSysfs()
+        self.subprocess = fileutil.subprocess
+        fileutil.subprocess = FakeSubprocess()
+
+    def tearDown(self):
+        fileutil.subprocess = self.subprocess
+        self.sysfs.remove()
+
+    def test_removes_only_the_volumes_paths(self):
+        self.sysfs.disk('sdb', vmax_wwid('0012A'))
+        self.sysfs.disk('sdc', vmax_wwid('0012A'))
+        self.sysfs.disk('sdd', vmax_wwid('0012B'))
+        self.sysfs.disk('sde', vmax_wwid('0012A', symm_id='000197900050'))
+        self.sysfs.multipath('dm-0', 'mpatha', ['sdb', 'sdc'])
+        self.sysfs.multipath('dm-1', 'mpathb', ['sdd'])
+        removed = fileutil.remove_vmax_devices(
+            SYMM_ID, '0012A', sysfs_root=self.sysfs.root)
+        self.assertEqual(['sdb', 'sdc'], sorted(removed))
+        for name in ('sdb', 'sdc'):
+            self.assertEqual('1', self.sysfs.read(
+                'block', name, 'device', 'delete'))
+        for name in ('sdd', 'sde'):
+            self.assertIsNone(self.sysfs.read(
+                'block', name, 'device', 'delete'))
+        self.assertEqual([['sudo', 'multipath', '-f', 'mpatha']],
+                         fileutil.subprocess.calls)
+
+    def test_no_devices(self):
+        self.assertEqual([], fileutil.remove_vmax_devices(
+            SYMM_ID, '0012A', sysfs_root=self.sysfs.root))
+        self.assertEqual([], fileutil.subprocess.calls)
+
+
+class FakeDevice(dict):
+    def __init__(self, device_node, action='add', device_type='disk',
+                 **properties):
+        dict.__init__(self, properties)
+        self.device_node = device_node
+        self.action = action
+        self.device_type = device_type
+
+
+def vmax_disk(device_node, device_id, claimed=False, **kwargs):
+    properties = {'ID_SERIAL_SHORT': vmax_wwid(device_id)[len('naa.'):],
+                  'MAJOR': '8'}
+    if claimed:
+        properties['DM_MULTIPATH_DEVICE_PATH'] = '1'
+    properties.update(kwargs)
+    return FakeDevice(device_node, **properties)
+
+
+def vmax_dm(device_node, device_id, **kwargs):
+    return FakeDevice(device_node, DM_TYPE='scsi',
+                      DM_NAME='3' + vmax_wwid(device_id)[len('naa.'):],
+                      **kwargs)
+
+
+class FakeContext(object):
+    def __init__(self, devices=()):
+        self.devices = list(devices)
+
+    def list_devices(self, subsystem=None, **properties):
+        return [device for device in self.devices
+                if all(device.get(key) == value
+                       for key, value in properties.items())]
+
+
+class FakeMonitor(object):
+    def __init__(self, devices):
+        self.devices = list(devices)
+
+    def poll(self):
+        if not self.devices:
+            raise IOError('closed')
+        return self.devices.pop(0)
+
+
+class DeviceEventsTest(unittest.TestCase):
+
+    def test_events_reach_subscribers_until_they_leave(self):
+        device_events = fileutil.DeviceEvents()
+        # Started already, as if by an earlier subscriber.
+        device_events._started = True
+        with device_events.subscribe() as first:
+            with device_events.subscribe() as second:
+                device_events._dispatch(FakeMonitor(['sdb']))
+            device_events._dispatch(FakeMonitor(['sdc']))
+        device_events._dispatch(FakeMonitor(['sdd']))
+        self.assertEqual(['sdb', 'sdc'], [first.get_nowait()
+                                          for _ in range(first.qsize())])
+        self.assertEqual(['sdb'], [second.get_nowait()
+                                   for _ in range(second.qsize())])
+        self.assertEqual(set(), device_events._subscribers)
+        # The failed monitor is replaced on the next subscribe.
+        self.assertFalse(device_events._started)
+
+
+class WaitForDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.claimed = set()
+        self.saved = fileutil._multipath_claimed_path
+        fileutil._multipath_claimed_path = (
+            lambda context, path: path in self.claimed)
+        self.events = Queue.Queue()
+
+    def tearDown(self):
+        fileutil._multipath_claimed_path = self.saved
+
+    def _wait(self, context=None, wait_for_multipath=False, timeout=5):
+        start = time.time()
+        path = fileutil._wait_for_device(
+            context or FakeContext(), self.events, SYMM_ID,
+            fileutil._encode_device_id('0012A'), timeout, 1,
+            wait_for_multipath=wait_for_multipath)
+        return path, time.time() - start
+
+    def _later(self, *devices):
+        def send():
+            for device in devices:
+                time.sleep(0.05)
+                self.events.put(device)
+        threading.Thread(target=send).start()
+
+    def test_existing_unclaimed_disk_is_used_at_once(self):
+        path, waited = self._wait(FakeContext([
+            vmax_disk('/dev/sdb', '0012A'),
+            vmax_disk('/dev/sdc', '0012B')]))
+        self.assertEqual('/dev/sdb', path)
+        self.assertLess(waited, 0.5)
+
+    def test_existing_multipath_device_is_preferred(self):
+        path, _ = self._wait(FakeContext([
+            vmax_disk('/dev/sdb', '0012A', claimed=True),
+            vmax_dm('/dev/dm-3', '0012A')]))
+        self.assertEqual('/dev/dm-3', path)
+
+    def test_unclaimed_disk_arriving_is_used_at_once(self):
+        self._later(vmax_disk('/dev/sdc', '0012B'),
+                    vmax_disk('/dev/sdb', '0012A'))
+        path, waited = self._wait()
+        self.assertEqual('/dev/sdb', path)
+        self.assertLess(waited, 0.5)
+
+    def test_claimed_disk_waits_for_multipath_device(self):
+        self._later(vmax_disk('/dev/sdb', '0012A', claimed=True),
+                    vmax_dm('/dev/dm-3', '0012A', action='change'))
+        self.assertEqual('/dev/dm-3', self._wait()[0])
+
+    def test_claimed_disk_is_used_when_no_multipath_device_comes(self):
+        self._later(vmax_disk('/dev/sdb', '0012A', claimed=True))
+        path, waited = self._wait()
+        self.assertEqual('/dev/sdb', path)
+        self.assertGreaterEqual(waited, 1)
+
+    def test_wait_for_multipath_even_if_unclaimed(self):
+        self._later(vmax_dm('/dev/dm-3', '0012A'))
+        path, _ = self._wait(FakeContext([vmax_disk('/dev/sdb', '0012A')]),
+                             wait_for_multipath=True)
+        self.assertEqual('/dev/dm-3', path)
+
+    def test_nothing_arrives(self):
+        self.assertEqual(None, self._wait(timeout=0.1)[0])
+
+
+class MinPathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = {'/dev/dm-3': 1}
+        self.saved = dict((name, getattr(fileutil, name)) for name in (
+            'DEVICE_EVENTS', 'login_to_targets', '_wait_for_device',
+            'count_paths'))
+        fileutil.DEVICE_EVENTS = fileutil.DeviceEvents()
+        fileutil.DEVICE_EVENTS._started = True
+        fileutil.login_to_targets = lambda targets: []
+        fileutil.count_paths = lambda path: self.paths.get(path, 1)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(fileutil, name, value)
+
+    def _get(self, found, min_paths, timeout=0.3):
+        fileutil._wait_for_device = lambda *args, **kwargs: found
+        return fileutil.get_vmax_device_path(
+            SYMM_ID, '0012A', ['10.1.1.1', '10.1.1.2'], timeout=timeout,
+            min_paths=min_paths)
+
+    def test_multipath_device_with_enough_paths(self):
+        self.paths['/dev/dm-3'] = 2
+        self.assertEqual('/dev/dm-3', self._get('/dev/dm-3', 2))
+
+    def test_paths_arriving_in_time(self):
+        def arrive():
+            time.sleep(0.1)
+            self.paths['/dev/dm-3'] = 2
+        threading.Thread(target=arrive).start()
+        self.assertEqual('/dev/dm-3', self._get('/dev/dm-3', 2, timeout=2))
+
+    def test_too_few_paths_are_used(self):
+        start = time.time()
+        self.assertEqual('/dev/dm-3', self._get('/dev/dm-3', 2))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+    def test_single_path_when_no_multipath_device_comes(self):
+        self.assertEqual('/dev/sdb', self._get('/dev/sdb', 2))
+
+    def test_single_path_without_min_paths(self):
+        self.assertEqual('/dev/sdb', self._get('/dev/sdb', None))
+
+
+class FindByIdTest(unittest.TestCase):
+
+    WWN = '60000970000197900049533030313241'
+
+    def setUp(self):
+        self.dev_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dev_root, 'disk', 'by-id'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dev_root)
+
+    def _node(self, name):
+        path = os.path.join(self.dev_root, name)
+        open(path, 'w').close()
+        return path
+
+    def _link(self, link, name):
+        os.symlink(os.path.join('..', '..', name),
+                   os.path.join(self.dev_root, 'disk', 'by-id', link))
+
+    def test_multipath_device(self):
+        dm = self._node('dm-3')
+        self._link('dm-uuid-mpath-3' + self.WWN, 'dm-3')
+        # Once there is a multipath device the wwn- link moves to it.
+        self._link('wwn-0x' + self.WWN, 'dm-3')
+        self.assertEqual((dm, None), fileutil._find_device_by_wwn(
+            self.WWN.upper(), dev_root=self.dev_root))
+
+    def test_scsi_disk(self):
+        disk = self._node('sdb')
+        self._link('wwn-0x' + self.WWN, 'sdb')
+        self.assertEqual((None, disk), fileutil._find_device_by_wwn(
+            self.WWN, dev_root=self.dev_root))
+
+    def test_no_links(self):
+        self.assertEqual((None, None), fileutil._find_device_by_wwn(
+            self.WWN, dev_root=self.dev_root))
+
+
+class IscsiSessionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = FakeSysfs()
+        self.logins = []
+        self.lock = threading.Lock()
+        self.saved = fileutil._login_to_target
+        fileutil._login_to_target = self._login
+
+    def tearDown(self):
+        fileutil._login_to_target = self.saved
+        self.sysfs.remove()
+
+    def _login(self, target):
+        time.sleep(0.1)
+        with self.lock:
+            self.logins.append(target)
+
+    def test_logged_in_sessions_by_portal(self):
+        self.sysfs.iscsi_session(1, '10.1.1.1')
+        self.sysfs.iscsi_session(2, '10.1.1.2', state='FAILED')
+        self.sysfs.iscsi_session(3, '10.1.1.3', state=None)
+        self.assertEqual({'10.1.1.1': '1', '10.1.1.3': '3'},
+                         fileutil.iscsi_sessions(self.sysfs.root))
+
+    def test_no_iscsi(self):
+        self.assertEqual({}, fileutil.iscsi_sessions(self.sysfs.root))
+
+    def test_logs_in_to_new_portals_in_parallel(self):
+        self.sysfs.iscsi_session(1, '10.1.1.1')
+        start = time.time()
+        existing = fileutil.login_to_targets(
+            ['10.1.1.1', '10.1.1.2', '10.1.1.3', '10.1.1.4'],
+            sysfs_root=self.sysfs.root)
+        self.assertEqual(['1'], existing)
+        self.assertEqual(['10.1.1.2', '10.1.1.3', '10.1.1.4'],
+                         sorted(self.logins))
+        self.assertLess(time.time() - start, 0.25)
+
+    def test_no_login_when_all_sessions_exist(self):
+        self.sysfs.iscsi_session(1, '10.1.1.1')
+        self.sysfs.iscsi_session(2, '10.1.1.2')
+        self.assertEqual(['1', '2'], fileutil.login_to_targets(
+            ['10.1.1.1', '10.1.1.2'], sysfs_root=self.sysfs.root))
+        self.assertEqual([], self.logins)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from vmaxafdockerplugin import fileutil
+from vmaxafdockerplugin import listener_vmax
+from vmaxafdockerplugin import volume_ops
+
+HOST = '127.0.0.1'
+
+
+class FakeConf(dict):
+    def safe_get(self, name):
+        return self.get(name)
+
+
+class FakeVmax(object):
+    protocol = 'iscsi'
+
+    def __init__(self, attach_delay=0):
+        self.attach_delay = attach_delay
+        self.attached = []
+        self.detached = []
+
+    def attach_volume(self, volume_name, device_id, group_conf):
+        time.sleep(self.attach_delay)
+        self.attached.append(volume_name)
+        return ['10.1.1.1']
+
+    def detach_volume(self, volume_name, device_id, group_conf):
+        self.detached.append(volume_name)
+
+
+class MountTest(unittest.TestCase):
+
+    FILEUTIL = {'get_vmax_device_path': lambda *args, **kwargs: '/dev/sdx',
+                'has_filesystem': lambda device: True,
+                'mkdir_for_mounting': lambda path: None,
+                'mount_dir': lambda device, path: None,
+                'umount_dir': lambda path: None,
+                'remove_dir': lambda path: None,
+                'count_paths': lambda device: 1}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(fileutil, name))
+                          for name in self.FILEUTIL)
+        for name, func in self.FILEUTIL.items():
+            setattr(fileutil, name, func)
+        self.saved_ops = listener_vmax.volume_ops
+        listener_vmax.volume_ops = volume_ops.VolumeMetaData(
+            store=volume_ops.JournalStore(os.path.join(self.dir, 'data')))
+        listener_vmax.volume_ops.set_volume('vol1', {
+            'name': 'vol1', 'volume_id': '00001', 'backend-name': 'b1',
+            'mounted': {}})
+        self.vmax = FakeVmax(attach_delay=0.2)
+        listener_vmax.backend_dict['b1'] = self.vmax
+        listener_vmax.backend_confs['b1'] = FakeConf(array='000197900049')
+        self.client = listener_vmax.listener.test_client()
+
+    def tearDown(self):
+        for name, func in self.saved.items():
+            setattr(fileutil, name, func)
+        listener_vmax.volume_ops = self.saved_ops
+        listener_vmax.backend_dict.pop('b1')
+        listener_vmax.backend_confs.pop('b1')
+        shutil.rmtree(self.dir)
+
+    def _post(self, operation, request_id):
+        response = self.client.post(
+            '/VolumeDriver.' + operation,
+            data=json.dumps({'Name': 'vol1', 'ID': request_id}))
+        return json.loads(response.data)
+
+    def test_unmount_after_coalesced_mounts_keeps_volume_attached(self):
+        responses = []
+        mounts = [threading.Thread(
+            target=lambda i=i: responses.append(self._post('Mount', i)))
+            for i in range(3)]
+        for thread in mounts:
+            thread.start()
+            # Let the first become the attaching mount.
+            time.sleep(0.05)
+        # Queued behind the attach, like an Unmount arriving right after
+        # the mounts.
+        unmount = threading.Thread(target=self._post, args=('Unmount', 9))
+        unmount.start()
+        for thread in mounts + [unmount]:
+            thread.join()
+        self.assertEqual(['vol1'], self.vmax.attached)
+        self.assertEqual(3, len([r for r in responses if not r['Err']]))
+        self.assertEqual([], self.vmax.detached)
+        volume = listener_vmax.volume_ops.get_volume('vol1')
+        self.assertEqual(2, volume['mounted'][HOST]['count'])
+
+    def test_volume_not_found_is_detached(self):
+        fileutil.get_vmax_device_path = lambda *args, **kwargs: None
+        self.assertTrue(self._post('Mount', 1)['Err'])
+        self.assertEqual(['vol1'], self.vmax.detached)
+        volume = listener_vmax.volume_ops.get_volume('vol1')
+        self.assertEqual({}, volume['mounted'])
+
+    def test_get_counts_the_paths_now(self):
+        paths = {'/dev/sdx': 2}
+        fileutil.count_paths = lambda device: paths[device]
+        self.vmax.attach_delay = 0
+        self.assertEqual('', self._post('Mount', 1)['Err'])
+        self.assertEqual(2, self._post('Get', 2)['Volume']['Status']['Paths'])
+        # A portal went down.
+        paths['/dev/sdx'] = 1
+        self.assertEqual(1, self._post('Get', 3)['Volume']['Status']['Paths'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import threading
+import time
+import unittest
+
+from vmaxafdockerplugin import locks
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.start()
+    return thread
+
+
+class KeyedLockTest(unittest.TestCase):
+
+    def test_same_key_is_serialized_other_keys_are_not(self):
+        keyed = locks.KeyedLock()
+        order = []
+
+        def hold(key, name):
+            with keyed.lock(key):
+                order.append(name + ' in')
+                time.sleep(0.05)
+                order.append(name + ' out')
+
+        with keyed.lock('vol1'):
+            threads = [_start(hold, 'vol1', 'a'), _start(hold, 'vol2', 'b')]
+            time.sleep(0.1)
+            order.append('released')
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['b in', 'b out', 'released', 'a in', 'a out'],
+                         order)
+        self.assertEqual(0, len(keyed))
+
+    def test_lock_all_in_any_order_does_not_deadlock(self):
+        keyed = locks.KeyedLock()
+        held = []
+
+        def hold(keys):
+            for _ in range(50):
+                with keyed.lock_all(keys):
+                    held.append(keys)
+
+        threads = [_start(hold, ['mv1', 'mv2', 'mv3']),
+                   _start(hold, ['mv3', 'mv1']),
+                   _start(hold, ['mv2', 'mv3', 'mv2'])]
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(150, len(held))
+        self.assertEqual(0, len(keyed))
+
+    def test_lock_all_holds_every_key(self):
+        keyed = locks.KeyedLock()
+        with keyed.lock_all(['mv2', 'mv1']):
+            self.assertEqual(2, len(keyed))
+        with keyed.lock_all([]):
+            self.assertEqual(0, len(keyed))
+
+
+class InFlightTest(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_call(self):
+        in_flight = locks.InFlight()
+        started = threading.Event()
+        calls = []
+        results = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return 'done'
+
+        leader = _start(lambda: results.append(in_flight.run('k', slow)))
+        started.wait()
+        followers = [_start(lambda: results.append(in_flight.run('k', slow)))
+                     for _ in range(3)]
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([('done', False)] + [('done', True)] * 3,
+                         sorted(results, key=lambda r: r[1]))
+
+    def test_close_counts_joiners_and_stops_more_joining(self):
+        in_flight = locks.InFlight()
+        joined = threading.Event()
+        counts = []
+
+        def leader():
+            joined.wait()
+            time.sleep(0.05)
+            counts.append(in_flight.close('k'))
+            # Called again, now that the leader has closed.
+            counts.append(in_flight.run('k', lambda: 'again'))
+            return 'first'
+
+        thread = _start(in_flight.run, 'k', leader)
+        time.sleep(0.02)
+        follower = _start(in_flight.run, 'k', lambda: 'not run')
+        joined.set()
+        thread.join()
+        follower.join()
+        self.assertEqual([1, ('again', False)], counts)
+        self.assertEqual(0, in_flight.close('k'))
+
+    def test_error_reaches_joiners(self):
+        in_flight = locks.InFlight()
+        errors = []
+
+        def fail():
+            time.sleep(0.05)
+            raise IOError('no path')
+
+        def run():
+            try:
+                in_flight.run('k', fail)
+            except IOError as e:
+                errors.append(e)
+
+        threads = [_start(run) for _ in range(3)]
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(errors))
+
+
+class KeyedSemaphoreTest(unittest.TestCase):
+
+    def test_limit_per_key(self):
+        semaphore = locks.KeyedSemaphore({'b1': 2}, default_limit=1)
+        active = {'b1': 0, 'b2': 0}
+        peaks = {'b1': 0, 'b2': 0}
+        lock = threading.Lock()
+
+        def hold(key):
+            with semaphore.hold(key):
+                with lock:
+                    active[key] += 1
+                    peaks[key] = max(peaks[key], active[key])
+                time.sleep(0.02)
+                with lock:
+                    active[key] -= 1
+
+        threads = [_start(hold, key) for key in ['b1', 'b2'] * 4]
+        for thread in threads:
+            thread.join()
+        self.assertEqual({'b1': 2, 'b2': 1}, peaks)
+        self.assertEqual({'limit': 2, 'active': 0, 'waiting': 0},
+                         semaphore.stats()['b1'])
+
+    def test_waiters_are_let_in_order(self):
+        semaphore = locks.KeyedSemaphore({}, default_limit=1)
+        order = []
+
+        def hold(i):
+            with semaphore.hold('b1'):
+                order.append(i)
+
+        with semaphore.hold('b1'):
+            threads = []
+            for i in range(5):
+                threads.append(_start(hold, i))
+                # Queue them one after another.
+                time.sleep(0.01)
+            self.assertEqual(5, semaphore.stats()['b1']['waiting'])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(range(5)), order)
+
+
+if __name__ == '__main__':
+    unittest.main()
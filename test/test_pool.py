@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+
+from PyU4V.utils import exception as pyU4V_exception
+
+from vmaxafdockerplugin import locks
+from vmaxafdockerplugin import pool
+
+
+class StubProvisioning(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get_storage_group(self, name):
+        if self.conn.error is not None:
+            raise self.conn.error
+        return {'storageGroupId': name, 'conn': self.conn.number}
+
+
+class StubConnection(object):
+    made = 0
+
+    def __init__(self):
+        StubConnection.made += 1
+        self.number = StubConnection.made
+        self.error = None
+        self.closed = False
+        self.provisioning = StubProvisioning(self)
+
+    def close_session(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def _pool(self, **kwargs):
+        made = []
+
+        def factory():
+            made.append(StubConnection())
+            return made[-1]
+
+        return pool.ConnectionPool(factory, health_check=lambda conn: None,
+                                   **kwargs), made
+
+    def test_connections_are_reused(self):
+        conn_pool, made = self._pool(size=2)
+        pooled = pool.PooledConnection(conn_pool)
+        for _ in range(3):
+            pooled.get_storage_group('sg1')
+        self.assertEqual(1, len(made))
+        self.assertEqual(1, conn_pool.stats()['idle'])
+
+    def test_callers_wait_when_pool_is_full(self):
+        conn_pool, made = self._pool(size=1)
+        conn = conn_pool.acquire()
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(conn_pool.acquire()))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual([], acquired)
+        self.assertEqual(1, conn_pool.stats()['waiting'])
+        conn_pool.release(conn)
+        thread.join()
+        self.assertEqual([conn], acquired)
+
+    def test_idle_connections_are_evicted(self):
+        conn_pool, made = self._pool(size=2, idle_timeout=0.02)
+        conn_pool.release(conn_pool.acquire())
+        time.sleep(0.03)
+        conn_pool.evict_idle()
+        self.assertTrue(made[0].closed)
+        self.assertEqual(0, conn_pool.stats()['open'])
+
+    def test_failed_health_check_replaces_connection(self):
+        made = []
+
+        def factory():
+            made.append(StubConnection())
+            return made[-1]
+
+        def check(conn):
+            if conn is made[0]:
+                raise pyU4V_exception.VolumeBackendAPIException(data='down')
+
+        conn_pool = pool.ConnectionPool(factory, check_interval=0,
+                                        health_check=check)
+        conn_pool.release(conn_pool.acquire())
+        time.sleep(0.01)
+        conn = conn_pool.acquire()
+        self.assertIs(made[1], conn)
+        self.assertTrue(made[0].closed)
+        self.assertEqual(1, conn_pool.stats()['failed_checks'])
+
+
+class PooledConnectionTest(unittest.TestCase):
+
+    def _call_failing(self, error):
+        conn_pool = pool.ConnectionPool(StubConnection,
+                                        health_check=lambda conn: None)
+        conn = conn_pool.acquire()
+        conn.error = error
+        conn_pool.release(conn)
+        self.assertRaises(type(error),
+                          pool.PooledConnection(conn_pool).get_storage_group,
+                          'sg1')
+        return conn, conn_pool
+
+    def test_connection_without_response_is_discarded(self):
+        # What PyU4V raises when requests times out or cannot connect.
+        conn, conn_pool = self._call_failing(
+            pyU4V_exception.VolumeBackendAPIException(
+                data='Error get storagegroup. The status code received is '
+                     'None and the message is None.'))
+        self.assertTrue(conn.closed)
+        self.assertEqual(0, conn_pool.stats()['open'])
+
+    def test_connection_refused_a_call_is_kept(self):
+        conn, conn_pool = self._call_failing(
+            pyU4V_exception.ResourceNotFoundException(data='sg1'))
+        self.assertFalse(conn.closed)
+        self.assertEqual(1, conn_pool.stats()['idle'])
+
+
+class AdmittedConnectionTest(unittest.TestCase):
+
+    def test_reads_and_changes_take_their_own_lanes(self):
+        admission = locks.KeyedSemaphore({pool.READ: 2, pool.MUTATE: 1})
+        held = []
+
+        class Conn(object):
+            def get_storage_group(self):
+                held.append(admission.stats())
+
+            def create_storage_group(self):
+                held.append(admission.stats())
+
+        conn = pool.AdmittedConnection(Conn(), admission)
+        conn.get_storage_group()
+        conn.create_storage_group()
+        self.assertEqual(1, held[0][pool.READ]['active'])
+        self.assertEqual(0, held[0][pool.MUTATE]['active'])
+        self.assertEqual(1, held[1][pool.MUTATE]['active'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import time
+import unittest
+
+import requests
+from PyU4V.utils import exception as pyU4V_exception
+
+from vmaxafdockerplugin import exception
+from vmaxafdockerplugin import metrics
+from vmaxafdockerplugin import retry
+
+
+def _status_error(status_code):
+    return pyU4V_exception.VolumeBackendAPIException(
+        data='Error get storagegroup. The status code received is %s and '
+             'the message is None.' % status_code)
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_no_response(self):
+        for error in (_status_error(None),
+                      pyU4V_exception.VolumeBackendAPIException(
+                          data='The GET request to URL: https://u4v failed '
+                               'with exception bad handshake'),
+                      requests.exceptions.ConnectionError(),
+                      requests.exceptions.Timeout()):
+            self.assertTrue(retry.no_response(error), error)
+            self.assertTrue(retry.unhealthy(error), error)
+
+    def test_server_error_is_unhealthy_with_a_response(self):
+        for status_code in (500, 503):
+            self.assertFalse(retry.no_response(_status_error(status_code)))
+            self.assertTrue(retry.unhealthy(_status_error(status_code)))
+
+    def test_refusals_are_healthy(self):
+        for error in (_status_error(400), _status_error(409),
+                      pyU4V_exception.ResourceNotFoundException(
+                          data=_status_error(404).kwargs['data']),
+                      pyU4V_exception.UnauthorizedRequestException(),
+                      pyU4V_exception.VolumeBackendAPIException(
+                          data='Error create. Status code: -1.'),
+                      ValueError('bad argument')):
+            self.assertFalse(retry.no_response(error), error)
+            self.assertFalse(retry.unhealthy(error), error)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_threshold_failures_in_a_row(self):
+        breaker = retry.CircuitBreaker(threshold=3, reset_timeout=60)
+        for healthy in (False, False, True, False, False):
+            breaker.record(healthy)
+        self.assertEqual(breaker.CLOSED, breaker.state)
+        breaker.record(False)
+        self.assertEqual(breaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        self.assertEqual({'state': 'open', 'failures': 3, 'trips': 1,
+                          'rejected': 1}, breaker.stats())
+
+    def test_half_open_probe(self):
+        breaker = retry.CircuitBreaker(threshold=1, reset_timeout=0.05)
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.HALF_OPEN, breaker.state)
+        # The probe fails: open again at once.
+        breaker.record(False)
+        self.assertEqual(breaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.CLOSED, breaker.state)
+        self.assertEqual(2, breaker.trips)
+
+
+class FakeConn(object):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+    def get_storage_group(self):
+        return self._call()
+
+    def create_storage_group(self):
+        return self._call()
+
+
+class ResilientConnectionTest(unittest.TestCase):
+
+    def _conn(self, errors, threshold=5):
+        fake = FakeConn(errors)
+        breaker = retry.CircuitBreaker(threshold=threshold, reset_timeout=60)
+        conn = retry.ResilientConnection(
+            fake, retry.RetryPolicy(retries=2, delay=0), breaker,
+            metrics.CallStats(), name='u4v')
+        return conn, fake, breaker
+
+    def test_reads_are_retried_when_unhealthy(self):
+        conn, fake, breaker = self._conn(
+            [_status_error(None), _status_error(503)])
+        self.assertEqual('ok', conn.get_storage_group())
+        self.assertEqual(3, fake.calls)
+        self.assertEqual(0, breaker.failures)
+
+    def test_refusals_are_not_retried_or_counted(self):
+        conn, fake, breaker = self._conn([_status_error(400)] * 6,
+                                         threshold=1)
+        for _ in range(6):
+            self.assertRaises(pyU4V_exception.VolumeBackendAPIException,
+                              conn.get_storage_group)
+        self.assertEqual(6, fake.calls)
+        self.assertEqual(breaker.CLOSED, breaker.state)
+
+    def test_changes_are_not_retried(self):
+        conn, fake, breaker = self._conn([_status_error(None)])
+        self.assertRaises(pyU4V_exception.VolumeBackendAPIException,
+                          conn.create_storage_group)
+        self.assertEqual(1, fake.calls)
+        self.assertEqual(1, breaker.failures)
+
+    def test_open_breaker_fails_calls_at_once(self):
+        conn, fake, breaker = self._conn([_status_error(500)] * 3,
+                                         threshold=1)
+        self.assertRaises(pyU4V_exception.VolumeBackendAPIException,
+                          conn.get_storage_group)
+        self.assertEqual(1, fake.calls)
+        self.assertRaises(exception.BackendUnavailable,
+                          conn.create_storage_group)
+        self.assertEqual(1, fake.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
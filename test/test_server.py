@@ -0,0 +1,67 @@
+import io
+import json
+import threading
+import time
+import unittest
+
+from vmaxafdockerplugin import server
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.finished = threading.Event()
+        self.started = []
+
+    def _app(self, environ, start_response):
+        body = environ['wsgi.input'].read()
+        if environ['PATH_INFO'] == '/VolumeDriver.Mount':
+            self.release.wait(5)
+        self.finished.set()
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [body]
+
+    def _start_response(self, status, headers, exc_info=None):
+        self.started.append((status, headers))
+
+    def _call(self, deadline, path):
+        environ = {'PATH_INFO': path,
+                   'wsgi.input': io.BytesIO(b'{"Name": "vol1"}')}
+        return b''.join(deadline(environ, self._start_response))
+
+    def test_request_within_its_deadline(self):
+        deadline = server.Deadline(self._app, 1)
+        self.assertEqual(b'{"Name": "vol1"}',
+                         self._call(deadline, '/VolumeDriver.Path'))
+        self.assertEqual([('200 OK', [('Content-Type', 'text/html')])],
+                         self.started)
+        self.assertEqual(0, deadline.overdue)
+
+    def test_overdue_request_is_answered_and_runs_on(self):
+        deadline = server.Deadline(self._app, 0.1)
+        start = time.time()
+        body = self._call(deadline, '/VolumeDriver.Mount')
+        self.assertLess(time.time() - start, 1)
+        self.assertIn('0.1 seconds', json.loads(body)['Err'])
+        self.assertEqual(1, deadline.overdue)
+        self.assertFalse(self.finished.is_set())
+        self.release.set()
+        self.assertTrue(self.finished.wait(5))
+        # The count drops once the handler has returned.
+        for _ in range(50):
+            if not deadline.overdue:
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, deadline.overdue)
+
+    def test_errors_reach_the_server(self):
+        def app(environ, start_response):
+            raise ValueError('broken')
+        deadline = server.Deadline(app, 1)
+        self.assertRaises(ValueError, self._call, deadline,
+                          '/VolumeDriver.Path')
+
+
+if __name__ == '__main__':
+    unittest.main()
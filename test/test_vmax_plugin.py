@@ -0,0 +1,450 @@
+import threading
+import time
+import unittest
+
+from PyU4V.utils import exception as pyU4V_exception
+
+from vmaxafdockerplugin import vmax_plugin
+
+ARRAY = '000197900049'
+HOST = 'host1'
+INITIATOR = 'iqn.1994-05.com.redhat:host1'
+PORT_GROUP = 'PG1'
+PORT = 'SE-1E:0'
+PORTAL = '10.1.1.1'
+
+
+def _conflict(what):
+    return pyU4V_exception.VolumeBackendAPIException(
+        data='The status code received is 400 and the message is %s.' % what)
+
+
+class FakeArray(object):
+    """
+    Just enough of the PyU4V provisioning calls for attach and detach. Like
+    the array it refuses to create what exists or delete what is in use,
+    and every call takes a little while so that races show.
+    """
+
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.sgs = {}
+        self.mvs = {}
+        self.igs = {}
+        self.created = []
+        # How long volume creates and moves take, once they have begun.
+        self.slow_delay = 0
+        self.slow_call = threading.Event()
+
+    def _wait(self):
+        time.sleep(self.delay)
+
+    def _slow_wait(self):
+        self.slow_call.set()
+        time.sleep(self.delay + self.slow_delay)
+
+    def get_slo_list(self):
+        return ['Diamond']
+
+    def get_workload_settings(self):
+        return ['OLTP']
+
+    def _sg(self, name):
+        if name not in self.sgs:
+            raise _conflict('storage group %s does not exist' % name)
+        return self.sgs[name]
+
+    def add_volume(self, device_id, sg_name, srp='SRP_1'):
+        with self.lock:
+            self.sgs.setdefault(sg_name, {'vols': set(), 'parent': None,
+                                          'srp': srp})
+            self.sgs[sg_name]['vols'].add(device_id)
+
+    def get_volume(self, device_id):
+        self._wait()
+        with self.lock:
+            return {'volumeId': device_id,
+                    'storageGroupId': sorted(
+                        name for name, sg in self.sgs.items()
+                        if device_id in sg['vols'])}
+
+    def get_storage_group(self, name):
+        self._wait()
+        with self.lock:
+            if name not in self.sgs:
+                raise pyU4V_exception.ResourceNotFoundException(data=name)
+            sg = self.sgs[name]
+            result = {'storageGroupId': name}
+            if sg['parent']:
+                result['parent_storage_group'] = [sg['parent']]
+            return result
+
+    def create_storage_group(self, srp, name, slo, workload):
+        self._wait()
+        with self.lock:
+            if name in self.sgs:
+                raise _conflict('storage group %s already exists' % name)
+            self.sgs[name] = {'vols': set(), 'parent': None, 'srp': srp}
+            self.created.append(name)
+            return {'storageGroupId': name}
+
+    def _delete_sg(self, name):
+        self._wait()
+        with self.lock:
+            if any(mv['sg'] == name for mv in self.mvs.values()):
+                raise _conflict('storage group %s is in use' % name)
+            self._sg(name)
+            for sg in self.sgs.values():
+                if sg['parent'] == name:
+                    sg['parent'] = None
+            del self.sgs[name]
+
+    delete_storagegroup = _delete_sg
+    delete_storage_group = _delete_sg
+
+    def _vols(self, name):
+        vols = set(self._sg(name)['vols'])
+        for sg in self.sgs.values():
+            if sg['parent'] == name:
+                vols |= sg['vols']
+        return vols
+
+    def get_num_vols_in_sg(self, name):
+        self._wait()
+        with self.lock:
+            return len(self._vols(name)) if name in self.sgs else 0
+
+    def create_volume_from_sg_return_dev_id(self, volume_name, sg_name,
+                                            size):
+        self._slow_wait()
+        with self.lock:
+            device_id = '%05X' % (1 + max(
+                [int(vol, 16) for sg in self.sgs.values()
+                 for vol in sg['vols']] or [0]))
+            self._sg(sg_name)['vols'].add(device_id)
+            return device_id
+
+    def is_volume_in_storagegroup(self, device_id, name):
+        self._wait()
+        with self.lock:
+            return name in self.sgs and device_id in self.sgs[name]['vols']
+
+    def move_volumes_between_storage_groups(self, device_id, src, dst,
+                                            force=False):
+        self._slow_wait()
+        with self.lock:
+            self._sg(dst)
+            self._sg(src)['vols'].discard(device_id)
+            self.sgs[dst]['vols'].add(device_id)
+
+    move_volume_between_storage_groups = move_volumes_between_storage_groups
+
+    def add_existing_vol_to_sg(self, name, device_id, **kwargs):
+        self._wait()
+        with self.lock:
+            self._sg(name)['vols'].add(device_id)
+
+    def remove_vol_from_storagegroup(self, name, device_id):
+        self._wait()
+        with self.lock:
+            self._sg(name)['vols'].discard(device_id)
+
+    def is_child_sg_in_parent_sg(self, child, parent):
+        self._wait()
+        with self.lock:
+            return (child in self.sgs and
+                    self.sgs[child]['parent'] == parent)
+
+    def add_child_sg_to_parent_sg(self, child, parent):
+        self._wait()
+        with self.lock:
+            self._sg(parent)
+            self._sg(child)['parent'] = parent
+
+    def remove_child_sg_from_parent_sg(self, child, parent):
+        self._wait()
+        with self.lock:
+            self._sg(child)['parent'] = None
+
+    def get_portgroup(self, name):
+        return {'portGroupId': name} if name == PORT_GROUP else None
+
+    def get_ports_from_pg(self, name):
+        return [PORT]
+
+    def get_iscsi_ip_address_and_iqn(self, port):
+        return [PORTAL], 'iqn.1992-04.com.emc:target'
+
+    def get_in_use_initiator_list_from_array(self):
+        self._wait()
+        with self.lock:
+            return ['SE-1E:0:' + init for inits in self.igs.values()
+                    for init in inits]
+
+    def get_initiator_group_from_initiator(self, initiator):
+        self._wait()
+        with self.lock:
+            if initiator in self.igs:
+                return initiator
+            for name, inits in self.igs.items():
+                if initiator.split(':', 2)[-1] in inits:
+                    return name
+            return None
+
+    def create_host(self, name, initiator_list=None, **kwargs):
+        self._wait()
+        with self.lock:
+            if name in self.igs:
+                raise _conflict('host %s already exists' % name)
+            if set(initiator_list) & set(
+                    init for inits in self.igs.values() for init in inits):
+                raise _conflict('initiator is in another host')
+            self.igs[name] = list(initiator_list)
+            self.created.append(name)
+
+    def delete_host(self, name):
+        self._wait()
+        with self.lock:
+            if any(mv['ig'] == name for mv in self.mvs.values()):
+                raise _conflict('host %s is in use' % name)
+            del self.igs[name]
+
+    def get_masking_view(self, name):
+        self._wait()
+        with self.lock:
+            if name not in self.mvs:
+                raise pyU4V_exception.ResourceNotFoundException(data=name)
+            return dict(self.mvs[name])
+
+    def create_masking_view_existing_components(
+            self, port_group, name, sg_name, host_name=None):
+        self._wait()
+        with self.lock:
+            if name in self.mvs:
+                raise _conflict('masking view %s already exists' % name)
+            self._sg(sg_name)
+            if host_name not in self.igs:
+                raise _conflict('host %s does not exist' % host_name)
+            self.mvs[name] = {'sg': sg_name, 'pg': port_group,
+                              'ig': host_name}
+            self.created.append(name)
+
+    def delete_masking_view(self, name):
+        self._wait()
+        with self.lock:
+            del self.mvs[name]
+
+    def get_element_from_masking_view(self, name, portgroup=False,
+                                      host=False, storagegroup=False):
+        self._wait()
+        with self.lock:
+            mv = self.mvs[name]
+            if portgroup:
+                return mv['pg']
+            if host:
+                return mv['ig']
+            return mv['sg']
+
+    def get_masking_views_from_storage_group(self, name):
+        self._wait()
+        with self.lock:
+            parent = self.sgs.get(name, {}).get('parent')
+            return [mv_name for mv_name, mv in self.mvs.items()
+                    if mv['sg'] in (name, parent)]
+
+    def get_masking_views_by_host(self, name):
+        self._wait()
+        with self.lock:
+            return [mv_name for mv_name, mv in self.mvs.items()
+                    if mv['ig'] == name]
+
+
+class FakeIdentity(object):
+    @staticmethod
+    def host_name():
+        return HOST
+
+    @staticmethod
+    def initiator():
+        return INITIATOR
+
+    @staticmethod
+    def wwpns():
+        return []
+
+
+class FakeConf(dict):
+    def safe_get(self, name):
+        return self.get(name)
+
+
+GROUP_CONF = FakeConf(srp='SRP_1', service_level='Diamond', workload='OLTP',
+                      port_groups=[PORT_GROUP], array=ARRAY)
+
+
+class MaskingConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.array = FakeArray()
+        self.default_sg = vmax_plugin.VmaxAf.get_default_storage_group_name(
+            'SRP_1', 'Diamond', 'OLTP')
+        self.array.add_volume('00001', self.default_sg)
+        self.array.add_volume('00002', self.default_sg)
+
+    def tearDown(self):
+        # The caches of the array outlive the instances.
+        vmax = self._vmax()
+        for ttl_cache in (vmax.catalog, vmax.objects, vmax.initiators):
+            ttl_cache.invalidate()
+
+    def _vmax(self):
+        # Separate instances, as two backends on the same array are.
+        vmax = vmax_plugin.VmaxAf(u4v_ip='10.0.0.9', array=ARRAY,
+                                  protocol='iscsi',
+                                  host_identity=FakeIdentity())
+        vmax._conn = self.array
+        return vmax
+
+    def _run(self, *calls):
+        errors = []
+        results = [None] * len(calls)
+
+        def run(i, func, args):
+            try:
+                results[i] = func(*args)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i, func, args))
+                   for i, (func, args) in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        return results
+
+    def test_first_attaches_on_a_host_create_the_masking_view_once(self):
+        results = self._run(
+            (self._vmax().attach_volume, ('vol1', '00001', GROUP_CONF)),
+            (self._vmax().attach_volume, ('vol2', '00002', GROUP_CONF)))
+        self.assertEqual([[PORTAL], [PORTAL]], results)
+        self.assertEqual(1, len(self.array.mvs))
+        self.assertEqual(1, len(self.array.igs))
+        self.assertEqual(len(set(self.array.created)),
+                         len(self.array.created))
+        mv = list(self.array.mvs.values())[0]
+        self.assertEqual(set(['00001', '00002']),
+                         self.array._vols(self.array.sgs[mv['sg']]['parent']))
+
+    def test_last_detach_does_not_tear_down_a_concurrent_attach(self):
+        self._vmax().attach_volume('vol1', '00001', GROUP_CONF)
+        self._run(
+            (self._vmax().detach_volume, ('vol1', '00001', GROUP_CONF)),
+            (self._vmax().attach_volume, ('vol2', '00002', GROUP_CONF)))
+        # Whichever went first, vol2 ends up masked to the host.
+        self.assertEqual(1, len(self.array.mvs))
+        mv = list(self.array.mvs.values())[0]
+        self.assertIn(mv['ig'], self.array.igs)
+        self.assertEqual(set(['00002']),
+                         self.array._vols(self.array.sgs[mv['sg']]['parent']))
+
+
+class DefaultGroupCleanupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.array = FakeArray()
+        self.default_sg = vmax_plugin.VmaxAf.get_default_storage_group_name(
+            'SRP_1', 'Diamond', 'OLTP')
+        # Emptied by the last attach, with its cleanup about to run.
+        self.array.add_volume('00001', self.default_sg)
+        self.array.sgs[self.default_sg]['vols'].clear()
+        self.array.slow_delay = 0.2
+
+    def tearDown(self):
+        vmax = self._vmax()
+        for ttl_cache in (vmax.catalog, vmax.objects, vmax.initiators):
+            ttl_cache.invalidate()
+
+    def _vmax(self):
+        vmax = vmax_plugin.VmaxAf(u4v_ip='10.0.0.9', array=ARRAY,
+                                  protocol='iscsi',
+                                  host_identity=FakeIdentity())
+        vmax._conn = self.array
+        return vmax
+
+    def _cleanup_during(self, func, *args):
+        errors = []
+
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        # The call has the group and is adding its volume to it.
+        self.assertTrue(self.array.slow_call.wait(5))
+        self._vmax()._cleanup_default_sg(self.default_sg)
+        thread.join()
+        self.assertEqual([], errors)
+        self.assertIn(self.default_sg, self.array.sgs)
+        return self.array.sgs[self.default_sg]['vols']
+
+    def test_create_keeps_the_group(self):
+        volumes = self._cleanup_during(
+            self._vmax().create_volume, 'vol2',
+            {'srp': 'SRP_1', 'service_level': 'Diamond', 'workload': 'OLTP',
+             'size': 1})
+        self.assertEqual(1, len(volumes))
+
+    def test_return_from_detach_keeps_the_group(self):
+        self.array.add_volume('00002', 'vol2-SG')
+        volumes = self._cleanup_during(
+            self._vmax().add_volume_to_default_storage_group, '00002',
+            'vol2', GROUP_CONF, 'vol2-SG')
+        self.assertEqual(set(['00002']), volumes)
+
+
+class FakePorts(object):
+    WWNS = {('FA-1D', '4'): '50000973b00c6c04',
+            ('FA-2D', '4'): '50000973b00c6c44'}
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def get_ports_from_pg(self, port_group):
+        if self.error is not None:
+            raise self.error
+        return ['FA-1D:4', 'FA-2D:4']
+
+    def get_port_identifier(self, director, port_no):
+        return self.WWNS[(director, port_no)]
+
+
+class TargetWwnsTest(unittest.TestCase):
+
+    def _vmax(self, conn):
+        vmax = vmax_plugin.VmaxAf(u4v_ip='10.0.0.9', protocol='fc',
+                                  host_identity=FakeIdentity())
+        vmax._conn = conn
+        return vmax
+
+    def test_wwns_of_the_port_groups_ports(self):
+        self.assertEqual(['50000973b00c6c04', '50000973b00c6c44'],
+                         self._vmax(FakePorts()).find_target_wwns('PG1'))
+
+    def test_array_errors_give_no_wwns(self):
+        vmax = self._vmax(FakePorts(
+            pyU4V_exception.VolumeBackendAPIException(data='down')))
+        self.assertEqual([], vmax.find_target_wwns('PG1'))
+
+    def test_other_errors_are_raised(self):
+        vmax = self._vmax(FakePorts(KeyError('symmetrixPortKey')))
+        self.assertRaises(KeyError, vmax.find_target_wwns, 'PG1')
+
+
+if __name__ == '__main__':
+    unittest.main()
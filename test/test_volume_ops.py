@@ -0,0 +1,260 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from vmaxafdockerplugin import volume_ops
+
+
+def _volume(name, backend='backend1', volume_id='00001', wwn=None,
+            hosts=()):
+    return {'name': name,
+            'volume_id': volume_id,
+            'wwn': wwn or '6000097000019790004953303030' + volume_id,
+            'backend-name': backend,
+            'mounted': dict((host, {'mount_point': '/mnt/' + name,
+                                    'count': 1}) for host in hosts)}
+
+
+class JournalStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data_file = os.path.join(self.dir, 'volumes_data.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _store(self, compact_threshold=1000):
+        store = volume_ops.JournalStore(self.data_file, compact_threshold)
+        return store, store.load()
+
+    def _journal(self):
+        with open(self.data_file + '.journal') as f:
+            return [json.loads(line) for line in f]
+
+    def test_changes_are_journaled_not_rewritten(self):
+        store, _ = self._store()
+        store.put('vol1', _volume('vol1'))
+        store.put('vol2', _volume('vol2', volume_id='00002'))
+        store.delete('vol1')
+        self.assertFalse(os.path.exists(self.data_file))
+        self.assertEqual(['set', 'set', 'remove'],
+                         [record['op'] for record in self._journal()])
+        self.assertEqual(['vol2'], list(self._store()[1]))
+
+    def test_compacts_at_threshold(self):
+        store, _ = self._store(compact_threshold=3)
+        for i in range(4):
+            store.put('vol%d' % i, _volume('vol%d' % i))
+        with open(self.data_file) as f:
+            self.assertEqual(['vol0', 'vol1', 'vol2'], sorted(json.load(f)))
+        self.assertEqual(['vol3'], [r['key'] for r in self._journal()])
+        self.assertEqual(['vol0', 'vol1', 'vol2', 'vol3'],
+                         sorted(self._store()[1]))
+
+    def test_torn_last_record_is_dropped(self):
+        store, _ = self._store()
+        store.put('vol1', _volume('vol1'))
+        with open(self.data_file + '.journal', 'a') as f:
+            f.write('{"op": "set", "key": "vol2", "vol')
+        store, volumes = self._store()
+        self.assertEqual(['vol1'], list(volumes))
+        # Folded away, so the next append starts on a fresh line.
+        self.assertEqual([], self._journal())
+        store.put('vol3', _volume('vol3'))
+        self.assertEqual(['vol1', 'vol3'], sorted(self._store()[1]))
+
+    def test_outside_edit_replaces_journal(self):
+        store, _ = self._store()
+        store.save({'vol1': _volume('vol1')})
+        store.put('vol1', _volume('vol1', hosts=['10.0.0.1']))
+        metadata = volume_ops.VolumeMetaData(store=store)
+        self.assertIn('10.0.0.1', metadata.get_volume('vol1')['mounted'])
+        # An operator rewrites the data file with the volume unmounted.
+        with open(self.data_file + '.edit', 'w') as f:
+            json.dump({'vol1': _volume('vol1'),
+                       'vol2': _volume('vol2', volume_id='00002')}, f)
+        os.rename(self.data_file + '.edit', self.data_file)
+        self.assertEqual(['vol1', 'vol2'],
+                         sorted(metadata.get_volume_list()))
+        self.assertEqual({}, metadata.get_volume('vol1')['mounted'])
+        self.assertEqual([], self._journal())
+        self.assertEqual({}, self._store()[1]['vol1']['mounted'])
+
+
+class VolumeListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_list_is_served_from_memory(self):
+        store = volume_ops.JournalStore(os.path.join(self.dir, 'data.json'))
+        metadata = volume_ops.VolumeMetaData(store=store)
+        metadata.set_volume('vol1', _volume('vol1'))
+        loads = []
+        store.load = lambda: loads.append(1)
+        for _ in range(3):
+            self.assertEqual(['vol1'], metadata.get_volume_list())
+        self.assertEqual([], loads)
+
+
+class SqliteStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.dir, 'volumes_data.json')
+        self.db_file = os.path.join(self.dir, 'volumes_data.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _store(self):
+        return volume_ops.SqliteStore(self.db_file, json_file=self.json_file)
+
+    def test_volume_store_is_abstract(self):
+        self.assertRaises(TypeError, volume_ops.VolumeStore)
+
+    def test_put_delete_load(self):
+        store = self._store()
+        store.put('vol1', _volume('vol1'))
+        store.put('vol2', _volume('vol2', volume_id='00002'))
+        store.delete('vol1')
+        self.assertEqual(['vol2'], list(self._store().load()))
+
+    def test_find_by_indexed_fields(self):
+        store = self._store()
+        store.apply([
+            ('put', 'vol1', _volume('vol1', hosts=['10.0.0.1'])),
+            ('put', 'vol2', _volume('vol2', backend='backend2',
+                                    volume_id='00002',
+                                    hosts=['10.0.0.1', '10.0.0.2'])),
+            ('put', 'vol3', _volume('vol3', volume_id='00003'))])
+        self.assertEqual(['vol1', 'vol3'],
+                         sorted(store.find(backend_name='backend1')))
+        self.assertEqual(['vol1', 'vol2'], sorted(store.find(host='10.0.0.1')))
+        self.assertEqual(['vol2'], store.find(host='10.0.0.2'))
+        self.assertEqual(['vol3'], store.find(volume_id='00003'))
+        self.assertEqual(['vol2'], store.find(
+            wwn=_volume('vol2', volume_id='00002')['wwn']))
+        self.assertEqual([], store.find(backend_name='backend2',
+                                        volume_id='00001'))
+
+    def test_unmount_updates_host_index(self):
+        store = self._store()
+        volume = _volume('vol1', hosts=['10.0.0.1'])
+        store.put('vol1', volume)
+        volume['mounted'] = {}
+        store.put('vol1', volume)
+        self.assertEqual([], store.find(host='10.0.0.1'))
+
+    def test_imports_json_store_once(self):
+        json_store = volume_ops.JournalStore(self.json_file)
+        json_store.load()
+        json_store.save({'vol1': _volume('vol1')})
+        # Changes still in the journal are imported too.
+        json_store.put('vol2', _volume('vol2', volume_id='00002'))
+        store = self._store()
+        self.assertEqual(['vol1', 'vol2'], sorted(store.load()))
+        self.assertEqual(['vol2'], store.find(volume_id='00002'))
+        store.delete('vol1')
+        store.delete('vol2')
+        # Emptying the database must not bring the json volumes back.
+        self.assertEqual({}, self._store().load())
+
+    def test_does_not_import_into_existing_database(self):
+        store = self._store()
+        store.put('vol1', _volume('vol1'))
+        # A database made before the import existed.
+        store.conn.execute('PRAGMA user_version = 0')
+        with open(self.json_file, 'w') as f:
+            json.dump({'vol2': _volume('vol2')}, f)
+        self.assertEqual(['vol1'], list(self._store().load()))
+
+
+class _RecordingStore(object):
+    def __init__(self, delay=0, error=None):
+        self.batches = []
+        self.delay = delay
+        self.error = error
+
+    def apply(self, changes):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        self.batches.append(list(changes))
+
+
+class GroupCommitWriterTest(unittest.TestCase):
+
+    def test_concurrent_changes_share_a_write(self):
+        store = _RecordingStore(delay=0.05)
+        writer = volume_ops.GroupCommitWriter(store, commit_window=0.05)
+        threads = [threading.Thread(target=writer.submit,
+                                    args=(('put', 'vol%d' % i, {}),))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(10, sum(len(batch) for batch in store.batches))
+        self.assertLess(len(store.batches), 10)
+        self.assertFalse(writer.busy())
+
+    def test_changes_keep_their_order(self):
+        store = _RecordingStore()
+        writer = volume_ops.GroupCommitWriter(store)
+        batches = [writer.enqueue(('put', 'vol1', {'count': i}))
+                   for i in range(5)]
+        for batch in batches:
+            writer.wait(batch)
+        changes = [change for batch in store.batches for change in batch]
+        self.assertEqual(list(range(5)),
+                         [volume['count'] for _, _, volume in changes])
+
+    def test_write_error_reaches_submitter(self):
+        writer = volume_ops.GroupCommitWriter(
+            _RecordingStore(error=IOError('disk full')))
+        self.assertRaises(IOError, writer.submit, ('delete', 'vol1', None))
+
+
+class VolumeMetaDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _stores(self):
+        yield volume_ops.JournalStore(os.path.join(self.dir, 'data.json'))
+        yield volume_ops.SqliteStore(
+            os.path.join(self.dir, 'data.db'),
+            json_file=os.path.join(self.dir, 'missing.json'))
+
+    def test_index_helpers(self):
+        for store in self._stores():
+            metadata = volume_ops.VolumeMetaData(store=store)
+            metadata.set_volume('vol1', _volume('vol1', hosts=['10.0.0.1']))
+            metadata.set_volume('vol2', _volume(
+                'vol2', backend='backend2', volume_id='00002'))
+            self.assertEqual(
+                ['vol1'], [volume['name'] for volume in
+                           metadata.get_volumes_by_backend('backend1')])
+            self.assertEqual(
+                ['vol1'], [volume['name'] for volume in
+                           metadata.get_volumes_mounted_on('10.0.0.1')])
+            self.assertEqual(
+                'vol2', metadata.get_volume_by_device_id('00002')['name'])
+            self.assertIsNone(metadata.get_volume_by_device_id(
+                '00002', backend_name='backend1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
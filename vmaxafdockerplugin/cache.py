@@ -0,0 +1,105 @@
+import threading
+import time
+
+_shared_lock = threading.Lock()
+_shared = {}
+
+
+def shared(name, owner, ttl):
+    """
+    The cache called name of owner, such as an array, made with ttl by its
+    first user. Everything using the same array then sees the others'
+    invalidations.
+    Args:
+        name: What the cache holds, such as 'catalog'.
+        owner: What the cached values belong to. None gets a cache of its
+            own.
+        ttl: Seconds values are kept, if the cache is made by this call.
+    Returns: A TTLCache.
+    """
+    if owner is None:
+        return TTLCache(ttl)
+    with _shared_lock:
+        return _shared.setdefault((name, owner), TTLCache(ttl))
+
+
+class TTLCache(object):
+    """
+    Thread-safe cache of values which expire ttl seconds after they are
+    stored. Values are loaded on a miss by the caller supplied loader.
+
+    Each invalidation bumps a generation, of the key or of the whole cache.
+    A value whose load started before its key was invalidated may predate
+    the change that prompted the invalidation, and is returned to its
+    caller but not stored.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+        # Keys invalidated since the whole cache last was.
+        self._generations = {}
+
+    def get(self, key, loader, *args):
+        """
+        Return the cached value for key, or load, store and return it.
+        Args:
+            key: The cache key.
+            loader: Called with args to load the value on a miss. A None
+                result is returned but not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation_of(key)
+        value = loader(*args)
+        if value is not None:
+            with self._lock:
+                if self._generation_of(key) == generation:
+                    self._entries[key] = (value, time.time() + self.ttl)
+        return value
+
+    def _generation_of(self, key):
+        return self._generation, self._generations.get(key, 0)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+
+    def invalidate(self, key=None):
+        """
+        Drop key, or every entry if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._generation += 1
+                self._generations.clear()
+            else:
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def invalidate_matching(self, predicate):
+        """
+        Drop every entry for which predicate(key, value) is true. Loads in
+        flight have no value to match yet, none of them is stored.
+        """
+        with self._lock:
+            for key, (value, _) in list(self._entries.items()):
+                if predicate(key, value):
+                    del self._entries[key]
+            self._generation += 1
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)}
@@ -101,3 +101,9 @@ class VMAXPluginException(Exception):
 
     def __unicode__(self):
         return self.msg
+
+
+class BackendUnavailable(VMAXPluginException):
+    message = ("Unisphere %(server)s is unavailable, calls to it will be "
+               "tried again in %(retry_after)d seconds.")
+    code = 503
@@ -1,22 +1,29 @@
-from sh import blkid
-from sh import mke2fs
-from sh import mkdir
-from sh import mount
-from sh import umount
+import contextlib
 import subprocess
-from sh import rm
-from sh import iscsiadm
 import os
-import pyudev
+import Queue
 import six
+import threading
+import time
+from multiprocessing import pool as mp_pool
 from oslo_log import log as logging
 
-from twisted.python.filepath import FilePath
+import waiter
+
+# sh and pyudev are imported where they are used, they are slow to import
+# and not needed until the first mount.
 
 LOG = logging.getLogger(__name__)
+SYSFS_ROOT = '/sys'
+DEVICE_WAIT_TIMEOUT = 30
+MULTIPATH_WAIT_TIMEOUT = 5
+DEV_ROOT = '/dev'
+ISCSI_PORT = 3260
+LOGIN_WORKERS = 8
 
 
 def has_filesystem(path):
+    from sh import blkid
     try:
         #ToDo Parse the output to get exact information, example
         #/dev/sdj: UUID="0cb38451-c366-46e8-a7a4-5e19bd9257f0" VERSION="1.0" TYPE="ext4" USAGE="filesystem"
@@ -31,6 +38,7 @@ def has_filesystem(path):
 
 
 def create_filesystem(path, fs_type):
+    from sh import mke2fs
     try:
         mke2fs("-t", fs_type, path)
     except:
@@ -46,6 +54,7 @@ def mkdir_for_mounting(path):
         LOG.debug(msg)
         return path
     else:
+        from sh import mkdir
         try:
             mkdir("-p", path)
         except:
@@ -55,6 +64,7 @@ def mkdir_for_mounting(path):
 
 
 def mount_dir(src, tgt):
+    from sh import mount
     try:
         mount(src, tgt)
     except Exception as ex:
@@ -73,6 +83,7 @@ def umount_dir(tgt):
     # Otherwise, we do not get the correct result
     result.wait()
     if result.returncode == 0:
+        from sh import umount
         try:
             umount("-l", tgt)
         except Exception as ex:
@@ -82,8 +93,8 @@ def umount_dir(tgt):
 
 
 def remove_dir(tgt):
-    path = FilePath(tgt)
-    if path.exists:
+    if os.path.exists(tgt):
+        from sh import rm
         try:
             rm("-rf", tgt)
         except:
@@ -94,8 +105,8 @@ def remove_dir(tgt):
 
 
 def remove_file(tgt):
-    path = FilePath(tgt)
-    if path.exists:
+    if os.path.exists(tgt):
+        from sh import rm
         try:
             rm(tgt)
         except:
@@ -105,48 +116,390 @@ def remove_file(tgt):
     return True
 
 
-def get_vmax_device_path(symm_id, device_id, target):
-    ret_path = None
-    if target:
-        _login_to_target(target)
-        _rescan_scsi_bus()
-    else:
-        # FC
-        rescan_fc()
-    encoded_str = ""
-    for c in device_id:
-        encoded_str += c.encode("hex")
+def get_vmax_device_path(symm_id, device_id, targets, fc_targets=None,
+                         timeout=DEVICE_WAIT_TIMEOUT,
+                         multipath_timeout=MULTIPATH_WAIT_TIMEOUT, wwn=None,
+                         min_paths=None):
+    """
+    Discover a VMAX volume on this host. Block device events are watched
+    from before the rescan, so a device which arrives late is not missed,
+    and a device which arrives early is found by a scan of the existing
+    devices.
+    Args:
+        symm_id: The array serial number.
+        device_id: The volume's device id.
+        targets: The iSCSI portals to log in to, empty for FC.
+        fc_targets: For FC, the WWPNs of the array ports the volume is
+            masked to. Only the SCSI targets of those ports are scanned, a
+            full bus rescan is the fallback.
+        timeout: Seconds to wait for the device.
+        multipath_timeout: Seconds to wait, once the SCSI disk is there
+            and multipath has claimed it, for multipath to build a device
+            on it.
+        wwn: The volume's WWN. Existing devices are looked up by their
+            /dev/disk/by-id links, all devices are only scanned if it is
+            not known or has no link.
+        min_paths: If set, wait up to timeout for the multipath device
+            and for it to have this many paths. If they do not come in
+            time, the device is used with the paths it has.
+    Returns: The path of the block device, preferring the multipath
+        device, or None.
+    """
+    import pyudev
+    deadline = time.time() + timeout
+    encoded_str = _encode_device_id(device_id)
     context = pyudev.Context()
+    with DEVICE_EVENTS.subscribe() as events:
+        if targets:
+            # New sessions scan their LUNs at login, reused ones need a
+            # rescan.
+            sessions = login_to_targets(targets)
+            if sessions:
+                _rescan_sessions(sessions)
+        else:
+            # FC
+            if not (fc_targets and rescan_fc_targets(fc_targets)):
+                rescan_fc()
+        if min_paths:
+            multipath_timeout = timeout
+        path = _wait_for_device(context, events, symm_id, encoded_str,
+                                timeout, multipath_timeout, wwn,
+                                wait_for_multipath=bool(min_paths))
+    if min_paths and path:
+        # A portal being down degrades the mount rather than failing it.
+        if not _is_dm_device(path):
+            LOG.warning('No multipath device was built on %s within %s '
+                        'seconds, using its single path', path, timeout)
+        elif not waiter.wait_for(lambda: count_paths(path) >= min_paths,
+                                 max(0, deadline - time.time()),
+                                 'multipath paths'):
+            LOG.warning('%s has %d of %d paths after %s seconds, using the '
+                        'paths it has', path, count_paths(path), min_paths,
+                        timeout)
+    return path
+
+
+class DeviceEvents(object):
+    """
+    One udev monitor of block devices for the whole process, started on
+    first use, whose events are handed to every subscriber. pyudev cannot
+    close a monitor, its netlink socket only goes when it is garbage
+    collected, so mounts share this one rather than each opening their
+    own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = False
+        self._subscribers = set()
+
+    @contextlib.contextmanager
+    def subscribe(self):
+        """
+        Receive the events which arrive from now on, from a Queue.Queue,
+        until the block exits.
+        """
+        events = Queue.Queue()
+        with self._lock:
+            if not self._started:
+                self._start()
+            self._subscribers.add(events)
+        try:
+            yield events
+        finally:
+            with self._lock:
+                self._subscribers.discard(events)
+
+    def _start(self):
+        import pyudev
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('block')
+        # Listening from here on, events queue on the socket until the
+        # thread reads them.
+        monitor.start()
+        thread = threading.Thread(target=self._dispatch, args=(monitor,),
+                                  name='udev-events')
+        thread.daemon = True
+        thread.start()
+        self._started = True
+
+    def _dispatch(self, monitor):
+        while True:
+            try:
+                device = monitor.poll()
+            except Exception as ex:
+                LOG.error('Stopped watching block device events: %s', ex)
+                with self._lock:
+                    # Started again by the next subscriber.
+                    self._started = False
+                return
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for events in subscribers:
+                events.put(device)
+
+
+DEVICE_EVENTS = DeviceEvents()
+
+
+def _is_vmax_dm(device, symm_id, encoded_str):
+    lun_naa = device.get('DM_NAME')
+    return bool(lun_naa and device.get('DM_TYPE') == 'scsi' and
+                lun_naa[-10:] == encoded_str and lun_naa[9:-12] == symm_id)
+
+
+def _is_vmax_disk(device, symm_id, encoded_str):
+    lun_naa = device.get('ID_SERIAL_SHORT')
+    return bool(lun_naa and device.get('MAJOR') == '8' and
+                device.device_type == 'disk' and
+                lun_naa[-10:] == encoded_str and lun_naa[8:-12] == symm_id)
+
+
+def _find_device(context, symm_id, encoded_str):
+    """
+    Returns: The multipath device and the SCSI disk of the volume among
+        the existing devices, either may be None.
+    """
+    disk_path = None
     # Get multipath device_path if it exist
     for device in context.list_devices(subsystem='block', DM_TYPE='scsi'):
-        lun_naa = device.get('DM_NAME')
-        ret_dev = lun_naa[-10:]
-        ret_symm = lun_naa[9:-12]
-        if str(ret_dev) == encoded_str and ret_symm == symm_id:
-            ret_path = device.device_node
-            break
+        if _is_vmax_dm(device, symm_id, encoded_str):
+            return device.device_node, None
     # Get device path for single path
-    if ret_path is None:
-        for device in context.list_devices(MAJOR='8'):
-            lun_naa = device.get('ID_SERIAL_SHORT')
-            if device.device_type == 'disk' and lun_naa:
-                ret_dev = lun_naa[-10:]
-                ret_symm = lun_naa[8:-12]
-                if str(ret_dev) == encoded_str and str(ret_symm) == symm_id:
-                    ret_path = device.device_node
-                    break
-    return ret_path
+    for device in context.list_devices(MAJOR='8'):
+        if _is_vmax_disk(device, symm_id, encoded_str):
+            disk_path = device.device_node
+            break
+    return None, disk_path
 
 
-def _rescan_scsi_bus():
+def _find_device_by_wwn(wwn, dev_root=DEV_ROOT):
+    """
+    Returns: The multipath device and the SCSI disk with the WWN, from
+        their /dev/disk/by-id links, either may be None.
     """
-        Rescan for new  iSCSI devices
+    by_id = os.path.join(dev_root, 'disk', 'by-id')
+    wwn = wwn.lower()
+    paths = []
+    for link in ('dm-uuid-mpath-3' + wwn, 'wwn-0x' + wwn):
+        link = os.path.join(by_id, link)
+        paths.append(os.path.realpath(link) if os.path.exists(link) else None)
+    if paths[1] is not None and paths[1] == paths[0]:
+        # wwn- links to the multipath device once there is one.
+        paths[1] = None
+    return paths[0], paths[1]
+
 
+def _is_dm_device(device):
+    return os.path.basename(os.path.realpath(device)).startswith('dm-')
+
+
+def count_paths(device, sysfs_root=SYSFS_ROOT):
+    """
+    Returns: The number of paths of a multipath device, 1 for a SCSI disk.
     """
+    if not _is_dm_device(device):
+        return 1
+    name = os.path.basename(os.path.realpath(device))
     try:
-        iscsiadm("-m", "session", "--rescan")
-    except:
-        LOG.error("iscsiadm rescan: error")
+        return len(os.listdir(os.path.join(sysfs_root, 'block', name,
+                                           'slaves')))
+    except OSError:
+        return 0
+
+
+def _multipath_claimed(device):
+    # Set by the multipath udev rules on the SCSI disks multipathd is to
+    # build a device on.
+    return device.get('DM_MULTIPATH_DEVICE_PATH') == '1'
+
+
+def _multipath_claimed_path(context, path):
+    import pyudev
+    try:
+        return _multipath_claimed(
+            pyudev.Devices.from_device_file(context, path))
+    except pyudev.DeviceNotFoundError:
+        return False
+
+
+def _wait_for_device(context, events, symm_id, encoded_str, timeout,
+                     multipath_timeout, wwn=None, wait_for_multipath=False):
+    """
+    Args:
+        events: A Queue.Queue of block device events, subscribed to
+            before the device could appear.
+        wait_for_multipath: Wait for a multipath device even if multipath
+            has not claimed the SCSI disk.
+    Returns: The multipath device of the volume, or its SCSI disk if
+        multipath has not claimed it or did not build a device in time.
+    """
+    deadline = time.time() + timeout
+    dm_path = disk_path = None
+    if wwn:
+        dm_path, disk_path = _find_device_by_wwn(wwn)
+    if not (dm_path or disk_path):
+        dm_path, disk_path = _find_device(context, symm_id, encoded_str)
+    if dm_path:
+        return dm_path
+    if disk_path:
+        if not (wait_for_multipath or
+                _multipath_claimed_path(context, disk_path)):
+            return disk_path
+        deadline = min(deadline, time.time() + multipath_timeout)
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            device = events.get(timeout=remaining)
+        except Queue.Empty:
+            break
+        if device.action not in ('add', 'change'):
+            continue
+        if _is_vmax_dm(device, symm_id, encoded_str):
+            return device.device_node
+        if disk_path is None and _is_vmax_disk(device, symm_id, encoded_str):
+            disk_path = device.device_node
+            if not (wait_for_multipath or _multipath_claimed(device)):
+                break
+            deadline = min(deadline, time.time() + multipath_timeout)
+    if disk_path is None:
+        LOG.warning('Volume %s of array %s did not appear within %s '
+                    'seconds', encoded_str.decode('hex'), symm_id, timeout)
+    return disk_path
+
+
+def _encode_device_id(device_id):
+    encoded_str = ""
+    for c in device_id:
+        encoded_str += c.encode("hex")
+    return encoded_str
+
+
+def _read_sysfs(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _write_sysfs(path, value):
+    try:
+        with open(path, 'w') as f:
+            f.write(value)
+    except IOError:
+        # Writable by root only.
+        proc = subprocess.Popen(["sudo", "tee", path], stdin=subprocess.PIPE,
+                                stdout=open(os.devnull, 'w'))
+        proc.communicate(value)
+        if proc.returncode:
+            raise IOError('Unable to write %s' % path)
+
+
+def _normalize_wwn(wwn):
+    wwn = wwn.strip().lower()
+    if wwn.startswith('0x'):
+        wwn = wwn[2:]
+    return wwn.replace(':', '')
+
+
+def rescan_fc_targets(target_wwns, sysfs_root=SYSFS_ROOT):
+    """
+    Scan the SCSI targets of the given FC ports for new LUNs, without a
+    LIP or a scan of the whole bus.
+    Args:
+        target_wwns: The WWPNs of the array ports.
+        sysfs_root: Where sysfs is mounted.
+    Returns: The number of targets scanned, 0 if none of the ports are
+        visible to this host.
+    """
+    wanted = set(_normalize_wwn(wwn) for wwn in target_wwns)
+    transport_dir = os.path.join(sysfs_root, 'class', 'fc_transport')
+    try:
+        fc_targets = os.listdir(transport_dir)
+    except OSError:
+        return 0
+    scans = set()
+    for fc_target in fc_targets:
+        try:
+            port_name = _read_sysfs(
+                os.path.join(transport_dir, fc_target, 'port_name'))
+        except IOError:
+            continue
+        if _normalize_wwn(port_name) in wanted:
+            # target<host>:<channel>:<id>
+            scans.add(tuple(fc_target[len('target'):].split(':')))
+    scanned = 0
+    for host, channel, target_id in sorted(scans):
+        scan_file = os.path.join(sysfs_root, 'class', 'scsi_host',
+                                 'host' + host, 'scan')
+        try:
+            _write_sysfs(scan_file, '%s %s -' % (channel, target_id))
+            scanned += 1
+        except IOError as ex:
+            LOG.warning('Unable to scan %s: %s', scan_file, ex)
+    LOG.debug('Scanned %d FC targets', scanned)
+    return scanned
+
+
+def _is_vmax_lun(wwid, symm_id, encoded_device_id):
+    # naa.6000097<symm_id><device id>, the same layout as ID_SERIAL_SHORT.
+    serial = wwid.split('.', 1)[-1]
+    return (serial[-10:] == encoded_device_id and
+            serial[8:-12] == symm_id)
+
+
+def remove_vmax_devices(symm_id, device_id, sysfs_root=SYSFS_ROOT):
+    """
+    Remove the SCSI devices of one VMAX volume from this host, flushing
+    its multipath device first, and leave every other LUN alone.
+    Args:
+        symm_id: The array serial number.
+        device_id: The volume's device id.
+        sysfs_root: Where sysfs is mounted.
+    Returns: The names of the SCSI devices removed.
+    """
+    encoded_str = _encode_device_id(device_id)
+    block_dir = os.path.join(sysfs_root, 'block')
+    try:
+        block_devices = os.listdir(block_dir)
+    except OSError:
+        return []
+    disks = []
+    for name in block_devices:
+        if not name.startswith('sd'):
+            continue
+        try:
+            wwid = _read_sysfs(os.path.join(block_dir, name, 'device', 'wwid'))
+        except IOError:
+            continue
+        if _is_vmax_lun(wwid, symm_id, encoded_str):
+            disks.append(name)
+    for name in block_devices:
+        if not name.startswith('dm-'):
+            continue
+        slaves_dir = os.path.join(block_dir, name, 'slaves')
+        try:
+            slaves = os.listdir(slaves_dir)
+        except OSError:
+            continue
+        if slaves and set(slaves) <= set(disks):
+            try:
+                map_name = _read_sysfs(os.path.join(block_dir, name, 'dm',
+                                                    'name'))
+                subprocess.check_call(["sudo", "multipath", "-f", map_name])
+            except (IOError, OSError, subprocess.CalledProcessError) as ex:
+                LOG.warning('Unable to flush multipath device %s: %s',
+                            name, ex)
+    removed = []
+    for name in disks:
+        try:
+            _write_sysfs(os.path.join(block_dir, name, 'device', 'delete'),
+                         '1')
+            removed.append(name)
+        except IOError as ex:
+            LOG.warning('Unable to remove %s: %s', name, ex)
+    LOG.debug('Removed SCSI devices %s', removed)
+    return removed
 
 
 def rescan_fc():
@@ -160,37 +513,98 @@ def rescan_fc():
     return scanned
 
 
-def _login_to_target(target):
+def iscsi_sessions(sysfs_root=SYSFS_ROOT):
+    """
+    Returns: A dict of the portal IP of each logged in iSCSI session to the
+        session id.
+    """
+    session_dir = os.path.join(sysfs_root, 'class', 'iscsi_session')
+    connection_dir = os.path.join(sysfs_root, 'class', 'iscsi_connection')
+    try:
+        sessions = os.listdir(session_dir)
+        connections = os.listdir(connection_dir)
+    except OSError:
+        return {}
+    portals = {}
+    for session in sessions:
+        sid = session[len('session'):]
+        try:
+            state = _read_sysfs(os.path.join(session_dir, session, 'state'))
+        except IOError:
+            # Not reported by older kernels.
+            state = 'LOGGED_IN'
+        if state != 'LOGGED_IN':
+            continue
+        for connection in connections:
+            if not connection.startswith('connection%s:' % sid):
+                continue
+            try:
+                address = _read_sysfs(os.path.join(
+                    connection_dir, connection, 'persistent_address'))
+            except IOError:
+                continue
+            portals[address] = sid
+    return portals
+
+
+def login_to_targets(targets, sysfs_root=SYSFS_ROOT):
+    """
+    Log in to the iSCSI portals this host has no session with, in parallel.
+    Args:
+        targets: The portal IPs.
+    Returns: The ids of the existing sessions with the other portals.
+    """
+    sessions = iscsi_sessions(sysfs_root)
+    existing = [sessions[target] for target in targets if target in sessions]
+    new = [target for target in targets if target not in sessions]
+    LOG.debug('iSCSI portals %s have sessions, logging in to %s',
+              [target for target in targets if target in sessions], new)
+    if len(new) > 1:
+        workers = mp_pool.ThreadPool(min(len(new), LOGIN_WORKERS))
+        try:
+            workers.map(_login_to_target, new)
+        finally:
+            workers.close()
+            workers.join()
+    elif new:
+        _login_to_target(new[0])
+    return existing
 
+
+def _rescan_sessions(sessions):
+    """
+    Rescan the given iSCSI sessions for new LUNs.
+    """
+    from sh import iscsiadm
+    for sid in sessions:
+        try:
+            iscsiadm("-m", "session", "-r", sid, "--rescan")
+        except:
+            LOG.error("iscsiadm rescan of session %s: error", sid)
+
+
+def _login_to_target(target):
+    from sh import iscsiadm
     try:
         iscsiadm("-m", "discovery", "-t", "sendtargets", "-p", target)
     except:
         LOG.error("iscsiadm discovery: error")
-    target += ':3260'
+    target += ':%d' % ISCSI_PORT
     try:
         iscsiadm("-m", "node", "-p", target, "-l")
     except:
         LOG.warn("iscsiadm login failure, initiator may be already logged in")
 
 
-def get_initiator():
+def get_initiator(initiator_file='/etc/iscsi/initiatorname.iscsi'):
+    """
+    Read the iSCSI initiator name with sudo. Only the fallback of
+    identity.HostIdentity for initiator files readable by root alone.
+    """
     try:
-        output = subprocess.check_output(
-            ["sudo", "cat", "/etc/iscsi/initiatorname.iscsi"])
+        output = subprocess.check_output(["sudo", "cat", initiator_file])
         for l in output.split('\n'):
             if l.startswith('InitiatorName='):
                 return l[l.index('=') + 1:].strip()
     except subprocess.CalledProcessError as e:
         LOG.error("Unable to get Iqn:\n", e.returncode)
-
-
-def get_wwpns():
-    try:
-        wwpns = []
-        output = subprocess.check_output(["systool", "-c", "fc_host", "-v"])
-        for l in output.split('\n'):
-            if l.strip().startswith('port_name'):
-                wwpns.append(l[l.index('x') + 1:-1])
-        return wwpns
-    except subprocess.CalledProcessError as e:
-        print("Unable to get WWPNS:\n", e.returncode)
\ No newline at end of file
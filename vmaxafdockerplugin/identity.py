@@ -0,0 +1,85 @@
+import os
+import platform
+import threading
+
+from oslo_log import log as logging
+
+import fileutil
+
+LOG = logging.getLogger(__name__)
+ISCSI_INITIATOR_FILE = '/etc/iscsi/initiatorname.iscsi'
+
+
+class HostIdentity(object):
+    """
+    The iSCSI initiator name and FC WWPNs of this host. They are read from
+    the initiator file and sysfs rather than by running commands, and only
+    read again when the file's mtime or the set of FC hosts changes.
+    """
+
+    def __init__(self, initiator_file=ISCSI_INITIATOR_FILE,
+                 sysfs_root='/sys'):
+        self.initiator_file = initiator_file
+        self.fc_host_dir = os.path.join(sysfs_root, 'class', 'fc_host')
+        self._lock = threading.Lock()
+        self._initiator = (None, None)
+        self._wwpns = (None, [])
+
+    @staticmethod
+    def host_name():
+        return platform.node()
+
+    def initiator(self):
+        """
+        Returns: The iSCSI initiator name, or None.
+        """
+        try:
+            mtime = os.stat(self.initiator_file).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            if self._initiator[0] == mtime:
+                return self._initiator[1]
+        initiator = self._read_initiator()
+        with self._lock:
+            self._initiator = (mtime, initiator)
+        return initiator
+
+    def _read_initiator(self):
+        try:
+            with open(self.initiator_file) as f:
+                for line in f:
+                    if line.startswith('InitiatorName='):
+                        return line[line.index('=') + 1:].strip()
+        except IOError:
+            # Readable by root only on some distributions.
+            LOG.debug('Unable to read %s, reading it with sudo',
+                      self.initiator_file)
+            return fileutil.get_initiator(self.initiator_file)
+        return None
+
+    def wwpns(self):
+        """
+        Returns: A list of the WWPNs of the FC hosts, without the 0x.
+        """
+        try:
+            fc_hosts = tuple(sorted(os.listdir(self.fc_host_dir)))
+        except OSError:
+            return []
+        with self._lock:
+            if self._wwpns[0] == fc_hosts:
+                return list(self._wwpns[1])
+        wwpns = []
+        for fc_host in fc_hosts:
+            try:
+                with open(os.path.join(self.fc_host_dir, fc_host,
+                                       'port_name')) as f:
+                    port_name = f.read().strip()
+            except IOError:
+                continue
+            if port_name.startswith('0x'):
+                port_name = port_name[2:]
+            wwpns.append(port_name)
+        with self._lock:
+            self._wwpns = (fc_hosts, wwpns)
+        return list(wwpns)
@@ -1,6 +1,8 @@
+import functools
 import json
 import os
 import sys
+import threading
 
 from flask import Flask
 from flask import request
@@ -9,9 +11,13 @@ from oslo_log import helpers
 from oslo_log import log as logging
 
 from vmaxafdockerplugin import fileutil
+from vmaxafdockerplugin import identity
 from config import setupcfg
+from vmaxafdockerplugin import locks
+from vmaxafdockerplugin import metrics
+from vmaxafdockerplugin import retry
 from vmaxafdockerplugin import vmax_plugin
-from vmaxafdockerplugin.volume_ops import volume_ops
+from vmaxafdockerplugin import volume_ops as metadata
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -21,34 +27,44 @@ vmax_plugin_dir = "/usr/lib/docker/plugins/"
 vmax_plugin_file = vmax_plugin_dir + "vmaxAF.json"
 
 logging.register_options(CONF)
+CONF.register_opts(setupcfg.host_opts)
 
 listener = Flask(DOMAIN)
+volume_locks = locks.KeyedLock()
+mount_requests = locks.InFlight()
 
-CONF.register_opts(setupcfg.host_opts)
+# Set up by create_app.
+volume_ops = None
+backend_confs = {}
+backend_dict = {}
+backend_slots = locks.KeyedSemaphore({})
 
-try:
-    vmax_config_file = sys.argv[1]
-except IndexError:
-    if not os.path.isfile(vmax_config_file):
-        LOG.error('Configuration file vmax.conf not found. Please create file '
-                  'using vmax.conf.sample...terminating')
-        sys.exit(1)
 
-CONFIG_FILE = os.path.abspath(vmax_config_file)
-CONFIG = ['--config-file', CONFIG_FILE]
+def volume_locked(func):
+    """
+    Serialize requests for the same volume. Requests for different volumes
+    run in parallel.
+    """
+    @functools.wraps(func)
+    def wrapper():
+        volume_name = request.get_json(force=True)['Name']
+        with volume_locks.lock(volume_name):
+            return func()
+    return wrapper
 
-CONF(CONFIG)
-backend_conf_list = []
-backend_dict = {}
 
-if not os.path.exists(vmax_plugin_dir):
-    os.makedirs(vmax_plugin_dir)
-filename = os.path.abspath(vmax_plugin_file)
-lines = ['{', '\"Name\": \"vmaxAF\",', (
-    '\"Addr\": \"http://127.0.0.1:%s\"' % CONF.listener_port_number), '}']
-with open(filename, 'w+') as f:
-    f.write('\n'.join(lines))
-    f.seek(0)
+def docker_operation(name):
+    """
+    Tag the array calls made while handling the request with the Docker
+    operation, for /Plugin.Stats.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper():
+            with metrics.operation(name):
+                return func()
+        return wrapper
+    return decorator
 
 
 class Configuration(object):
@@ -82,24 +98,120 @@ class Configuration(object):
         return getattr(self.local_conf, value)
 
 
-if CONF.enabled_backends:
-    if not (CONF.default_backend and
-            CONF.default_backend in CONF.enabled_backends):
-        CONF.set_override(name='default_backend',
-                          override=CONF.enabled_backends[0]),
-    for backend in filter(None, CONF.enabled_backends):
-        backend_conf_list.append(Configuration(
-            setupcfg.volume_opts, config_group=backend))
-logging.setup(CONF, DOMAIN)
-for backend_conf in backend_conf_list:
-    array = backend_conf.safe_get('array')
-    u4v_ip = backend_conf.safe_get('rest_server_ip')
-    user = backend_conf.safe_get('rest_user_name')
-    password = backend_conf.safe_get('rest_password')
-    protocol = backend_conf.safe_get('storage_protocol')
-    vmax = vmax_plugin.VmaxAf(u4v_ip, user, password, array=array,
-                              protocol=protocol)
-    backend_dict[backend_conf.safe_get('volume_backend_name')] = vmax
+def create_app(config_file):
+    """
+    Load the configuration and set up the metadata store, the plugin spec
+    file and the backends. Nothing is done at import time, and the
+    connection to each backend's Unisphere is only made on first use.
+    Args:
+        config_file: Path of vmax.conf.
+    Returns: The Flask application serving the plugin API.
+    """
+    global volume_ops, backend_slots
+    CONF(['--config-file', os.path.abspath(config_file)])
+    logging.setup(CONF, DOMAIN)
+    volume_ops = metadata.VolumeMetaData(
+        store=metadata.get_store(CONF.metadata_store),
+        commit_window=CONF.metadata_commit_window / 1000.0)
+
+    if CONF.listener_socket and CONF.listener_server != 'twisted':
+        LOG.warning('listener_socket is only supported by the twisted '
+                    'server, listening on port %s instead',
+                    CONF.listener_port_number)
+        CONF.set_override(name='listener_socket', override=None)
+    _write_plugin_spec()
+
+    if CONF.enabled_backends:
+        if not (CONF.default_backend and
+                CONF.default_backend in CONF.enabled_backends):
+            CONF.set_override(name='default_backend',
+                              override=CONF.enabled_backends[0]),
+        for backend in filter(None, CONF.enabled_backends):
+            backend_conf = Configuration(
+                setupcfg.volume_opts, config_group=backend)
+            backend_confs[backend_conf.safe_get(
+                'volume_backend_name')] = backend_conf
+    host_identity = identity.HostIdentity()
+    for backend_name, backend_conf in backend_confs.items():
+        array = backend_conf.safe_get('array')
+        u4v_ip = backend_conf.safe_get('rest_server_ip')
+        user = backend_conf.safe_get('rest_user_name')
+        password = backend_conf.safe_get('rest_password')
+        protocol = backend_conf.safe_get('storage_protocol')
+        backend_dict[backend_name] = vmax_plugin.VmaxAf(
+            u4v_ip, user, password, array=array, protocol=protocol,
+            catalog_ttl=backend_conf.safe_get('catalog_cache_ttl'),
+            object_cache_ttl=backend_conf.safe_get('object_cache_ttl'),
+            initiator_cache_ttl=backend_conf.safe_get('initiator_cache_ttl'),
+            host_identity=host_identity,
+            pool_size=backend_conf.safe_get('rest_connections'),
+            pool_idle_timeout=backend_conf.safe_get(
+                'rest_connection_idle_timeout'),
+            pool_check_interval=backend_conf.safe_get(
+                'rest_connection_check_interval'),
+            read_limit=backend_conf.safe_get('rest_read_limit'),
+            mutate_limit=backend_conf.safe_get('rest_mutate_limit'),
+            retry_policy=retry.RetryPolicy(
+                retries=backend_conf.safe_get('rest_retries'),
+                delay=backend_conf.safe_get('rest_retry_delay'),
+                budget=retry.RetryBudget(
+                    ratio=backend_conf.safe_get('rest_retry_budget'))),
+            circuit_breaker=retry.CircuitBreaker(
+                threshold=backend_conf.safe_get('circuit_breaker_threshold'),
+                reset_timeout=backend_conf.safe_get(
+                    'circuit_breaker_reset_timeout')))
+    backend_slots = locks.KeyedSemaphore(dict(
+        (backend_name, backend_conf.safe_get('max_concurrent_operations'))
+        for backend_name, backend_conf in backend_confs.items()))
+    for backend_name in backend_dict:
+        # In the background, start up does not wait on Unisphere.
+        worker = threading.Thread(target=_refresh_catalog,
+                                  args=(backend_name, False),
+                                  name='catalog-' + backend_name)
+        worker.daemon = True
+        worker.start()
+    return listener
+
+
+def _refresh_catalog(backend_name, reload_all=True):
+    """
+    Load the array catalog of a backend.
+    Args:
+        backend_name: The backend to load.
+        reload_all: Drop what is already cached first.
+    Returns: An error message, empty on success.
+    """
+    vmax = backend_dict[backend_name]
+    port_groups = backend_confs[backend_name].safe_get('port_groups')
+    try:
+        with metrics.operation('Catalog'):
+            if reload_all:
+                vmax.refresh_catalog(port_groups)
+            else:
+                vmax.warm_catalog(port_groups)
+    except Exception as ex:
+        LOG.warning('Unable to load the catalog of backend %s: %s',
+                    backend_name, ex)
+        return str(ex)
+    return ''
+
+
+def _write_plugin_spec():
+    filename = os.path.abspath(vmax_plugin_file)
+    if CONF.listener_socket:
+        # Docker finds the socket itself, a spec file left from an earlier
+        # TCP configuration would shadow it.
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    if not os.path.exists(vmax_plugin_dir):
+        os.makedirs(vmax_plugin_dir)
+    lines = ['{', '\"Name\": \"vmaxAF\",', (
+        '\"Addr\": \"http://127.0.0.1:%s\"' % CONF.listener_port_number),
+        '}']
+    with open(filename, 'w+') as f:
+        f.write('\n'.join(lines))
+        f.seek(0)
 
 
 @listener.route('/Plugin.Activate', methods=['POST'])
@@ -108,6 +220,74 @@ def activate():
     return json.dumps({u"Implements": [u"VolumeDriver"]})
 
 
+@listener.route('/Plugin.Stats', methods=['GET', 'POST'])
+def stats():
+    """
+    Report request lane and backend queue depths so saturation can be
+    spotted, the hit rates of the backend caches, and the array calls made
+    by each Docker operation with their latencies, the state of each
+    backend's circuit breaker and connection pool, how long calls queued
+    for admission, how long waits on the array took, and the volumes of
+    each backend and mounted on the requesting host. Not part of the docker
+    plugin API.
+    """
+    lanes = {}
+    if CONF.listener_server == 'twisted':
+        from vmaxafdockerplugin import server
+        lanes = server.lane_stats()
+    catalog = dict((backend_name, vmax.catalog.stats())
+                   for backend_name, vmax in backend_dict.items())
+    objects = dict((backend_name, vmax.objects.stats())
+                   for backend_name, vmax in backend_dict.items())
+    initiators = dict((backend_name, vmax.initiators.stats())
+                      for backend_name, vmax in backend_dict.items())
+    calls = dict((backend_name, vmax.calls.stats())
+                 for backend_name, vmax in backend_dict.items())
+    breakers = dict((backend_name, vmax.circuit_breaker.stats())
+                    for backend_name, vmax in backend_dict.items())
+    connections = dict((backend_name, vmax.connections.stats())
+                       for backend_name, vmax in backend_dict.items())
+    admission = dict((backend_name, {u"Lanes": vmax.admission.stats(),
+                                     u"Waits": vmax.admission_waits.stats()})
+                     for backend_name, vmax in backend_dict.items())
+    waits = dict((backend_name, vmax.waits.stats())
+                 for backend_name, vmax in backend_dict.items())
+    volumes = dict(
+        (backend_name, len(volume_ops.get_volumes_by_backend(backend_name)))
+        for backend_name in backend_dict)
+    mounted = len(volume_ops.get_volumes_mounted_on(request.remote_addr))
+    return json.dumps({u"Lanes": lanes,
+                       u"Backends": backend_slots.stats(),
+                       u"Catalog": catalog,
+                       u"Objects": objects,
+                       u"Initiators": initiators,
+                       u"Calls": calls,
+                       u"Breakers": breakers,
+                       u"Connections": connections,
+                       u"Admission": admission,
+                       u"Waits": waits,
+                       u"Volumes": {u"Backends": volumes,
+                                    u"Mounted": mounted}})
+
+
+@listener.route('/Plugin.RefreshCatalog', methods=['POST'])
+def refresh_catalog():
+    """
+    Reload the cached array catalog of one backend, given by "Backend" in
+    the request, or of every backend. Not part of the docker plugin API.
+    """
+    request_data = request.get_json(force=True, silent=True) or {}
+    backend_name = request_data.get('Backend')
+    if backend_name is None:
+        backend_names = list(backend_dict)
+    elif backend_name in backend_dict:
+        backend_names = [backend_name]
+    else:
+        return json.dumps({u"Err": 'Unknown backend: %s' % backend_name})
+    errors = [_refresh_catalog(name) for name in backend_names]
+    return json.dumps({u"Err": '; '.join(filter(None, errors))})
+
+
 @listener.route('/VolumeDriver.List', methods=['POST'])
 def list_volumes():
     LOG.info('List request')
@@ -130,9 +310,14 @@ def get():
     volume_info = volume_ops.get_volume(volume_name)
     if volume_info:
         mountpoint = volume_ops.get_mount_path(volume_name, target_host_name)
+        status = {}
+        mounted = volume_info['mounted'].get(target_host_name)
+        if mounted and 'device' in mounted:
+            # Counted now, paths come and go while the volume is mounted.
+            status['Paths'] = fileutil.count_paths(mounted['device'])
         data = {'Name': volume_name,
                 'Mountpoint': mountpoint,
-                'Status': {}}
+                'Status': status}
 
         response = json.dumps({u"Err": err, u"Volume": data})
         LOG.debug('Get Response = {0}'.format(response))
@@ -144,6 +329,8 @@ def get():
 
 
 @listener.route('/VolumeDriver.Create', methods=['POST'])
+@docker_operation('Create')
+@volume_locked
 def create():
     """
     1. Check if the given volume name exists, if not, create the volume;
@@ -202,19 +389,14 @@ def create():
             LOG.debug(
                 "Volume backend NOT specified, using default")
             volume_opts['backend-name'] = CONF.default_backend
-        group_conf = None
-
-        for backend_config in backend_conf_list:
-            if (backend_config.safe_get('volume_backend_name') == (
-                    volume_opts['backend-name'])):
-                group_conf = backend_conf
-                break
+        group_conf = backend_confs.get(volume_opts['backend-name'])
         if group_conf is not None:
             volume_opts['service_level'] = group_conf.safe_get('service_level')
             volume_opts['workload'] = group_conf.safe_get('workload')
             volume_opts['srp'] = group_conf.safe_get('srp')
         vmax = backend_dict[volume_opts['backend-name']]
-        res = vmax.create_volume(volume_name, volume_opts)
+        with backend_slots.hold(volume_opts['backend-name']):
+            res = vmax.create_volume(volume_name, volume_opts)
         if res['volume_identifier'] == volume_name:
             LOG.info("Volume create successful ", res)
             volume = {'name': volume_name,
@@ -262,6 +444,7 @@ def capabilities():
 
 
 @listener.route('/VolumeDriver.Mount', methods=['POST'])
+@docker_operation('Mount')
 def mount():
     """
     Check if the given volume has been mounted to this current host, if not,
@@ -269,87 +452,129 @@ def mount():
     formatted, if not, use "format" option in the "mount" operation. When
     the mount operation succeeds, mark it as mounted to the host.
 
+    Mounts of the same volume on the same host that arrive while one is
+    already attaching it wait for that attach instead of attaching again.
+    The attaching mount counts them in the same update as itself.
+
     Returns: Mount path needed by Docker daemon.
     """
     request_data = log_input('Mount', request)
     volume_name = request_data['Name']
     target_host_name = request.remote_addr
     LOG.debug('Target host address = {0}'.format(target_host_name))
+    response, shared = mount_requests.run(
+        (volume_name, target_host_name), _mount, volume_name,
+        target_host_name)
+    if shared:
+        LOG.debug('Joined in-flight mount of %s, Request ID: %s',
+                  volume_name, request_data['ID'])
+    return response
+
+
+def _mounts(volume_name, target_host_name):
+    """
+    The number of mounts the running mount stands for, itself and those
+    that joined it. Called with the volume lock held, no more can join.
+    """
+    return 1 + mount_requests.close((volume_name, target_host_name))
+
+
+def _mount(volume_name, target_host_name):
+    with volume_locks.lock(volume_name):
+        return _mount_locked(volume_name, target_host_name)
+
+
+def _mount_locked(volume_name, target_host_name):
     volume = volume_ops.get_volume(volume_name)
     mount_path = volume_ops.get_mount_path(volume_name, target_host_name)
-    disk_device = None
     if mount_path:
         # If the volume is already mounted to the target host, just increase
         # counter.
-        volume['mounted'][target_host_name]['count'] += 1
+        volume['mounted'][target_host_name]['count'] += _mounts(
+            volume_name, target_host_name)
         volume_ops.set_volume(volume_name, volume)
-    else:
-        # Else it means it's the first time to mount the volume to the target
-        vmax = backend_dict[volume['backend-name']]
-        group_conf = None
-        for backend_config in backend_conf_list:
-            if (backend_config.safe_get('volume_backend_name') == (
-                    volume['backend-name'])):
-                group_conf = backend_conf
-                break
-        target_ip_list = vmax.attach_volume(
-            volume_name, volume["volume_id"], group_conf)
-        volume_id = volume['volume_id']
-        if not target_ip_list and vmax.protocol.lower() == 'iscsi':
-            error_msg = "Error mounting volume."
+        return json.dumps({u"Err": '', u"Mountpoint": mount_path})
+    # Else it means it's the first time to mount the volume to the target
+    with backend_slots.hold(volume['backend-name']):
+        return _attach_and_mount(volume_name, volume, target_host_name)
+
+
+def _attach_and_mount(volume_name, volume, target_host_name):
+    disk_device = None
+    vmax = backend_dict[volume['backend-name']]
+    group_conf = backend_confs.get(volume['backend-name'])
+    target_ip_list = vmax.attach_volume(
+        volume_name, volume["volume_id"], group_conf)
+    volume_id = volume['volume_id']
+    if not target_ip_list and vmax.protocol.lower() == 'iscsi':
+        error_msg = "Error mounting volume."
+        vmax.detach_volume(volume_name, volume_id, group_conf)
+        LOG.error(error_msg)
+        return json.dumps({u"Err": error_msg})
+    mount_point = CONF.mount_path + volume_name
+
+    symm_id = group_conf.safe_get('array')
+    if vmax.protocol.lower() == 'iscsi':
+        LOG.debug('Target ips:%s', target_ip_list)
+        min_paths = None
+        if CONF.iscsi_multipath:
+            # A path through each portal, unless there are enough anyway.
+            min_paths = min(CONF.multipath_min_paths, len(target_ip_list))
+        disk_device = fileutil.get_vmax_device_path(
+            symm_id, volume_id, target_ip_list,
+            timeout=CONF.device_wait_timeout,
+            multipath_timeout=CONF.multipath_wait_timeout,
+            wwn=volume.get('wwn'), min_paths=min_paths)
+        if disk_device is None:
+            error_msg = "Volume could not be discoved on host"
             vmax.detach_volume(volume_name, volume_id, group_conf)
             LOG.error(error_msg)
             return json.dumps({u"Err": error_msg})
-        mount_point = CONF.mount_path + volume_name
-
-        symm_id = group_conf.safe_get('array')
+    else:
+        disk_device = fileutil.get_vmax_device_path(
+            symm_id, volume_id, None, fc_targets=target_ip_list,
+            timeout=CONF.device_wait_timeout,
+            multipath_timeout=CONF.multipath_wait_timeout,
+            wwn=volume.get('wwn'))
+    # Check if filesystem exists, create one if not
+    if fileutil.has_filesystem(disk_device) is False:
+        LOG.debug('File system does not exist on %s', disk_device)
         if vmax.protocol.lower() == 'iscsi':
-            for target_ip in target_ip_list:
-                LOG.debug('Target ip:%s', target_ip)
-                disk_device = fileutil.get_vmax_device_path(
-                    symm_id, volume_id, target_ip)
-                if disk_device:
-                    break
-            if disk_device is None:
-                error_msg = "Volume could not be discoved on host"
-                return json.dumps({u"Err": error_msg})
-        else:
-            disk_device = fileutil.get_vmax_device_path(symm_id, volume_id, "")
-        # Check if filesystem exists, create one if not
-        if fileutil.has_filesystem(disk_device) is False:
-            LOG.debug('File system does not exist on %s', disk_device)
-            if vmax.protocol.lower() == 'iscsi':
-                file_exist = fileutil.create_filesystem(disk_device, 'ext4')
-            else:
-                file_exist = fileutil.create_filesystem(disk_device, 'ext3')
+            file_exist = fileutil.create_filesystem(disk_device, 'ext4')
         else:
-            msg = ('Found File system on %s', disk_device)
-            LOG.debug(msg)
-            file_exist = True
-        if not file_exist:
-            vmax.detach_volume(volume_name, volume_id, group_conf)
-            error_msg = (
-                    "Filesystem %s could not be created on host" % disk_device)
-            return json.dumps({u"Err": error_msg})
-        # Create mountpoint
-        fileutil.mkdir_for_mounting(mount_point)
-        # Mount
-        try:
-            fileutil.mount_dir(disk_device, mount_point)
-        except:
-            vmax.detach_volume(volume_name, volume_id, group_conf)
-        # Update record
-        volume['formatted'] = True
-        volume['mounted'][target_host_name] = {
-            'mount_point': mount_point, 'count': 1}
-        volume_ops.set_volume(volume_name, volume)
-        mount_path = volume_ops.get_mount_path(volume_name, target_host_name)
-        LOG.info("Volume Mount successful. Mount Path from data file %s",
-                 mount_path)
-        return json.dumps({u"Err": '', u"Mountpoint": mount_path})
+            file_exist = fileutil.create_filesystem(disk_device, 'ext3')
+    else:
+        msg = ('Found File system on %s', disk_device)
+        LOG.debug(msg)
+        file_exist = True
+    if not file_exist:
+        vmax.detach_volume(volume_name, volume_id, group_conf)
+        error_msg = (
+                "Filesystem %s could not be created on host" % disk_device)
+        return json.dumps({u"Err": error_msg})
+    # Create mountpoint
+    fileutil.mkdir_for_mounting(mount_point)
+    # Mount
+    try:
+        fileutil.mount_dir(disk_device, mount_point)
+    except:
+        vmax.detach_volume(volume_name, volume_id, group_conf)
+    # Update record
+    volume['formatted'] = True
+    volume['mounted'][target_host_name] = {
+        'mount_point': mount_point,
+        'count': _mounts(volume_name, target_host_name),
+        'device': disk_device}
+    volume_ops.set_volume(volume_name, volume)
+    mount_path = volume_ops.get_mount_path(volume_name, target_host_name)
+    LOG.info("Volume Mount successful. Mount Path from data file %s",
+             mount_path)
+    return json.dumps({u"Err": '', u"Mountpoint": mount_path})
 
 
 @listener.route('/VolumeDriver.Unmount', methods=['POST'])
+@docker_operation('Unmount')
+@volume_locked
 def unmount():
     """
     Unmount the volume from the target host.
@@ -379,15 +604,14 @@ def unmount():
             fileutil.remove_dir(mount_path)
             # detach volume
             vmax = backend_dict[volume['backend-name']]
-            group_conf = None
-            for backend_config in backend_conf_list:
-                if (backend_config.safe_get('volume_backend_name') == (
-                        volume['backend-name'])):
-                    group_conf = backend_conf
-                    break
-            vmax.detach_volume(volume_name, volume["volume_id"], group_conf)
+            group_conf = backend_confs.get(volume['backend-name'])
             if vmax.protocol.lower() != 'iscsi':
-                fileutil.rescan_fc()
+                # Only this volume's devices, before it is unmasked.
+                fileutil.remove_vmax_devices(
+                    group_conf.safe_get('array'), volume["volume_id"])
+            with backend_slots.hold(volume['backend-name']):
+                vmax.detach_volume(
+                    volume_name, volume["volume_id"], group_conf)
             # Udate record in data.json
             del volume['mounted'][target_host_name]
             volume_ops.set_volume(volume_name, volume)
@@ -399,6 +623,8 @@ def unmount():
 
 
 @listener.route('/VolumeDriver.Remove', methods=['POST'])
+@docker_operation('Remove')
+@volume_locked
 def remove():
     """
     1. Unexport the volume from the target host;
@@ -416,7 +642,9 @@ def remove():
     vmax = backend_dict[volume['backend-name']]
     msg = ''
     if volume:
-        res = vmax.remove_volume(volume_name, volume_id=volume["volume_id"])
+        with backend_slots.hold(volume['backend-name']):
+            res = vmax.remove_volume(
+                volume_name, volume_id=volume["volume_id"])
         if res:
             volume_ops.remove_volume(volume_name)
             LOG.info("Volume %s removed successfully", volume_name)
@@ -445,9 +673,30 @@ def log_input(operation, req):
 
 @helpers.log_method_call
 def main():
+    try:
+        config_file = sys.argv[1]
+    except IndexError:
+        config_file = vmax_config_file
+        if not os.path.isfile(config_file):
+            LOG.error('Configuration file vmax.conf not found. Please create '
+                      'file using vmax.conf.sample...terminating')
+            sys.exit(1)
+    app = create_app(config_file)
     LOG.info('Starting server...')
-    LOG.info('Listening on port: ' + str(CONF.listener_port_number))
-    listener.run('0.0.0.0', CONF.listener_port_number, debug=CONF.debug)
+    if not CONF.listener_socket:
+        LOG.info('Listening on port: ' + str(CONF.listener_port_number))
+    if CONF.listener_server == 'twisted':
+        from vmaxafdockerplugin import server
+        server.serve(app, CONF.listener_port_number,
+                     threads=CONF.listener_threads,
+                     fast_threads=CONF.listener_fast_threads,
+                     backlog=CONF.listener_backlog,
+                     idle_timeout=CONF.listener_idle_timeout,
+                     request_timeout=CONF.listener_request_timeout,
+                     socket_path=CONF.listener_socket)
+    else:
+        app.run('0.0.0.0', CONF.listener_port_number, debug=CONF.debug,
+                threaded=True)
 
 
 if __name__ == '__main__':
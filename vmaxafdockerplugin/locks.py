@@ -0,0 +1,178 @@
+import collections
+import contextlib
+import threading
+import time
+
+
+class KeyedLock(object):
+    """
+    Hands out one lock per key, such as a volume name. Callers holding
+    different keys never block each other, callers with the same key are
+    serialized. A key's lock only exists while somebody holds or waits on it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    @contextlib.contextmanager
+    def lock_all(self, keys):
+        """
+        Hold the locks of several keys. They are taken in sorted order, so
+        two callers never each hold a lock the other is waiting for.
+        """
+        keys = sorted(set(keys))
+        if not keys:
+            yield
+            return
+        with self.lock(keys[0]):
+            with self.lock_all(keys[1:]):
+                yield
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.joined = 0
+
+
+class InFlight(object):
+    """
+    Collapses concurrent calls for the same key into one. The first caller
+    runs the function, callers arriving before it finishes wait for it and
+    get its result, or its exception, instead of running it again.
+
+    The function may call close to stop further callers joining and learn
+    how many joined, so that it can account for them while it still holds
+    whatever lock guards its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Returns: The result of func and whether it was shared from a call
+            already in flight rather than run by this caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if shared:
+                call.joined += 1
+            else:
+                call = self._calls[key] = _Call()
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self.close(key, call)
+            call.done.set()
+        return call.result, False
+
+    def close(self, key, call=None):
+        """
+        Stop callers joining the call in flight for key, later callers run
+        the function again.
+        Args:
+            key: The key the function is running for.
+            call: Only close this call, used by run itself.
+        Returns: The number of callers that joined the call.
+        """
+        with self._lock:
+            current = self._calls.get(key)
+            if current is None or (call is not None and current is not call):
+                return 0
+            del self._calls[key]
+            return current.joined
+
+
+class KeyedSemaphore(object):
+    """
+    Lets at most a configured number of callers hold a key, such as a
+    backend name, at once. Further callers for that key wait, and are let
+    in the order they arrived.
+    """
+
+    def __init__(self, limits, default_limit=1, wait_stats=None):
+        """
+        Args:
+            limits: A dict of key to the number of concurrent holders.
+            default_limit: The limit of keys missing from limits.
+            wait_stats: A metrics.WaitStats to record how long each caller
+                waited for its key in.
+        """
+        self._cond = threading.Condition()
+        self._limits = limits
+        self._default_limit = default_limit
+        self._wait_stats = wait_stats
+        self._active = {}
+        self._queues = {}
+
+    def limit(self, key):
+        return self._limits.get(key) or self._default_limit
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        start = time.time()
+        ticket = object()
+        with self._cond:
+            queue = self._queues.setdefault(key, collections.deque())
+            queue.append(ticket)
+            while (queue[0] is not ticket or
+                   self._active.get(key, 0) >= self.limit(key)):
+                self._cond.wait()
+            queue.popleft()
+            if not queue:
+                del self._queues[key]
+            self._active[key] = self._active.get(key, 0) + 1
+            # The next in line may fit too.
+            self._cond.notify_all()
+        if self._wait_stats is not None:
+            self._wait_stats.record(key, (time.time() - start) * 1000.0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active[key] -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        """
+        Returns: A dict of key to its limit, active and waiting holders.
+        """
+        with self._cond:
+            keys = set(self._limits) | set(self._active)
+            return dict((key, {'limit': self.limit(key),
+                               'active': self._active.get(key, 0),
+                               'waiting': len(self._queues.get(key, ()))})
+                        for key in keys)
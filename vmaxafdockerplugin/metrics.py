@@ -0,0 +1,160 @@
+import contextlib
+import threading
+import time
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# Operation recorded for calls made outside a Docker request.
+BACKGROUND = 'Background'
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def operation(name):
+    """
+    Tag the array calls made by this thread with a Docker operation.
+    Args:
+        name: The operation, e.g. Create or Mount.
+    """
+    previous = getattr(_context, 'operation', None)
+    _context.operation = name
+    try:
+        yield
+    finally:
+        _context.operation = previous
+
+
+def current_operation():
+    return getattr(_context, 'operation', None) or BACKGROUND
+
+
+class _Method(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, elapsed_ms, failed):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(BUCKETS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def stats(self):
+        histogram = dict(('<=%d' % bound, n)
+                         for bound, n in zip(BUCKETS, self.buckets))
+        histogram['>%d' % BUCKETS[-1]] = self.buckets[-1]
+        return {'count': self.count,
+                'errors': self.errors,
+                'retries': self.retries,
+                'total_ms': round(self.total_ms, 3),
+                'max_ms': round(self.max_ms, 3),
+                'histogram_ms': histogram}
+
+
+class CallStats(object):
+    """
+    Counts, errors, retries and latencies of the array calls of a backend,
+    by Docker operation and method.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def _method(self, method):
+        key = (current_operation(), method)
+        entry = self._methods.get(key)
+        if entry is None:
+            entry = self._methods[key] = _Method()
+        return entry
+
+    def record(self, method, elapsed_ms, failed=False):
+        with self._lock:
+            self._method(method).record(elapsed_ms, failed)
+
+    def record_retry(self, method):
+        with self._lock:
+            self._method(method).retries += 1
+
+    def stats(self):
+        """
+        Returns: A dict of operation to a dict of method to its stats.
+        """
+        result = {}
+        with self._lock:
+            for (op, method), entry in self._methods.items():
+                result.setdefault(op, {})[method] = entry.stats()
+        return result
+
+
+class InstrumentedConnection(object):
+    """
+    Wraps a PyU4V connection object and records every method call made
+    through it in a CallStats.
+    """
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        stats = self._stats
+
+        def call(*args, **kwargs):
+            start = time.time()
+            failed = True
+            try:
+                result = attr(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                stats.record(name, (time.time() - start) * 1000.0, failed)
+        call.__name__ = name
+        return call
+
+
+class WaitStats(object):
+    """
+    Durations, polls and timeouts of waits on the array, by what was waited
+    for.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits = {}
+
+    def record(self, name, elapsed_ms, polls=0, timed_out=False):
+        with self._lock:
+            entry = self._waits.get(name)
+            if entry is None:
+                entry = self._waits[name] = _Method()
+            entry.record(elapsed_ms, timed_out)
+            entry.retries += polls
+
+    def stats(self):
+        """
+        Returns: A dict of wait name to its stats.
+        """
+        result = {}
+        with self._lock:
+            for name, entry in self._waits.items():
+                stats = entry.stats()
+                stats['timeouts'] = stats.pop('errors')
+                stats['polls'] = stats.pop('retries')
+                result[name] = stats
+        return result
@@ -0,0 +1,193 @@
+import collections
+import threading
+import time
+
+from oslo_log import log as logging
+
+import retry
+
+LOG = logging.getLogger(__name__)
+# Admission lanes of calls which only read and of calls which change the
+# array.
+READ = 'read'
+MUTATE = 'mutate'
+
+
+def check_connection(conn):
+    """
+    The default health check, a cheap call which needs a working session.
+    """
+    conn.common.get_uni_version()
+
+
+def close_connection(conn):
+    close = getattr(conn, 'close_session', None)
+    if close is not None:
+        try:
+            close()
+        except Exception as ex:
+            LOG.debug('Error closing connection: %s', ex)
+
+
+class ConnectionPool(object):
+    """
+    A pool of up to size connections, made by factory when needed. Each
+    connection keeps its HTTP session, so requests on it reuse kept alive
+    TLS connections. Connections idle for longer than idle_timeout are
+    closed, and ones idle for longer than check_interval are health checked
+    before being handed out.
+    """
+
+    def __init__(self, factory, size=4, idle_timeout=300, check_interval=60,
+                 health_check=check_connection, close=close_connection):
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.health_check = health_check
+        self.close = close
+        self._idle = collections.deque()
+        self._open = 0
+        self._waiting = 0
+        self._created = 0
+        self._evicted = 0
+        self._failed_checks = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """
+        Returns: A connection, which must be given back with release or
+            discard.
+        """
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.size:
+                    self._waiting += 1
+                    self._cond.wait()
+                    self._waiting -= 1
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._open += 1
+                    self._created += 1
+                    conn = last_used = None
+            if conn is None:
+                try:
+                    return self.factory()
+                except Exception:
+                    self._forget()
+                    raise
+            idle = time.time() - last_used
+            if idle > self.idle_timeout:
+                self.discard(conn, evicted=True)
+                continue
+            if idle > self.check_interval and not self._healthy(conn):
+                self.discard(conn)
+                continue
+            return conn
+
+    def _healthy(self, conn):
+        try:
+            self.health_check(conn)
+            return True
+        except Exception as ex:
+            LOG.info('Connection failed health check: %s', ex)
+            with self._cond:
+                self._failed_checks += 1
+            return False
+
+    def release(self, conn):
+        with self._cond:
+            # Most recently used last, so it is handed out first and the
+            # others can go idle and be evicted.
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+        self.evict_idle()
+
+    def discard(self, conn, evicted=False):
+        self.close(conn)
+        self._forget(evicted)
+
+    def _forget(self, evicted=False):
+        with self._cond:
+            self._open -= 1
+            if evicted:
+                self._evicted += 1
+            self._cond.notify()
+
+    def evict_idle(self):
+        """
+        Close the connections idle for longer than idle_timeout.
+        """
+        now = time.time()
+        with self._cond:
+            stale = [entry for entry in self._idle
+                     if now - entry[1] > self.idle_timeout]
+            for entry in stale:
+                self._idle.remove(entry)
+        for conn, _ in stale:
+            self.discard(conn, evicted=True)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size,
+                    'open': self._open,
+                    'idle': len(self._idle),
+                    'waiting': self._waiting,
+                    'created': self._created,
+                    'evicted': self._evicted,
+                    'failed_checks': self._failed_checks}
+
+
+class PooledConnection(object):
+    """
+    Looks like a PyU4V provisioning object, but makes each call on a
+    provisioning object from a connection borrowed from the pool.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        pool = self._pool
+
+        def call(*args, **kwargs):
+            conn = pool.acquire()
+            try:
+                result = getattr(conn.provisioning, name)(*args, **kwargs)
+            except Exception as e:
+                if retry.no_response(e):
+                    # The session is not trusted again.
+                    pool.discard(conn)
+                else:
+                    pool.release(conn)
+                raise
+            pool.release(conn)
+            return result
+        call.__name__ = name
+        return call
+
+
+class AdmittedConnection(object):
+    """
+    Wraps a PyU4V connection object. Each call first takes a slot of its
+    lane, READ or MUTATE, from admission, a locks.KeyedSemaphore, waiting
+    in turn for one if the lane is full.
+    """
+
+    def __init__(self, conn, admission):
+        self._conn = conn
+        self._admission = admission
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        lane = READ if name.startswith(retry.IDEMPOTENT_PREFIXES) else MUTATE
+        admission = self._admission
+
+        def call(*args, **kwargs):
+            with admission.hold(lane):
+                return attr(*args, **kwargs)
+        call.__name__ = name
+        return call
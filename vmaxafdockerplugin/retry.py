@@ -0,0 +1,217 @@
+import random
+import re
+import threading
+import time
+
+import requests
+import six
+from PyU4V.utils import exception as pyU4V_exception
+from oslo_log import log as logging
+
+import exception
+
+LOG = logging.getLogger(__name__)
+# PyU4V catches requests' connection errors and timeouts itself. It reports
+# them as a VolumeBackendAPIException with no status code, and any other
+# error making the request as one which failed with an exception.
+STATUS_CODE = re.compile(r'status code received is (\w+)')
+REQUEST_FAILED = 'failed with exception'
+# Calls which only read, so are safe to make again.
+IDEMPOTENT_PREFIXES = ('get_', 'is_', 'find_')
+MAX_DELAY = 10.0
+
+
+def _status_code(error):
+    match = STATUS_CODE.search(six.text_type(error))
+    return match.group(1) if match else None
+
+
+def no_response(error):
+    """
+    Returns: True if error means the call got no response from Unisphere,
+        its connection failed or timed out.
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout)):
+        return True
+    return (isinstance(error, pyU4V_exception.VolumeBackendAPIException) and
+            (_status_code(error) == 'None' or
+             REQUEST_FAILED in six.text_type(error)))
+
+
+def unhealthy(error):
+    """
+    Returns: True if error means Unisphere did not handle the call, there
+        was no response or a 5xx one, rather than that it refused it.
+    """
+    if no_response(error):
+        return True
+    return (isinstance(error, pyU4V_exception.VolumeBackendAPIException) and
+            (_status_code(error) or '').startswith('5'))
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a share of calls, so that an overloaded Unisphere is
+    not sent several times its normal load. Each call deposits ratio and
+    each retry withdraws one, the balance never exceeds reserve.
+    """
+
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+    @property
+    def balance(self):
+        return self._balance
+
+
+class RetryPolicy(object):
+    """
+    Retries with exponential backoff and full jitter, within a retry budget.
+    """
+
+    def __init__(self, retries=2, delay=0.5, budget=None):
+        self.retries = retries
+        self.delay = delay
+        self.budget = budget or RetryBudget()
+
+    def should_retry(self, attempt):
+        """
+        Args:
+            attempt: The number of attempts which have failed.
+        Returns: True if another attempt may be made.
+        """
+        return attempt <= self.retries and self.budget.withdraw()
+
+    def backoff(self, attempt):
+        """
+        Returns: The seconds to wait before the next attempt.
+        """
+        return random.uniform(
+            0, min(MAX_DELAY, self.delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls at once while Unisphere is unhealthy. After threshold
+    failures in a row it opens for reset_timeout seconds, then lets one
+    probe call through. The breaker closes if the probe succeeds and opens
+    again if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._changed_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # A probe which has not come back within reset_timeout is
+            # given up on and another one allowed.
+            if time.time() - self._changed_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._changed_at = time.time()
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, healthy):
+        with self._lock:
+            if healthy:
+                if self.state != self.CLOSED:
+                    LOG.info('Circuit breaker closed')
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    self.failures >= self.threshold):
+                LOG.warning('Circuit breaker opened after %d failures',
+                            self.failures)
+                self.state = self.OPEN
+                self.trips += 1
+                self._changed_at = time.time()
+
+    def retry_after(self):
+        return max(0, int(self._changed_at + self.reset_timeout - time.time()))
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state,
+                    'failures': self.failures,
+                    'trips': self.trips,
+                    'rejected': self.rejected}
+
+
+class ResilientConnection(object):
+    """
+    Wraps a PyU4V connection object. Every call goes through the circuit
+    breaker, and calls which only read are retried by the retry policy.
+    """
+
+    def __init__(self, conn, policy, breaker, stats, name=None):
+        self._conn = conn
+        self._policy = policy
+        self._breaker = breaker
+        self._stats = stats
+        self._name = name
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        idempotent = name.startswith(IDEMPOTENT_PREFIXES)
+
+        def call(*args, **kwargs):
+            if not self._breaker.allow():
+                raise exception.BackendUnavailable(
+                    server=self._name,
+                    retry_after=self._breaker.retry_after())
+            self._policy.budget.deposit()
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    result = attr(*args, **kwargs)
+                except Exception as e:
+                    if not unhealthy(e):
+                        # Unisphere answered, it just refused the call.
+                        self._breaker.record(True)
+                        raise
+                    self._breaker.record(False)
+                    if not (idempotent and
+                            self._policy.should_retry(attempt) and
+                            self._breaker.allow()):
+                        raise
+                    self._stats.record_retry(name)
+                    time.sleep(self._policy.backoff(attempt))
+                    continue
+                self._breaker.record(True)
+                return result
+        call.__name__ = name
+        return call
@@ -0,0 +1,207 @@
+import io
+import json
+import os
+import sys
+import threading
+
+from oslo_log import log as logging
+import six
+from twisted.internet import address
+from twisted.internet import reactor
+from twisted.python import threadpool
+from twisted.web import resource
+from twisted.web import server
+from twisted.web import wsgi
+
+LOG = logging.getLogger(__name__)
+LOCAL_HOST = '127.0.0.1'
+FAST = 'fast'
+ARRAY = 'array'
+# Requests which only read local state. They get a thread pool of their own
+# so they never queue behind Create or Mount requests waiting on the array.
+FAST_PATHS = frozenset(['Plugin.Activate',
+                        'Plugin.Stats',
+                        'VolumeDriver.Capabilities',
+                        'VolumeDriver.Get',
+                        'VolumeDriver.List',
+                        'VolumeDriver.Path'])
+# Thread pool of each lane, once serving.
+LANES = {}
+
+
+def _as_local_host(addr):
+    if isinstance(addr, address.UNIXAddress):
+        return address.IPv4Address('TCP', LOCAL_HOST, 0)
+    return addr
+
+
+class Request(server.Request):
+    # Docker is always on this host. Requests over a unix socket have no
+    # IP addresses, present them as loopback so they are keyed to the same
+    # host as requests over TCP and the WSGI environ can be built.
+
+    def getClientIP(self):
+        return server.Request.getClientIP(self) or LOCAL_HOST
+
+    def getClientAddress(self):
+        return _as_local_host(server.Request.getClientAddress(self))
+
+    def getHost(self):
+        return _as_local_host(server.Request.getHost(self))
+
+
+class LaneResource(resource.Resource):
+    """
+    Hands each request to the WSGI resource of its lane.
+    """
+
+    def __init__(self, lanes):
+        resource.Resource.__init__(self)
+        self.lanes = lanes
+
+    def getChildWithDefault(self, path, request):
+        # Give the segment back, the WSGI application routes on the full
+        # path.
+        request.postpath.insert(0, request.prepath.pop())
+        if not isinstance(path, str):
+            path = path.decode('utf-8')
+        return self.lanes[FAST if path in FAST_PATHS else ARRAY]
+
+
+class Deadline(object):
+    """
+    WSGI middleware which gives each request a deadline. The application
+    runs on a thread of its own while the worker thread waits for it. A
+    request still running at its deadline is answered with an error, so
+    Docker is not left waiting, and the worker goes back to its lane.
+    Python threads cannot be stopped: the overdue handler runs on until it
+    returns, whatever it then does to the array or the volume records
+    stands, and its response is dropped.
+    """
+
+    def __init__(self, app, timeout):
+        """
+        Args:
+            app: The WSGI application.
+            timeout: Seconds a request may run.
+        """
+        self.app = app
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.overdue = 0
+
+    def __call__(self, environ, start_response):
+        # Twisted has read the body already. Hand the handler a copy, the
+        # request's own is closed when an overdue request is answered.
+        environ['wsgi.input'] = io.BytesIO(environ['wsgi.input'].read())
+        call = {'overdue': False}
+        done = threading.Event()
+        thread = threading.Thread(target=self._run,
+                                  args=(environ, call, done),
+                                  name='request ' + environ['PATH_INFO'])
+        thread.daemon = True
+        thread.start()
+        done.wait(self.timeout)
+        with self._lock:
+            if not done.is_set():
+                call['overdue'] = True
+                self.overdue += 1
+        if call['overdue']:
+            LOG.error('%s did not finish within %s seconds',
+                      environ['PATH_INFO'], self.timeout)
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps({u"Err": 'The request did not finish within '
+                                        '%s seconds' % self.timeout})]
+        if 'error' in call:
+            six.reraise(*call['error'])
+        start_response(*call['start'])
+        return call['body']
+
+    def _run(self, environ, call, done):
+        body = []
+
+        def start_response(status, headers, exc_info=None):
+            call['start'] = (status, headers)
+            return body.append
+
+        try:
+            app_iter = self.app(environ, start_response)
+            try:
+                body.extend(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            call['body'] = body
+        except Exception:
+            call['error'] = sys.exc_info()
+        with self._lock:
+            done.set()
+            if call['overdue']:
+                self.overdue -= 1
+                LOG.warning('%s finished after its deadline',
+                            environ['PATH_INFO'])
+
+
+def lane_stats():
+    """
+    Returns: A dict of lane name to its worker threads, the requests being
+        handled, the requests queued waiting for a worker and the requests
+        answered at their deadline whose handlers still run.
+    """
+    return dict((name, {'threads': pool.max,
+                        'active': len(pool.working),
+                        'queued': pool.q.qsize(),
+                        'overdue': deadline.overdue if deadline else 0})
+                for name, (pool, deadline) in LANES.items())
+
+
+def serve(app, port, threads=20, fast_threads=4, backlog=50,
+          idle_timeout=120, request_timeout=600, socket_path=None):
+    """
+    Serve a WSGI application with Twisted. Connections are accepted and
+    parsed on the reactor thread and each request runs on a bounded thread
+    pool, so a slow request only ties up its own worker thread and requests
+    waiting for a worker only hold a connection. Requests in FAST_PATHS
+    run on a separate pool from everything else.
+    Args:
+        app: The WSGI application.
+        port: The TCP port to listen on, on all interfaces.
+        threads: The maximum number of other requests handled at once.
+        fast_threads: The maximum number of FAST_PATHS requests handled at
+            once.
+        backlog: The listen backlog for connections not yet accepted.
+        idle_timeout: Seconds a connection may wait for, or stall while
+            sending, a request before it is closed. The timer is off while
+            a request is handled, request_timeout bounds that.
+        request_timeout: Seconds a request may run before Docker is sent
+            an error and its worker thread is freed, see Deadline. 0 for
+            no deadline.
+        socket_path: Listen on this unix socket instead of the TCP port.
+    """
+    lanes = {}
+    for name, size in ((FAST, fast_threads), (ARRAY, threads)):
+        pool = threadpool.ThreadPool(minthreads=1, maxthreads=size,
+                                     name='vmaxAF-' + name)
+        reactor.callWhenRunning(pool.start)
+        reactor.addSystemEventTrigger('after', 'shutdown', pool.stop)
+        deadline = None
+        if request_timeout:
+            deadline = Deadline(app, request_timeout)
+        LANES[name] = (pool, deadline)
+        lanes[name] = wsgi.WSGIResource(reactor, pool, deadline or app)
+    site = server.Site(LaneResource(lanes), timeout=idle_timeout)
+    site.requestFactory = Request
+    if socket_path:
+        socket_dir = os.path.dirname(socket_path)
+        if not os.path.exists(socket_dir):
+            os.makedirs(socket_dir)
+        if os.path.exists(socket_path):
+            # Left behind by a previous run which did not shut down cleanly.
+            os.remove(socket_path)
+        reactor.listenUNIX(socket_path, site, backlog=backlog, mode=0o660)
+        LOG.info('Listening on socket: %s', socket_path)
+    else:
+        reactor.listenTCP(port, site, backlog=backlog)
+    LOG.info('Serving with up to %d worker threads and %d fast lane threads',
+             threads, fast_threads)
+    reactor.run()
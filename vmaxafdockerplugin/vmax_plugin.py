@@ -1,15 +1,23 @@
+import contextlib
+import functools
 import hashlib
-import platform
+from multiprocessing import pool as mp_pool
 import random
+import threading
 
 import six
-import time
 import PyU4V
 from PyU4V.utils import exception as pyU4V_exception
 from oslo_log import log as logging
 
+import cache
 import exception
-import fileutil
+import identity
+import locks
+import metrics
+import pool
+import retry
+import waiter
 
 LOG = logging.getLogger(__name__)
 
@@ -27,6 +35,17 @@ IG_NAME = 'init_group_name'
 PARENT_SG_NAME = 'parent_sg_name'
 PORTGROUPNAME = 'port_group_name'
 CONNECTOR = 'connector'
+# Seconds to wait for Unisphere to report the default storage group empty
+# before it is deleted.
+DEFAULT_SG_CLEANUP_TIMEOUT = 60
+# Most ports of a port group looked up at once.
+FIND_IPS_WORKERS = 8
+# Held by (array, name) while masking views, initiator groups or default
+# storage groups are checked and then created or deleted. They are shared
+# by every volume of a host, whichever backend it is on. A masking view's
+# lock covers its storage groups, and is always taken before the lock of
+# an initiator group or default storage group.
+MASKING_LOCKS = locks.KeyedLock()
 
 
 class VmaxAf:
@@ -36,7 +55,11 @@ class VmaxAf:
     """
 
     def __init__(self, u4v_ip=None, user=None, password=None, port=8443,
-                 sg=None, array=None, protocol=ISCSI):
+                 sg=None, array=None, protocol=ISCSI, catalog_ttl=300,
+                 object_cache_ttl=10, retry_policy=None, circuit_breaker=None,
+                 initiator_cache_ttl=300, host_identity=None,
+                 pool_size=4, pool_idle_timeout=300, pool_check_interval=60,
+                 read_limit=3, mutate_limit=1):
         self.user = user
         self.password = password
         self.U4V = u4v_ip
@@ -48,9 +71,142 @@ class VmaxAf:
             self.protocol = ISCSI
         else:
             self.protocol = protocol
-        self.CONN = PyU4V.U4VConn(
-            username=user, password=password, server_ip=u4v_ip, port=port,
-            array_id=array, verify=False).provisioning
+        # The caches are shared by every backend on the array, so a change
+        # made through one backend is not hidden from the others.
+        # SLOs, workloads, SRPs, port groups and port IPs, which hardly ever
+        # change on the array.
+        self.catalog = cache.shared('catalog', array, catalog_ttl)
+        # Storage groups, masking views and initiator groups, looked up
+        # several times over on each attach and detach. Dropped whenever
+        # this plugin changes any of them.
+        self.objects = cache.shared('objects', array, object_cache_ttl)
+        # The initiators in use on the array indexed by name, and the
+        # initiator group of each initiator this host has looked up.
+        self.initiators = cache.shared('initiators', array,
+                                       initiator_cache_ttl)
+        self.calls = metrics.CallStats()
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        self.circuit_breaker = circuit_breaker or retry.CircuitBreaker()
+        self.waits = metrics.WaitStats()
+        self.connections = pool.ConnectionPool(
+            self._connect, size=pool_size, idle_timeout=pool_idle_timeout,
+            check_interval=pool_check_interval)
+        self.admission_waits = metrics.WaitStats()
+        self.admission = locks.KeyedSemaphore(
+            {pool.READ: read_limit, pool.MUTATE: mutate_limit},
+            wait_stats=self.admission_waits)
+        self._conn = retry.ResilientConnection(
+            pool.AdmittedConnection(
+                metrics.InstrumentedConnection(
+                    pool.PooledConnection(self.connections), self.calls),
+                self.admission),
+            self.retry_policy, self.circuit_breaker, self.calls,
+            name=self.U4V)
+        self.identity = host_identity or identity.HostIdentity()
+        self._masking_names = {}
+        self._cleanups = set()
+        self._cleanups_lock = threading.Lock()
+
+    @property
+    def CONN(self):
+        """
+        The PyU4V provisioning calls. Each call is made on a connection
+        from the pool, which connects on first use so that start up does
+        not wait on every configured Unisphere. Every call goes through the
+        circuit breaker, is retried by the retry policy if it only reads,
+        waits its turn for a read or mutate slot, and each attempt is
+        recorded in self.calls.
+        """
+        return self._conn
+
+    def _connect(self):
+        return PyU4V.U4VConn(
+            username=self.user, password=self.password,
+            server_ip=self.U4V, port=self.port,
+            array_id=self.array, verify=False)
+
+    def get_slo_list(self):
+        return self.catalog.get('slos', self.CONN.get_slo_list)
+
+    def get_workload_settings(self):
+        return self.catalog.get('workloads', self.CONN.get_workload_settings)
+
+    def get_srp_list(self):
+        return self.catalog.get('srps', self.CONN.get_srp_list)
+
+    def get_portgroup(self, port_group):
+        return self.catalog.get(
+            ('portgroup', port_group), self.CONN.get_portgroup, port_group)
+
+    def get_ports_from_pg(self, port_group):
+        return self.catalog.get(
+            ('ports', port_group), self.CONN.get_ports_from_pg, port_group)
+
+    def get_storage_group(self, storagegroup_name):
+        return self.objects.get(('sg', storagegroup_name),
+                                self.CONN.get_storage_group, storagegroup_name)
+
+    def get_masking_view(self, masking_view_name):
+        return self.objects.get(('mv', masking_view_name),
+                                self.CONN.get_masking_view, masking_view_name)
+
+    def get_masking_views_from_storage_group(self, storagegroup_name):
+        return self.objects.get(
+            ('sg_mvs', storagegroup_name),
+            self.CONN.get_masking_views_from_storage_group, storagegroup_name)
+
+    def get_masking_views_by_host(self, initiator_group_name):
+        return self.objects.get(
+            ('ig_mvs', initiator_group_name),
+            self.CONN.get_masking_views_by_host, initiator_group_name)
+
+    def get_element_from_masking_view(self, masking_view_name, **kwargs):
+        return self.objects.get(
+            ('mv_element', masking_view_name, tuple(sorted(kwargs))),
+            functools.partial(self.CONN.get_element_from_masking_view,
+                              masking_view_name, **kwargs))
+
+    def is_child_sg_in_parent_sg(self, child_sg_name, parent_sg_name):
+        return self.objects.get(
+            ('child', child_sg_name, parent_sg_name),
+            self.CONN.is_child_sg_in_parent_sg, child_sg_name, parent_sg_name)
+
+    def _mutate(self, func, *args, **kwargs):
+        """Make a call which changes storage groups, masking views or
+        initiator groups on the array, and drop the cached copies.
+
+        :param func: the PyU4V call
+        :returns: what func returns
+        """
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.objects.invalidate()
+
+    def warm_catalog(self, port_groups=None):
+        """
+        Load the catalog so the first Create and Mount do not pay for it.
+        Args:
+            port_groups: The port groups configured for this backend.
+        """
+        self.get_slo_list()
+        self.get_workload_settings()
+        self.get_srp_list()
+        for port_group in port_groups or []:
+            self.get_portgroup(port_group)
+            if self.protocol.lower() == ISCSI:
+                self.find_ips(port_group)
+            else:
+                self.find_target_wwns(port_group)
+
+    def refresh_catalog(self, port_groups=None):
+        """
+        Drop everything held in the catalog and load it again.
+        Args:
+            port_groups: The port groups configured for this backend.
+        """
+        self.catalog.invalidate()
+        self.warm_catalog(port_groups)
 
     def remove_volume(self, volume_name, volume_id):
         """
@@ -62,11 +218,7 @@ class VmaxAf:
         :param volume_name:
         :param volume_id:
         """
-        try:
-            volume_info = self.CONN.get_volume(volume_id)
-        except pyU4V_exception.VolumeBackendAPIException:
-            # try again
-            volume_info = self.CONN.get_volume(volume_id)
+        volume_info = self.CONN.get_volume(volume_id)
         if volume_info is None:
             msg = ('VMAX device ID for volume ' +
                    volume_name + ' Could not be found')
@@ -80,14 +232,11 @@ class VmaxAf:
                 LOG.debug(
                     "volume %s belongs to storage group %s "
                     "removing from SG", volume_id, sg_id)
-                self.CONN.remove_vol_from_storagegroup(sg_id, volume_id)
+                self._mutate(self.CONN.remove_vol_from_storagegroup,
+                             sg_id, volume_id)
 
         LOG.info("Deleting volume  with volume_id: %s", volume_id)
-        try:
-            volume_info = self.CONN.get_volume(volume_id)
-        except pyU4V_exception.VolumeBackendAPIException:
-            # try again
-            volume_info = self.CONN.get_volume(volume_id)
+        volume_info = self.CONN.get_volume(volume_id)
         if volume_info['num_of_storage_groups'] == 0:
             try:
                 self.CONN.deallocate_volume(volume_id)
@@ -103,13 +252,67 @@ class VmaxAf:
         return True
 
     def find_ips(self, port_group):
+        return list(self.catalog.get(
+            ('pg_ips', port_group), self._find_ips, port_group) or [])
+
+    def _find_ips(self, port_group):
+        """Get the ips of the ports in a port group, looking the ports up
+        in parallel.
+
+        :param port_group: the port group name
+        :returns: list of ips, or None if there are none
+        """
+        ports = self.get_ports_from_pg(port_group) or []
+        LOG.debug("Ports of %(pg)s: %(ports)s",
+                  {'pg': port_group, 'ports': ports})
+        operation = metrics.current_operation()
+
+        def get_ip(port):
+            with metrics.operation(operation):
+                return self._get_ip(port)
+
+        if len(ports) > 1:
+            workers = mp_pool.ThreadPool(min(len(ports), FIND_IPS_WORKERS))
+            try:
+                ip_lists = workers.map(get_ip, ports)
+            finally:
+                workers.close()
+                workers.join()
+        else:
+            ip_lists = [get_ip(port) for port in ports]
         ips = []
-        ports = self.CONN.get_ports_from_pg(port_group)
-        for port in ports:
-            LOG.debug(port)
-            ip = self._get_ip(port)
-            ips.extend(ip)
-        return ips
+        for ip_list in ip_lists:
+            ips.extend(ip_list)
+        return ips or None
+
+    def find_target_wwns(self, port_group):
+        """Get the WWPNs of the FC ports in a port group.
+
+        :param port_group: the port group name
+        :returns: list of WWPNs, empty if they cannot be found
+        """
+        try:
+            return list(self.catalog.get(
+                ('pg_wwns', port_group), self._find_target_wwns,
+                port_group) or [])
+        except (pyU4V_exception.PyU4VException,
+                exception.VMAXPluginException) as e:
+            LOG.warning("Unable to get the target WWPNs of port group "
+                        "%(pg)s: %(e)s",
+                        {'pg': port_group, 'e': six.text_type(e)})
+            return []
+
+    def _find_target_wwns(self, port_group):
+        wwns = []
+        for port in self.get_ports_from_pg(port_group) or []:
+            # Ports are named director:port, such as FA-1D:4.
+            director, port_no = port.split(':', 1)
+            wwn = self.catalog.get(
+                ('wwn', port), self.CONN.get_port_identifier,
+                director, port_no)
+            if wwn:
+                wwns.append(wwn)
+        return wwns or None
 
     def _get_ip(self, port):
         """Get ip and iqn from the director port.
@@ -117,6 +320,9 @@ class VmaxAf:
         :param port: the director port on the array
         :returns: ip_and_iqn - dict
         """
+        return list(self.catalog.get(('ips', port), self._load_ips, port))
+
+    def _load_ips(self, port):
         ip_list = []
 
         ip_addresses, iqn = self.CONN.get_iscsi_ip_address_and_iqn(port)
@@ -151,28 +357,31 @@ class VmaxAf:
                   {'volume': volume_name, 'srp': volume_opts['srp'],
                    'array': self.array, 'size': volume_opts['size']})
 
-        storagegroup_name = self.get_or_create_default_storage_group(
-            volume_opts[SRP], volume_opts[SLO], volume_opts[WORKLOAD])
-        try:
-            device_id = self.CONN.create_volume_from_sg_return_dev_id(
-                volume_name, storagegroup_name, volume_opts['size'])
-        except Exception:
-            # if the volume create fails, check if the
-            # storage group needs to be cleaned up
-            exception_message = ("Create volume failed. Checking if "
-                                 "storage group cleanup necessary...")
-            num_vol_in_sg = self.CONN.get_num_vols_in_sg(storagegroup_name)
-            if num_vol_in_sg == 0:
-                LOG.debug("There are no volumes in the storage group "
-                          "%(sg_id)s. Deleting storage group.",
-                          {'sg_id': storagegroup_name})
-                self.CONN.delete_storagegroup(storagegroup_name)
-            raise exception.VMAXPluginException(exception_message)
-        try:
-            volume_info = self.CONN.get_volume(device_id)
-        except pyU4V_exception.VolumeBackendAPIException:
-            # try again
-            volume_info = self.CONN.get_volume(device_id)
+        with self.default_storage_group(
+                volume_opts[SRP], volume_opts[SLO],
+                volume_opts[WORKLOAD]) as storagegroup_name:
+            try:
+                device_id = self._mutate(
+                    self.CONN.create_volume_from_sg_return_dev_id,
+                    volume_name, storagegroup_name, volume_opts['size'])
+            except Exception:
+                # if the volume create fails, check if the
+                # storage group needs to be cleaned up
+                exception_message = ("Create volume failed. Checking if "
+                                     "storage group cleanup necessary...")
+                # The default storage group may have gone since it was
+                # cached.
+                self.objects.invalidate()
+                num_vol_in_sg = self.CONN.get_num_vols_in_sg(
+                    storagegroup_name)
+                if num_vol_in_sg == 0:
+                    LOG.debug("There are no volumes in the storage group "
+                              "%(sg_id)s. Deleting storage group.",
+                              {'sg_id': storagegroup_name})
+                    self._mutate(self.CONN.delete_storagegroup,
+                                 storagegroup_name)
+                raise exception.VMAXPluginException(exception_message)
+        volume_info = self.CONN.get_volume(device_id)
         LOG.debug("Volume info is %s" % volume_info)
 
         return volume_info
@@ -180,8 +389,16 @@ class VmaxAf:
     def verify_slo_workload(self, slo, workload):
         is_valid_slo = False
         is_valid_workload = False
-        valid_workloads = self.CONN.get_workload_settings()
-        valid_slos = self.CONN.get_slo_list()
+        valid_workloads = self.get_workload_settings() or []
+        valid_slos = self.get_slo_list() or []
+        if ((workload is not None and workload not in valid_workloads) or
+                (slo is not None and slo not in valid_slos)):
+            # The catalog may predate a change on the array, check again
+            # before failing the request.
+            self.catalog.invalidate('workloads')
+            self.catalog.invalidate('slos')
+            valid_workloads = self.get_workload_settings() or []
+            valid_slos = self.get_slo_list() or []
 
         if (workload in valid_workloads) or (workload is None):
             is_valid_workload = True
@@ -195,9 +412,30 @@ class VmaxAf:
                        "%s" % (slo, valid_slos)))
         return is_valid_slo, is_valid_workload
 
+    @contextlib.contextmanager
+    def default_storage_group(self, srp, slo, workload):
+        """Get or create a default storage group and hold its lock.
+
+        The background cleanup deletes the group once it is empty, so a
+        volume must be added to it before the lock is released.
+
+        :param srp: the SRP name
+        :param slo: the SLO
+        :param workload: the workload
+        :returns: storagegroup_name
+        :raises: VolumeBackendAPIException
+        """
+        storagegroup_name = self.get_default_storage_group_name(
+            srp, slo, workload)
+        with MASKING_LOCKS.lock((self.array, storagegroup_name)):
+            yield self.get_or_create_default_storage_group(
+                srp, slo, workload)
+
     def get_or_create_default_storage_group(self, srp, slo, workload):
         """Get or create a default storage group.
 
+        Called with the group's lock held, see default_storage_group.
+
         :param srp: the SRP name
         :param slo: the SLO
         :param workload: the workload
@@ -207,12 +445,12 @@ class VmaxAf:
         storagegroup, storagegroup_name = (
             self.get_vmax_default_storage_group(srp, slo, workload))
         if storagegroup is None:
-            self.CONN.create_storage_group(
-                srp, storagegroup_name, slo, workload)
+            self._mutate(self.CONN.create_storage_group,
+                         srp, storagegroup_name, slo, workload)
         else:
             # Check that SG is not part of a masking view
             LOG.debug("Using existing default storage group")
-            masking_views = self.CONN.get_masking_views_from_storage_group(
+            masking_views = self.get_masking_views_from_storage_group(
                 storagegroup_name)
             if masking_views:
                 exception_message = (
@@ -232,6 +470,23 @@ class VmaxAf:
         :param workload: the workload
         :returns: the storage group dict (or None), the storage group name
         """
+        storage_group_name = self.get_default_storage_group_name(
+            srp, slo, workload)
+        try:
+            storagegroup = self.get_storage_group(storage_group_name)
+        except pyU4V_exception.ResourceNotFoundException:
+            storagegroup = None
+        return storagegroup, storage_group_name
+
+    @staticmethod
+    def get_default_storage_group_name(srp, slo, workload):
+        """Get the name of the default storage group.
+
+        :param srp: the pool name
+        :param slo: the SLO
+        :param workload: the workload
+        :returns: the storage group name
+        """
         if slo and workload:
             prefix = ("DK-%(srpName)s-%(slo)s-%(workload)s"
                       % {'srpName': srp, 'slo': slo, 'workload': workload})
@@ -239,24 +494,31 @@ class VmaxAf:
         else:
             prefix = "DK-no_SLO"
 
-        storage_group_name = ("%(prefix)s-SG" % {'prefix': prefix})
-        try:
-            storagegroup = self.CONN.get_storage_group(storage_group_name)
-        except pyU4V_exception.ResourceNotFoundException:
-            storagegroup = None
-        return storagegroup, storage_group_name
+        return "%(prefix)s-SG" % {'prefix': prefix}
 
     def attach_volume(self, volume_name, device_id, group_conf):
+        """Mask a volume to this host.
+
+        :param volume_name: the volume name
+        :param device_id: the device id
+        :param group_conf: the backend configuration
+        :returns: list -- for iSCSI the target ips, for FC the WWPNs of
+            the target ports
+        """
         target_ip_list = []
         masking_view_dict = self._populate_masking_dict(
             volume_name, device_id, group_conf)
-        _, default_sg_name = self.get_vmax_default_storage_group(
+        default_sg_name = self.get_default_storage_group_name(
             masking_view_dict[SRP], masking_view_dict[SLO],
             masking_view_dict[WORKLOAD])
-        error_message = self.get_or_create_masking_view(
-            masking_view_dict, default_sg_name)
+        with MASKING_LOCKS.lock((self.array, masking_view_dict[MV_NAME])):
+            error_message = self.get_or_create_masking_view(
+                masking_view_dict, default_sg_name)
         if not error_message and self.protocol.lower() == ISCSI:
             target_ip_list = self.find_ips(masking_view_dict[PORTGROUPNAME])
+        elif not error_message:
+            target_ip_list = self.find_target_wwns(
+                masking_view_dict[PORTGROUPNAME])
         return target_ip_list
 
     def get_or_create_masking_view(self, masking_view_dict, default_sg_name):
@@ -268,13 +530,16 @@ class VmaxAf:
         """
         masking_view_name = masking_view_dict[MV_NAME]
         try:
-            masking_view_details = self.CONN.get_masking_view(
+            masking_view_details = self.get_masking_view(
                 masking_view_name)
         except pyU4V_exception.ResourceNotFoundException:
             masking_view_details = None
         if not masking_view_details:
-            error_message = self._create_new_masking_view(
-                masking_view_dict, masking_view_name, default_sg_name)
+            # The initiator group may be shared with the host's other
+            # masking views, it must not be deleted before this one exists.
+            with MASKING_LOCKS.lock((self.array, masking_view_dict[IG_NAME])):
+                error_message = self._create_new_masking_view(
+                    masking_view_dict, masking_view_name, default_sg_name)
 
         else:
             storagegroup_name, error_message = (
@@ -311,7 +576,7 @@ class VmaxAf:
         if error_message:
             return error_message
 
-        portgroup = self.CONN.get_portgroup(port_group_name)
+        portgroup = self.get_portgroup(port_group_name)
         if portgroup is None:
             msg = ("Cannot get port group: %(portgroup)s from the array "
                    "%(array)s. Portgroups must be pre-configured - please "
@@ -342,7 +607,8 @@ class VmaxAf:
         if error_message:
             return error_message
         try:
-            self.CONN.create_masking_view_existing_components(
+            self._mutate(
+                self.CONN.create_masking_view_existing_components,
                 port_group_name, masking_view_name, storagegroup_name,
                 host_name=init_group_name)
         except Exception as e:
@@ -365,8 +631,11 @@ class VmaxAf:
         # If you cannot find an initiator group that matches the connector
         # info, create a new initiator group.
         if found_init_group is None:
-            self.CONN.create_host(
-                init_group_name, initiator_list=initiator_names, async=True)
+            self._mutate(self.CONN.create_host, init_group_name,
+                         initiator_list=initiator_names, async=True)
+            self.initiators.invalidate('in_use')
+            for initiator in initiator_names:
+                self.initiators.set(('ig', initiator), init_group_name)
             LOG.debug("Created new initiator group name: %(init_group_name)s.",
                       {'init_group_name': init_group_name})
             found_init_group = init_group_name
@@ -425,15 +694,46 @@ class VmaxAf:
         :param initiator_names: the list of initiator names
         :returns: initiator group name -- string or None
         """
-        ig_name = None
-        init_list = self.CONN.get_in_use_initiator_list_from_array()
         for initiator in initiator_names:
-            found_init = [init for init in init_list if initiator in init]
-            if found_init:
-                ig_name = self.CONN.get_initiator_group_from_initiator(
-                    found_init[0])
-                break
-        return ig_name
+            ig_name = self.initiators.get(
+                ('ig', initiator), self._load_initiator_group, initiator)
+            if ig_name:
+                return ig_name
+        # The index may predate an initiator group made since, check the
+        # array again before one is created.
+        self.initiators.invalidate('in_use')
+        for initiator in initiator_names:
+            ig_name = self.initiators.get(
+                ('ig', initiator), self._load_initiator_group, initiator)
+            if ig_name:
+                return ig_name
+        return None
+
+    def _load_initiator_group(self, initiator):
+        """Look up the initiator group of an initiator on the array.
+
+        :param initiator: the initiator name
+        :returns: initiator group name -- string or None
+        """
+        index = self.initiators.get('in_use', self._load_in_use_initiators)
+        found_init = index.get(initiator) or [
+            init for init_ids in index.values() for init in init_ids
+            if initiator in init]
+        if found_init:
+            return self.CONN.get_initiator_group_from_initiator(
+                found_init[0])
+        return None
+
+    def _load_in_use_initiators(self):
+        """Index the initiators in use on the array by initiator name.
+
+        :returns: dict -- initiator name to its initiator ids
+        """
+        index = {}
+        for init in self.CONN.get_in_use_initiator_list_from_array() or []:
+            # Ids are director:port:name, iSCSI names hold colons too.
+            index.setdefault(init.split(':', 2)[-1], []).append(init)
+        return index
 
     def _move_vol_from_default_sg(
             self, device_id, volume_name, default_sg_name,
@@ -455,20 +755,13 @@ class VmaxAf:
                       "storage group %(sg_name)s.",
                       {'num_vol': num_vol_in_sg,
                        'sg_name': default_sg_name})
-            self.CONN.move_volumes_between_storage_groups(
-                device_id, default_sg_name, dest_storagegroup)
+            self._mutate(self.CONN.move_volumes_between_storage_groups,
+                         device_id, default_sg_name, dest_storagegroup)
 
             if num_vol_in_sg == 1:
-                num_vol = self.CONN.get_num_vols_in_sg(default_sg_name)
-                count = 0
-                while num_vol == 1 and count < 6:
-                    time.sleep(5)
-                    num_vol = self.CONN.get_num_vols_in_sg(default_sg_name)
-                    count += 1
-
-                if num_vol < 1:
-                    # Last volume in the storage group - delete sg.
-                    self.CONN.delete_storagegroup(default_sg_name)
+                # Last volume in the storage group - delete sg once
+                # Unisphere reports it empty, without holding up the mount.
+                self._delete_default_sg_when_empty(default_sg_name)
 
         else:
             LOG.warning(
@@ -481,6 +774,46 @@ class VmaxAf:
 
         return msg
 
+    def _delete_default_sg_when_empty(self, default_sg_name):
+        """Delete a default storage group in the background once empty.
+
+        :param default_sg_name: the name of the default sg
+        """
+        with self._cleanups_lock:
+            if default_sg_name in self._cleanups:
+                return
+            self._cleanups.add(default_sg_name)
+        worker = threading.Thread(target=self._cleanup_default_sg,
+                                  args=(default_sg_name,),
+                                  name='cleanup-' + default_sg_name)
+        worker.daemon = True
+        worker.start()
+
+    def _cleanup_default_sg(self, default_sg_name):
+        try:
+            with metrics.operation('Cleanup'):
+                if waiter.wait_for(
+                        lambda: self.CONN.get_num_vols_in_sg(
+                            default_sg_name) < 1,
+                        DEFAULT_SG_CLEANUP_TIMEOUT, 'default_sg_empty',
+                        stats=self.waits):
+                    with MASKING_LOCKS.lock((self.array, default_sg_name)):
+                        # A Create or Unmount may have used it since.
+                        if self.CONN.get_num_vols_in_sg(default_sg_name) < 1:
+                            self._mutate(self.CONN.delete_storagegroup,
+                                         default_sg_name)
+                else:
+                    LOG.debug("Storage group %(sg_name)s still has volumes, "
+                              "not deleting it.",
+                              {'sg_name': default_sg_name})
+        except Exception as e:
+            LOG.warning("Unable to clean up storage group %(sg_name)s: "
+                        "%(e)s", {'sg_name': default_sg_name,
+                                  'e': six.text_type(e)})
+        finally:
+            with self._cleanups_lock:
+                self._cleanups.discard(default_sg_name)
+
     def _check_adding_volume_to_storage_group(
             self, device_id, storagegroup_name, volume_name):
         """Check if a volume is part of an sg and add it if not.
@@ -498,8 +831,8 @@ class VmaxAf:
                        'sg_name': storagegroup_name})
         else:
             try:
-                self.CONN.add_existing_vol_to_sg(
-                    storagegroup_name, device_id, async=True)
+                self._mutate(self.CONN.add_existing_vol_to_sg,
+                             storagegroup_name, device_id, async=True)
             except Exception as e:
                 msg = ("Exception adding volume %(vol)s to %(sg)s. "
                        "Exception received was %(e)s."
@@ -525,11 +858,12 @@ class VmaxAf:
         else:
             slo = masking_view_dict[SLO]
         try:
-            storagegroup = self.CONN.get_storage_group(storage_group_name)
+            storagegroup = self.get_storage_group(storage_group_name)
         except pyU4V_exception.ResourceNotFoundException:
             storagegroup = None
         if storagegroup is None:
-            storagegroup = self.CONN.create_storage_group(
+            storagegroup = self._mutate(
+                self.CONN.create_storage_group,
                 srp, storage_group_name, slo, workload)
 
         if storagegroup is None:
@@ -554,9 +888,9 @@ class VmaxAf:
         storage_group_name, msg = self._check_existing_storage_group(
             masking_view_name, default_sg_name, masking_view_dict)
         if not msg:
-            portgroup_name = self.CONN.get_element_from_masking_view(
+            portgroup_name = self.get_element_from_masking_view(
                 masking_view_name, portgroup=True)
-            portgroup = self.CONN.get_portgroup(portgroup_name)
+            portgroup = self.get_portgroup(portgroup_name)
             if portgroup is None:
                 msg = ("Cannot get port group: %(portgroup)s from the array "
                        "%(array)s. Portgroups must be pre-configured - please "
@@ -564,7 +898,7 @@ class VmaxAf:
                        % {'portgroup': portgroup_name, 'array': self.array})
                 LOG.error(msg)
             else:
-                ig_from_mv = self.CONN.get_element_from_masking_view(
+                ig_from_mv = self.get_element_from_masking_view(
                     masking_view_name, host=True)
                 if ig_from_mv is None:
                     msg = ("Cannot get initiator group: %(ig_name)s "
@@ -590,10 +924,10 @@ class VmaxAf:
         msg = None
         child_sg_name = masking_view_dict[SG_NAME]
         parent_sg_name = masking_view_dict[PARENT_SG_NAME]
-        sg_from_mv = self.CONN.get_element_from_masking_view(
+        sg_from_mv = self.get_element_from_masking_view(
             masking_view_name, storagegroup=True)
 
-        storagegroup = self.CONN.get_storage_group(sg_from_mv)
+        storagegroup = self.get_storage_group(sg_from_mv)
 
         if not storagegroup:
             msg = ("Cannot get storage group: %(sg_from_mv)s "
@@ -602,9 +936,9 @@ class VmaxAf:
                       'masking_view': masking_view_name})
             LOG.error(msg)
         else:
-            check_child = self.CONN.is_child_sg_in_parent_sg(
+            check_child = self.is_child_sg_in_parent_sg(
                 child_sg_name, parent_sg_name)
-            child_sg = self.CONN.get_storage_group(child_sg_name)
+            child_sg = self.get_storage_group(child_sg_name)
             # Ensure the child sg can be retrieved
             if check_child and not child_sg:
                 msg = ("Cannot get child storage group: %(sg_name)s "
@@ -639,7 +973,7 @@ class VmaxAf:
         :returns: error_message or None
         """
         msg = None
-        if self.CONN.is_child_sg_in_parent_sg(
+        if self.is_child_sg_in_parent_sg(
                 child_sg_name, parent_sg_name):
             LOG.debug("Child sg: %(child_sg)s is already part "
                       "of parent storage group %(parent_sg)s.",
@@ -647,8 +981,8 @@ class VmaxAf:
                        'parent_sg': parent_sg_name})
         else:
             try:
-                self.CONN.add_child_sg_to_parent_sg(
-                    child_sg_name, parent_sg_name)
+                self._mutate(self.CONN.add_child_sg_to_parent_sg,
+                             child_sg_name, parent_sg_name)
             except Exception as e:
                 msg = ("Exception adding child sg %(child_sg)s to "
                        "%(parent_sg)s. Exception received was %(e)s"
@@ -659,6 +993,22 @@ class VmaxAf:
         return msg
 
     def detach_volume(self, volume_name, device_id, group_conf):
+        # Whichever port group the volume was attached through.
+        with MASKING_LOCKS.lock_all(self._masking_view_locks(group_conf)):
+            self._detach_volume(volume_name, device_id, group_conf)
+
+    def _masking_view_locks(self, group_conf):
+        """The lock keys of this host's masking views on a backend.
+
+        :param group_conf: the backend configuration
+        :returns: list -- (array, masking view name) tuples
+        """
+        return [(self.array, self._get_masking_names(
+            group_conf.safe_get(SRP), group_conf.safe_get(SLO),
+            group_conf.safe_get(WORKLOAD), port_group)[MV_NAME])
+            for port_group in group_conf.safe_get('port_groups') or []]
+
+    def _detach_volume(self, volume_name, device_id, group_conf):
         move = False
         storagegroup_names = self.get_storage_groups_from_volume(
             device_id)
@@ -679,11 +1029,7 @@ class VmaxAf:
         :returns: storagegroup_list
         """
         sg_list = []
-        try:
-            vol = self.CONN.get_volume(device_id)
-        except pyU4V_exception.VolumeBackendAPIException:
-            # try again
-            vol = self.CONN.get_volume(device_id)
+        vol = self.CONN.get_volume(device_id)
         if vol and vol.get('storageGroupId'):
             sg_list = vol['storageGroupId']
         num_storage_groups = len(sg_list)
@@ -703,7 +1049,7 @@ class VmaxAf:
         :param storagegroup_name: the storage group name
         :param move: flag to indicate if move should be used instead of remove
         """
-        masking_list = self.CONN.get_masking_views_from_storage_group(
+        masking_list = self.get_masking_views_from_storage_group(
             storagegroup_name)
         if not masking_list:
             LOG.debug("No masking views associated with storage group "
@@ -783,8 +1129,8 @@ class VmaxAf:
             self.add_volume_to_default_storage_group(
                 device_id, volume_name, group_conf, src_sg=storagegroup_name)
         else:
-            self.CONN.remove_vol_from_storagegroup(
-                storagegroup_name, device_id)
+            self._mutate(self.CONN.remove_vol_from_storagegroup,
+                         storagegroup_name, device_id)
 
         LOG.debug(
             "Volume %(volume_name)s successfully moved/ removed from "
@@ -820,7 +1166,7 @@ class VmaxAf:
         LOG.debug("Only one volume remains in storage group "
                   "%(sgname)s. Driver will attempt cleanup.",
                   {'sgname': storagegroup_name})
-        masking_view_list = self.CONN.get_masking_views_from_storage_group(
+        masking_view_list = self.get_masking_views_from_storage_group(
             storagegroup_name)
         if not bool(masking_view_list):
             status = self._last_vol_no_masking_views(
@@ -852,7 +1198,7 @@ class VmaxAf:
                     device_id, volume_name, group_conf,
                     src_sg=storagegroup_name)
             # Delete the storage group.
-            self.CONN.delete_storage_group(storagegroup_name)
+            self._mutate(self.CONN.delete_storage_group, storagegroup_name)
             status = True
         else:
             num_vols_parent = self.CONN.get_num_vols_in_sg(parent_sg)
@@ -882,15 +1228,16 @@ class VmaxAf:
             self.add_volume_to_default_storage_group(
                 device_id, volume_name, group_conf, src_sg=storagegroup_name)
         else:
-            self.CONN.remove_vol_from_storagegroup(storagegroup_name, device_id)
+            self._mutate(self.CONN.remove_vol_from_storagegroup,
+                         storagegroup_name, device_id)
 
         LOG.debug("Remove the last volume %(volumeName)s completed "
                   "successfully.", {'volumeName': volume_name})
         if parent_sg_name:
-            self.CONN.remove_child_sg_from_parent_sg(
-                storagegroup_name, parent_sg_name)
+            self._mutate(self.CONN.remove_child_sg_from_parent_sg,
+                         storagegroup_name, parent_sg_name)
 
-        self.CONN.delete_storage_group(storagegroup_name)
+        self._mutate(self.CONN.delete_storage_group, storagegroup_name)
 
     def _delete_cascaded_storage_groups(self, child_sg_name, parent_sg_name,
                                         device_id, move, group_conf):
@@ -905,11 +1252,11 @@ class VmaxAf:
             self.add_volume_to_default_storage_group(
                 device_id, "", group_conf, src_sg=child_sg_name)
         if child_sg_name != parent_sg_name:
-            self.CONN.delete_storagegroup(parent_sg_name)
+            self._mutate(self.CONN.delete_storagegroup, parent_sg_name)
             LOG.debug("Storage Group %(storagegroup_name)s "
                       "successfully deleted.",
                       {'storagegroup_name': parent_sg_name})
-        self.CONN.delete_storagegroup(child_sg_name)
+        self._mutate(self.CONN.delete_storagegroup, child_sg_name)
 
         LOG.debug("Storage Group %(storagegroup_name)s successfully deleted.",
                   {'storagegroup_name': child_sg_name})
@@ -923,15 +1270,16 @@ class VmaxAf:
         :param volume_name: the volume name
         :param src_sg: the source storage group, if any
         """
-        storagegroup_name = self.get_or_create_default_storage_group(
-            group_conf.safe_get(SRP), group_conf.safe_get(SLO),
-            group_conf.safe_get(WORKLOAD))
-        if src_sg is not None:
-            self.CONN.move_volume_between_storage_groups(
-                device_id, src_sg, storagegroup_name, force=True)
-        else:
-            self._check_adding_volume_to_storage_group(
-                device_id, storagegroup_name, volume_name)
+        with self.default_storage_group(
+                group_conf.safe_get(SRP), group_conf.safe_get(SLO),
+                group_conf.safe_get(WORKLOAD)) as storagegroup_name:
+            if src_sg is not None:
+                self._mutate(self.CONN.move_volume_between_storage_groups,
+                             device_id, src_sg, storagegroup_name,
+                             force=True)
+            else:
+                self._check_adding_volume_to_storage_group(
+                    device_id, storagegroup_name, volume_name)
 
     def get_parent_sg_from_child(self, storagegroup_name):
         """Given a storage group name, get its parent storage group, if any.
@@ -940,7 +1288,7 @@ class VmaxAf:
         :returns: the parent storage group name, or None
         """
         parent_sg_name = None
-        storagegroup = self.CONN.get_storage_group(storagegroup_name)
+        storagegroup = self.get_storage_group(storagegroup_name)
         if storagegroup and storagegroup.get('parent_storage_group'):
             parent_sg_name = storagegroup['parent_storage_group'][0]
         return parent_sg_name
@@ -986,9 +1334,9 @@ class VmaxAf:
         :param parent_sg_name: the parent storage group name
         :param move: flag to indicate if the volume should be moved
         """
-        host = platform.node()
+        host = self.identity.host_name()
 
-        initiator_group = self.CONN.get_element_from_masking_view(
+        initiator_group = self.get_element_from_masking_view(
             masking_view, host=True)
         self._last_volume_delete_masking_view(masking_view)
         self._last_volume_delete_initiator_group(initiator_group, host)
@@ -1011,27 +1359,8 @@ class VmaxAf:
                                   'protocol': protocol})
 
             if initiator_group_name == default_ig_name:
-                masking_view_names = (
-                    self.CONN.get_masking_views_by_host(
-                        initiator_group_name))
-                if not masking_view_names:
-                    # Check initiator group hasn't been recently deleted
-                    ig_details = self.CONN.get_initiator_group_from_initiator(
-                        initiator_group_name)
-                    if ig_details:
-                        LOG.debug(
-                            "Last volume associated with the initiator "
-                            "group - deleting the associated initiator "
-                            "group %(initiator_group_name)s.",
-                            {'initiator_group_name': initiator_group_name})
-                        self.CONN.delete_host(initiator_group_name)
-                else:
-                    LOG.warning("Initiator group %(ig_name)s is associated "
-                                "with masking views and can't be deleted. "
-                                "Number of associated masking view is: "
-                                "%(nmv)d.",
-                                {'ig_name': initiator_group_name,
-                                 'nmv': len(masking_view_names)})
+                with MASKING_LOCKS.lock((self.array, initiator_group_name)):
+                    self._delete_unused_initiator_group(initiator_group_name)
             else:
                 LOG.warning("Initiator group %(ig_name)s was "
                             "not created by the VMAX driver so will "
@@ -1042,6 +1371,35 @@ class VmaxAf:
                         "initiator group %(ig_name)s will not be deleted.",
                         {'ig_name': initiator_group_name})
 
+    def _delete_unused_initiator_group(self, initiator_group_name):
+        """Delete an initiator group which is in no masking view.
+
+        :param initiator_group_name: initiator group name
+        """
+        masking_view_names = self.get_masking_views_by_host(
+            initiator_group_name)
+        if masking_view_names:
+            LOG.warning("Initiator group %(ig_name)s is associated "
+                        "with masking views and can't be deleted. "
+                        "Number of associated masking view is: "
+                        "%(nmv)d.",
+                        {'ig_name': initiator_group_name,
+                         'nmv': len(masking_view_names)})
+            return
+        # Check initiator group hasn't been recently deleted
+        ig_details = self.CONN.get_initiator_group_from_initiator(
+            initiator_group_name)
+        if ig_details:
+            LOG.debug(
+                "Last volume associated with the initiator "
+                "group - deleting the associated initiator "
+                "group %(initiator_group_name)s.",
+                {'initiator_group_name': initiator_group_name})
+            self._mutate(self.CONN.delete_host, initiator_group_name)
+            self.initiators.invalidate_matching(
+                lambda key, value: (
+                    key == 'in_use' or value == initiator_group_name))
+
     def _last_volume_delete_masking_view(self, masking_view):
         """Delete the masking view.
 
@@ -1052,7 +1410,7 @@ class VmaxAf:
         LOG.debug("Last volume in the storage group, deleting masking view "
                   "%(masking_view_name)s.",
                   {'masking_view_name': masking_view})
-        self.CONN.delete_masking_view(masking_view)
+        self._mutate(self.CONN.delete_masking_view, masking_view)
         LOG.debug("Masking view %(masking_view_name)s successfully deleted.",
                   {'masking_view_name': masking_view})
 
@@ -1062,7 +1420,7 @@ class VmaxAf:
         :param masking_view_name: the name of the masking view
         :returns: num_vols, parent_sg_name
         """
-        sg_name = self.CONN.get_element_from_masking_view(
+        sg_name = self.get_element_from_masking_view(
             masking_view_name, storagegroup=True)
         parent_sg_name = self.get_parent_sg_from_child(sg_name)
         num_vols = self.CONN.get_num_vols_in_sg(parent_sg_name)
@@ -1074,64 +1432,81 @@ class VmaxAf:
         :param volume: the volume object
         :returns: dict -- a dictionary with masking view information
         """
-        masking_view_dict = {}
-        host_name = platform.node()
-        unique_name = self.truncate_string(group_conf.safe_get(SRP), 12)
-
-        protocol = self.get_short_protocol_type(self.protocol)
         connector = {}
         if self.protocol.lower() == ISCSI:
-            connector['initiator'] = fileutil.get_initiator()
+            connector['initiator'] = self.identity.initiator()
         else:
-            connector['wwpns'] = fileutil.get_wwpns()
+            connector['wwpns'] = self.identity.wwpns()
 
-        short_host_name = self.get_host_short_name(host_name)
-        masking_view_dict['replication_enabled'] = False
-        slo = group_conf.safe_get(SLO)
-        workload = group_conf.safe_get(WORKLOAD)
         port_group = random.choice(group_conf.safe_get('port_groups'))
-        short_pg_name = self.get_pg_short_name(port_group)
-        masking_view_dict[SLO] = slo
-        masking_view_dict[WORKLOAD] = workload
-        masking_view_dict[SRP] = unique_name
-        masking_view_dict[ARRAY] = self.array
-        masking_view_dict[PORTGROUPNAME] = port_group
-
-        if slo:
-            slo_wl_combo = self.truncate_string(slo + workload, 10)
-            child_sg_name = (
-                "DK-%(shortHostName)s-%(srpName)s-%(combo)s-%(pg)s"
-                % {'shortHostName': short_host_name,
-                   'srpName': unique_name,
-                   'combo': slo_wl_combo,
-                   'pg': short_pg_name})
-        else:
-            child_sg_name = (
-                "DK-%(shortHostName)s-No_SLO-%(pg)s"
-                % {'shortHostName': short_host_name,
-                   'pg': short_pg_name})
-        mv_prefix = (
-            "DK-%(shortHostName)s-%(protocol)s-%(pg)s"
-            % {'shortHostName': short_host_name,
-               'protocol': protocol, 'pg': short_pg_name})
-
-        masking_view_dict[SG_NAME] = child_sg_name
-
-        masking_view_dict[MV_NAME] = ("%(prefix)s-MV" % {'prefix': mv_prefix})
-
-        masking_view_dict[PARENT_SG_NAME] = ("%(prefix)s-SG"
-                                             % {'prefix': mv_prefix})
-
-        masking_view_dict[IG_NAME] = (
-            ("DK-%(shortHostName)s-%(protocol)s-IG"
-             % {'shortHostName': short_host_name,
-                'protocol': protocol}))
+        masking_view_dict = self._get_masking_names(
+            group_conf.safe_get(SRP), group_conf.safe_get(SLO),
+            group_conf.safe_get(WORKLOAD), port_group)
         masking_view_dict[CONNECTOR] = connector
         masking_view_dict[DEVICE_ID] = device_id
         masking_view_dict[VOL_NAME] = volume
 
         return masking_view_dict
 
+    def _get_masking_names(self, srp, slo, workload, port_group):
+        """Get the names of the masking view and its components.
+
+        They only depend on the host and the configuration, so are worked
+        out once for each port group.
+        :param srp: the SRP name
+        :param slo: the SLO
+        :param workload: the workload
+        :param port_group: the port group name
+        :returns: dict -- a new copy of the names
+        """
+        host_name = self.identity.host_name()
+        key = (host_name, srp, slo, workload, port_group)
+        names = self._masking_names.get(key)
+        if names is None:
+            names = {}
+            unique_name = self.truncate_string(srp, 12)
+            protocol = self.get_short_protocol_type(self.protocol)
+            short_host_name = self.get_host_short_name(host_name)
+            short_pg_name = self.get_pg_short_name(port_group)
+            names['replication_enabled'] = False
+            names[SLO] = slo
+            names[WORKLOAD] = workload
+            names[SRP] = unique_name
+            names[ARRAY] = self.array
+            names[PORTGROUPNAME] = port_group
+
+            if slo:
+                slo_wl_combo = self.truncate_string(slo + workload, 10)
+                child_sg_name = (
+                    "DK-%(shortHostName)s-%(srpName)s-%(combo)s-%(pg)s"
+                    % {'shortHostName': short_host_name,
+                       'srpName': unique_name,
+                       'combo': slo_wl_combo,
+                       'pg': short_pg_name})
+            else:
+                child_sg_name = (
+                    "DK-%(shortHostName)s-No_SLO-%(pg)s"
+                    % {'shortHostName': short_host_name,
+                       'pg': short_pg_name})
+            mv_prefix = (
+                "DK-%(shortHostName)s-%(protocol)s-%(pg)s"
+                % {'shortHostName': short_host_name,
+                   'protocol': protocol, 'pg': short_pg_name})
+
+            names[SG_NAME] = child_sg_name
+
+            names[MV_NAME] = ("%(prefix)s-MV" % {'prefix': mv_prefix})
+
+            names[PARENT_SG_NAME] = ("%(prefix)s-SG"
+                                     % {'prefix': mv_prefix})
+
+            names[IG_NAME] = (
+                ("DK-%(shortHostName)s-%(protocol)s-IG"
+                 % {'shortHostName': short_host_name,
+                    'protocol': protocol}))
+            self._masking_names[key] = names
+        return dict(names)
+
     def get_pg_short_name(self, portgroup_name):
         """Create a unique port group name under 12 characters.
 
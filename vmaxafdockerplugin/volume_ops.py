@@ -1,5 +1,470 @@
+import abc
+import copy
 import os
 import json
+import sqlite3
+import threading
+import time
+
+import six
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Volume record fields which can be looked up without a full scan, mapped to
+# the key they are stored under in the volume record.
+INDEXED_FIELDS = {'backend_name': 'backend-name',
+                  'volume_id': 'volume_id',
+                  'wwn': 'wwn'}
+
+
+@six.add_metaclass(abc.ABCMeta)
+class VolumeStore(object):
+    """
+    Persistence interface behind VolumeMetaData. VolumeMetaData keeps every
+    volume in memory and tells the store about each change, the store only
+    has to make the changes durable and read them back on start up.
+    """
+
+    @abc.abstractmethod
+    def load(self):
+        """
+        Returns: A dict of all stored volumes keyed by volume name.
+        """
+
+    @abc.abstractmethod
+    def put(self, volume_key, volume):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, volume_key):
+        pass
+
+    def apply(self, changes):
+        """
+        Make a batch of changes durable, in order.
+        Args:
+            changes: A list of ('put', volume_key, volume) and
+                ('delete', volume_key, None) tuples.
+        """
+        for op, volume_key, volume in changes:
+            if op == 'put':
+                self.put(volume_key, volume)
+            else:
+                self.delete(volume_key)
+
+    def changed(self):
+        """
+        Returns: True if the persisted volumes were changed by someone else
+            since they were last loaded, so the caller should load again.
+        """
+        return False
+
+    def find(self, backend_name=None, host=None, volume_id=None, wwn=None):
+        """
+        Look up volume names through the store's indexes.
+        Returns: A list of volume names, or None if the store has no
+            indexes and the caller must scan.
+        """
+        return None
+
+
+class JournalStore(VolumeStore):
+    """
+    The base data file is a snapshot of all volumes. Every change after the
+    snapshot is appended as a single json record to a journal file next to
+    it, so a mount count bump costs one small write instead of a rewrite of
+    every volume. Once the journal holds COMPACT_THRESHOLD records it is
+    folded back into the base file and truncated.
+
+    An edit of the base file made while the plugin runs replaces the
+    volumes as they were, journal included. The journal is discarded rather
+    than replayed over the edit, which would undo it.
+    """
+    #DATA_FILE = os.path.join(BASE_PATH, '..', 'data', 'data.json')
+    #DATA_FILE = os.path.join(BASE_PATH, 'volumes/' 'volumes_data.json')
+    DATA_FILE = os.path.join(BASE_PATH, 'volumes_data.json')
+    JOURNAL_SUFFIX = '.journal'
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self, data_file=DATA_FILE,
+                 compact_threshold=COMPACT_THRESHOLD):
+        self.data_file = data_file
+        self.journal_file = data_file + self.JOURNAL_SUFFIX
+        self.compact_threshold = compact_threshold
+        self.journal_records = 0
+        self.signature = None
+        self.volumes = {}
+
+    def put(self, volume_key, volume):
+        self.apply([('put', volume_key, volume)])
+
+    def delete(self, volume_key):
+        self.apply([('delete', volume_key, None)])
+
+    def apply(self, changes):
+        records = []
+        for op, volume_key, volume in changes:
+            if op == 'put':
+                self.volumes[volume_key] = volume
+                records.append({'op': 'set', 'key': volume_key,
+                                'volume': volume})
+            else:
+                self.volumes.pop(volume_key, None)
+                records.append({'op': 'remove', 'key': volume_key})
+        self.append(records)
+
+    def changed(self):
+        return self._stat() != self.signature
+
+    def _stat(self):
+        """
+        Returns: A signature of the base and journal files which changes
+            whenever either of them is written or replaced.
+        """
+        signature = []
+        for path in (self.data_file, self.journal_file):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def load(self):
+        """
+        Load the base snapshot and replay the journal on top of it.
+        Returns: A dict instance of all the volumes.
+        """
+        data = {}
+        signature = self._stat()
+        if os.path.exists(self.data_file):
+            with open(self.data_file, 'r') as f:
+                data = json.load(f)
+        if (self.signature is not None and
+                signature[0] != self.signature[0]):
+            # Only compaction writes the base file, so somebody else did.
+            LOG.warning('%s was edited, discarding the %d changes in %s',
+                        self.data_file, self.journal_records,
+                        self.journal_file)
+            self._truncate_journal()
+            torn = False
+        else:
+            self.journal_records, torn = self._replay(data)
+        if torn or self.journal_records >= self.compact_threshold:
+            # A torn record would swallow the next append, so fold the
+            # journal away before accepting any new change.
+            self.compact(data)
+        # Private copy for compaction, the caller is free to change data.
+        self.volumes = copy.deepcopy(data)
+        self.signature = self._stat()
+        return data
+
+    def _replay(self, data):
+        """
+        Apply the journal records, in order, to the given snapshot.
+        Args:
+            data: The dict loaded from the base data file.
+        Returns: The number of records applied and whether the journal
+            ended with a partially written record.
+        """
+        count = 0
+        if not os.path.exists(self.journal_file):
+            return count, False
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the last record can be partial, it was never
+                    # acknowledged so it is safe to drop.
+                    LOG.warning('Discarding partial record at end of %s',
+                                self.journal_file)
+                    return count, True
+                if record['op'] == 'set':
+                    data[record['key']] = record['volume']
+                else:
+                    data.pop(record['key'], None)
+                count += 1
+        return count, False
+
+    def append(self, records):
+        """
+        Durably append change records to the journal with a single write.
+        Args:
+            records: A list of dicts with the 'op', 'key' and, for 'set',
+                'volume'.
+        """
+        lines = ''.join(json.dumps(record, sort_keys=False) + '\n'
+                        for record in records)
+        with open(self.journal_file, 'a') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_records += len(records)
+        if self.journal_records >= self.compact_threshold:
+            self.compact(self.volumes)
+        self.signature = self._stat()
+
+    def compact(self, data):
+        """
+        Write the given data as the new base snapshot and empty the journal.
+        Replaying the old journal over the new snapshot is idempotent, so a
+        crash between the two steps loses nothing.
+        """
+        self.save(data)
+        self._truncate_journal()
+
+    def _truncate_journal(self):
+        with open(self.journal_file, 'w') as f:
+            os.fsync(f.fileno())
+        self.journal_records = 0
+
+    def save(self, data):
+        tmp_file = self.data_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_file, self.data_file)
+        self._fsync_dir()
+
+    def _fsync_dir(self):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.data_file)),
+                         os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class SqliteStore(VolumeStore):
+    """
+    Keeps each volume as a row with its backend, device id and wwn in
+    indexed columns, and the hosts it is mounted on in a separate indexed
+    table, so volumes can be looked up by any of them without a scan.
+    Every change is a single transaction.
+
+    A new database is filled from the json store's data file, if there is
+    one, so switching metadata_store over keeps the existing volumes.
+    """
+    DATA_FILE = os.path.join(BASE_PATH, 'volumes_data.db')
+    # PRAGMA user_version once the json data has been looked for.
+    IMPORTED = 1
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS volumes ('
+        ' name TEXT PRIMARY KEY,'
+        ' backend_name TEXT,'
+        ' volume_id TEXT,'
+        ' wwn TEXT,'
+        ' data TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS volumes_backend_name '
+        'ON volumes (backend_name)',
+        'CREATE INDEX IF NOT EXISTS volumes_volume_id ON volumes (volume_id)',
+        'CREATE INDEX IF NOT EXISTS volumes_wwn ON volumes (wwn)',
+        'CREATE TABLE IF NOT EXISTS mounts ('
+        ' name TEXT NOT NULL,'
+        ' host TEXT NOT NULL,'
+        ' PRIMARY KEY (name, host))',
+        'CREATE INDEX IF NOT EXISTS mounts_host ON mounts (host)',
+    ]
+
+    def __init__(self, data_file=DATA_FILE,
+                 json_file=JournalStore.DATA_FILE):
+        self.data_file = data_file
+        self.data_version = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(data_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+        self._import_json(json_file)
+
+    def _import_json(self, json_file):
+        """
+        Copy the volumes of the json store into a database which has never
+        had any, once. The json files are left as they are.
+        """
+        with self.conn:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= self.IMPORTED:
+                return
+            empty = self.conn.execute(
+                'SELECT COUNT(*) FROM volumes').fetchone()[0] == 0
+            if empty and os.path.exists(json_file):
+                volumes = JournalStore(json_file).load()
+                for volume_key, volume in volumes.items():
+                    self._insert(volume_key, volume)
+                LOG.info('Imported %d volumes from %s into %s',
+                         len(volumes), json_file, self.data_file)
+            self.conn.execute('PRAGMA user_version = %d' % self.IMPORTED)
+
+    def load(self):
+        with self.lock:
+            self.data_version = self._data_version()
+            rows = self.conn.execute('SELECT name, data FROM volumes')
+            return dict((name, json.loads(data)) for name, data in rows)
+
+    def changed(self):
+        # data_version only moves when another connection commits.
+        with self.lock:
+            return self._data_version() != self.data_version
+
+    def _data_version(self):
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def put(self, volume_key, volume):
+        self.apply([('put', volume_key, volume)])
+
+    def delete(self, volume_key):
+        self.apply([('delete', volume_key, None)])
+
+    def apply(self, changes):
+        with self.lock, self.conn:
+            for op, volume_key, volume in changes:
+                self.conn.execute('DELETE FROM mounts WHERE name = ?',
+                                  (volume_key,))
+                if op == 'put':
+                    self._insert(volume_key, volume)
+                else:
+                    self.conn.execute('DELETE FROM volumes WHERE name = ?',
+                                      (volume_key,))
+
+    def _insert(self, volume_key, volume):
+        row = [volume_key]
+        row.extend(volume.get(INDEXED_FIELDS[field])
+                   for field in ('backend_name', 'volume_id', 'wwn'))
+        row.append(json.dumps(volume))
+        hosts = list(volume.get('mounted') or {})
+        self.conn.execute(
+            'INSERT OR REPLACE INTO volumes '
+            '(name, backend_name, volume_id, wwn, data) '
+            'VALUES (?, ?, ?, ?, ?)', row)
+        self.conn.executemany(
+            'INSERT INTO mounts (name, host) VALUES (?, ?)',
+            [(volume_key, host) for host in hosts])
+
+    def find(self, backend_name=None, host=None, volume_id=None, wwn=None):
+        criteria = {'backend_name': backend_name,
+                    'volume_id': volume_id,
+                    'wwn': wwn}
+        clauses = []
+        args = []
+        for field in sorted(criteria):
+            if criteria[field] is not None:
+                clauses.append('%s = ?' % field)
+                args.append(criteria[field])
+        if host is not None:
+            clauses.append('name IN (SELECT name FROM mounts WHERE host = ?)')
+            args.append(host)
+        query = 'SELECT name FROM volumes'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self.lock:
+            return [name for name, in self.conn.execute(query, args)]
+
+
+class _Batch(object):
+    def __init__(self):
+        self.changes = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter(object):
+    """
+    Funnels changes from concurrent requests into a single background
+    writer. The first change of a batch starts a commit window, every change
+    submitted before the window closes is made durable by the same store
+    write, and each submitter returns once its own batch is on disk.
+    """
+
+    def __init__(self, store, commit_window=0):
+        """
+        Args:
+            store: The VolumeStore the batches are applied to.
+            commit_window: Seconds to wait for more changes to join a batch.
+        """
+        self.store = store
+        self.commit_window = commit_window
+        self.cond = threading.Condition()
+        self.batch = _Batch()
+        self.flushing = False
+        self.thread = None
+
+    def submit(self, change):
+        """
+        Queue a change and block until the batch holding it is durable.
+        Args:
+            change: A change tuple as accepted by VolumeStore.apply.
+        """
+        self.wait(self.enqueue(change))
+
+    def enqueue(self, change):
+        """
+        Queue a change without waiting for it.
+        Returns: The batch to pass to wait.
+        """
+        with self.cond:
+            batch = self.batch
+            batch.changes.append(change)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='metadata-writer')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return batch
+
+    @staticmethod
+    def wait(batch):
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def busy(self):
+        """
+        Returns: True while changes are queued or being written.
+        """
+        with self.cond:
+            return self.flushing or bool(self.batch.changes)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.batch.changes:
+                    self.cond.wait()
+                self.flushing = True
+            if self.commit_window:
+                time.sleep(self.commit_window)
+            with self.cond:
+                batch, self.batch = self.batch, _Batch()
+            try:
+                self.store.apply(batch.changes)
+            except Exception as e:
+                LOG.exception('Failed to write %d volume metadata changes',
+                              len(batch.changes))
+                batch.error = e
+            with self.cond:
+                self.flushing = False
+            batch.done.set()
+
+
+STORES = {'json': JournalStore,
+          'sqlite': SqliteStore}
+
+
+def get_store(store_type='json'):
+    """
+    Build the metadata store selected by the metadata_store option.
+    Args:
+        store_type: One of the keys of STORES.
+    Returns: A VolumeStore instance.
+    """
+    return STORES[store_type]()
 
 
 class VolumeMetaData(object):
@@ -18,15 +483,15 @@ class VolumeMetaData(object):
         ...
       }
     }
+
+    Persistence is delegated to a VolumeStore, see get_store.
     """
-    BASE_PATH = os.path.dirname(os.path.abspath(__file__))
-    #DATA_FILE = os.path.join(BASE_PATH, '..', 'data', 'data.json')
-    #DATA_FILE = os.path.join(BASE_PATH, 'volumes/' 'volumes_data.json')
-    DATA_FILE = os.path.join(BASE_PATH, 'volumes_data.json')
 
-    def __init__(self, data_file=DATA_FILE):
-        self.data_file = data_file
-        self.volumes = self.load()
+    def __init__(self, store=None, commit_window=0):
+        self.store = store if store is not None else JournalStore()
+        self.writer = GroupCommitWriter(self.store, commit_window)
+        self.lock = threading.Lock()
+        self.volumes = self.store.load()
 
     def get_volumes(self):
         return self.volumes
@@ -38,18 +503,66 @@ class VolumeMetaData(object):
             volume_key: The unique name of the volume as key in the dict.
         Returns: A dict instance of the volume information.
         """
+        self.refresh()
         return self.volumes.get(volume_key)
 
     def set_volume(self, volume_key, volume):
-        self.volumes[volume_key] = volume
-        self.save(self.volumes)
+        # Queue under the lock so changes reach the store in the order they
+        # were made in memory, and copy so the writer never serialises a
+        # record a handler is still changing.
+        with self.lock:
+            self.volumes[volume_key] = volume
+            batch = self.writer.enqueue(
+                ('put', volume_key, copy.deepcopy(volume)))
+        self.writer.wait(batch)
         return volume
 
     def remove_volume(self, volume_key):
-        volume = self.volumes.pop(volume_key, None)
-        self.save(self.volumes)
+        with self.lock:
+            volume = self.volumes.pop(volume_key, None)
+            if volume is None:
+                return None
+            batch = self.writer.enqueue(('delete', volume_key, None))
+        self.writer.wait(batch)
         return volume
 
+    def find_volumes(self, backend_name=None, host=None, volume_id=None,
+                     wwn=None):
+        """
+        Query volumes by backend, mounted host, device id and/or wwn.
+        Criteria left as None are ignored.
+        Returns: A list of dict instances of the matching volumes.
+        """
+        criteria = {'backend_name': backend_name,
+                    'volume_id': volume_id,
+                    'wwn': wwn}
+        names = self.store.find(host=host, **criteria)
+        if names is None:
+            names = [key for key, volume in self.volumes.items()
+                     if self._matches(volume, host, criteria)]
+        return [self.volumes[name] for name in names if name in self.volumes]
+
+    @staticmethod
+    def _matches(volume, host, criteria):
+        if host is not None and host not in (volume.get('mounted') or {}):
+            return False
+        for field, value in criteria.items():
+            if value is not None and (
+                    volume.get(INDEXED_FIELDS[field]) != value):
+                return False
+        return True
+
+    def get_volumes_by_backend(self, backend_name):
+        return self.find_volumes(backend_name=backend_name)
+
+    def get_volumes_mounted_on(self, target_host_name):
+        return self.find_volumes(host=target_host_name)
+
+    def get_volume_by_device_id(self, volume_id, backend_name=None):
+        volumes = self.find_volumes(backend_name=backend_name,
+                                    volume_id=volume_id)
+        return volumes[0] if volumes else None
+
     def is_exported_to(self, volume_key, target_host_name):
         volume = self.volumes.get(volume_key)
         if volume.get('exported'):
@@ -67,25 +580,16 @@ class VolumeMetaData(object):
         return len(volume['exported'].keys()) if volume.get('exported') else 0
 
     def get_volume_list(self):
-        volume_list = []
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-                for key in data:
-                    volume_list.append(key)
-        else:
-            print("File: %s does not exist", self.data_file)
-        return volume_list
-
-    def load(self):
-        data = {}
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-        return data
-
-    def save(self, data):
-        with open(self.data_file, 'w') as f:
-            json.dump(data, f, indent=2, sort_keys=False)
+        """
+        List the volume names from memory, reloading first only if the
+        store was changed out of band.
+        """
+        self.refresh()
+        return list(self.volumes)
 
-volume_ops = VolumeMetaData()
+    def refresh(self):
+        with self.lock:
+            # Our own writes in flight would look like outside changes.
+            if not self.writer.busy() and self.store.changed():
+                LOG.info('Volume metadata changed on disk, reloading')
+                self.volumes = self.store.load()
@@ -0,0 +1,37 @@
+import time
+
+
+def wait_for(condition, timeout, name, stats=None, initial_delay=0.05,
+             max_delay=2.0, factor=2.0):
+    """
+    Poll condition until it is true or timeout seconds have passed. The
+    first polls come quickly, then the delay between them grows, so short
+    waits finish promptly and long ones do not load the array.
+    Args:
+        condition: Called with no arguments, returns True when done.
+        timeout: Seconds to wait at most.
+        name: What is being waited for, the key in stats.
+        stats: A metrics.WaitStats to record the wait in.
+        initial_delay: Seconds before the second poll.
+        max_delay: Most seconds between polls.
+        factor: Growth of the delay after each poll.
+    Returns: True if condition became true, False on timeout.
+    """
+    start = time.time()
+    deadline = start + timeout
+    delay = initial_delay
+    polls = 0
+    while True:
+        polls += 1
+        if condition():
+            met = True
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            met = False
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(max_delay, delay * factor)
+    if stats is not None:
+        stats.record(name, (time.time() - start) * 1000.0, polls, not met)
+    return met